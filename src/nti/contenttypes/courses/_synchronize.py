@@ -70,6 +70,8 @@ from nti.contenttypes.courses.discussions.parser import parse_discussions
 
 from nti.contenttypes.courses.grading import fill_grading_policy_from_key
 
+from nti.contenttypes.courses.indexing import deferred_index_updates
+
 from nti.contenttypes.courses.interfaces import ES_CREDIT
 from nti.contenttypes.courses.interfaces import COURSE_OUTLINE_NAME
 from nti.contenttypes.courses.interfaces import SECTIONS as SECTION_FOLDER_NAME
@@ -600,7 +602,11 @@ def synchronize_catalog_from_root(catalog_folder, root, **kwargs):
     """
     Given a :class:`CourseCatalogFolder` and a class:`.IDelimitedHierarchyBucket`,
     synchronize the course catalog to match.
+
+    The courses catalog index updates are deferred until the sync is done.
     """
     synchronizer = component.getMultiAdapter((catalog_folder, root),
                                              IObjectEntrySynchronizer)
-    synchronizer.synchronize(catalog_folder, root, **kwargs)
+    # sync walks the folders, it does not look courses up in the catalog
+    with deferred_index_updates():
+        synchronizer.synchronize(catalog_folder, root, **kwargs)
@@ -10,6 +10,10 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import threading
+
+from collections import OrderedDict
+
 from datetime import datetime
 from functools import total_ordering
 
@@ -30,9 +34,12 @@ from nti.contentlibrary.presentationresource import DisplayableContentMixin
 
 from nti.contenttypes.courses.index import IX_SITE
 from nti.contenttypes.courses.index import IX_ENTRY
+from nti.contenttypes.courses.index import IX_TOPICS
+from nti.contenttypes.courses.index import TP_DELETED_COURSES
 
 from nti.contenttypes.courses.index import get_courses_catalog
 
+from nti.contenttypes.courses.interfaces import IDeletedCourse
 from nti.contenttypes.courses.interfaces import ICatalogFamily
 from nti.contenttypes.courses.interfaces import ICourseCatalog
 from nti.contenttypes.courses.interfaces import ICourseInstance
@@ -114,6 +121,11 @@ class _AbstractCourseCatalogMixin(object):
     def isEmpty(self):
         raise NotImplementedError()
 
+    def count_entries(self, include_parents=False):
+        if include_parents:
+            return sum(1 for _ in self.iterCatalogEntries())
+        return sum(1 for _ in self._iter_entries())
+
     def _iter_entries(self):
         """
         Iterate over course catalog entries.
@@ -243,6 +255,11 @@ class GlobalCourseCatalog(_AbstractCourseCatalogMixin,
         # we can be more efficient than the parent
         return len(self) == 0
 
+    def count_entries(self, include_parents=False):
+        if include_parents:
+            return super(GlobalCourseCatalog, self).count_entries(True)
+        return len(self)
+
     def clear(self):
         for i in list(self.iterCatalogEntries()):
             self.removeCatalogEntry(i, event=False)
@@ -423,6 +440,100 @@ class CourseCatalogEntry(CatalogFamily,
     seat_limit = property(_get_seat_limit, _set_seat_limit, _del_seat_limit)
     
 
+class _LookupCache(object):
+    """
+    A small, thread-safe, least recently used cache.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+#: (site name, entry ntiid) -> (courses catalog stamp, catalog level,
+#: course intid). The stamp is the serial of the last committed change to
+#: the courses catalog, so entries become stale as soon as a course is added,
+#: removed or reindexed. Misses are not cached.
+_entry_lookup_cache = _LookupCache()
+
+
+def clear_entry_lookup_cache():
+    _entry_lookup_cache.clear()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(clear_entry_lookup_cache)
+    del addCleanUp
+
+
+class MergedCatalogEntries(object):
+    """
+    The entries of a catalog and its parents, de-duplicated by ntiid,
+    held as the intids of their courses so that they can be counted
+    without activating any entry. Entries from a parent catalog that
+    is not backed by the courses catalog (the global catalog) are
+    read from it as needed.
+    """
+
+    def __init__(self, course_intids, ntiids=(), tail=None, deleted=0):
+        self.tail = tail
+        self.ntiids = ntiids
+        self.deleted = deleted
+        self.course_intids = course_intids
+
+    def _iter_tail(self):
+        if self.tail is not None:
+            for entry in self.tail.iterCatalogEntries():
+                if entry.ntiid not in self.ntiids:
+                    yield entry
+
+    def __len__(self):
+        return len(self.course_intids) + sum(1 for _ in self._iter_tail())
+
+    def count_not_deleted(self):
+        """
+        Return the number of these entries whose course is not deleted.
+        """
+        return len(self.course_intids) - self.deleted \
+             + sum(1 for x in self._iter_tail()
+                   if not IDeletedCourse.providedBy(ICourseInstance(x, None)))
+
+    def __iter__(self):
+        intids = component.getUtility(IIntIds)
+        for course_intid in self.course_intids:
+            course = intids.queryObject(course_intid)
+            entry = ICourseCatalogEntry(course, None)
+            if entry is not None:
+                yield entry
+        for entry in self._iter_tail():
+            yield entry
+
+
 @interface.implementer(IPersistentCourseCatalog)
 class CourseCatalogFolder(_AbstractCourseCatalogMixin,
                           CheckingLastModifiedBTreeFolder):
@@ -441,8 +552,47 @@ class CourseCatalogFolder(_AbstractCourseCatalogMixin,
             application level).
     """
 
+    def _iter_entry_course_intids(self, catalog, include_deleted=False):
+        """
+        Iterate over the (course intid, entry ntiid) pairs of the courses
+        of this catalog (that are not deleted, unless asked), reading only
+        the indexes. The site index also holds the catalog entries, which
+        have no entry ntiid of their own.
+        """
+        current_site = getattr(self._catalog_site, '__name__', None)
+        if not current_site or catalog is None:
+            return
+        site_index = catalog[IX_SITE]
+        if not site_index.has_documents(current_site):
+            return
+        ntiid_index = catalog[IX_ENTRY].documents_to_values
+        deleted = () if include_deleted \
+                  else catalog[IX_TOPICS][TP_DELETED_COURSES].getExtent()
+        for course_intid in site_index.apply({'any_of': (current_site,)}):
+            ntiid = ntiid_index.get(course_intid)
+            if ntiid is not None and course_intid not in deleted:
+                yield course_intid, ntiid
+
     def isEmpty(self):
-        return not bool(self._course_intid_iter())
+        catalog = get_courses_catalog()
+        current_site = getattr(self._catalog_site, '__name__', None)
+        if not current_site or catalog is None:
+            return True
+        return not catalog[IX_SITE].has_documents(current_site)
+
+    def count_entries(self, include_parents=False):
+        if include_parents:
+            return self.merged_entries().count_not_deleted()
+        catalog = get_courses_catalog()
+        current_site = getattr(self._catalog_site, '__name__', None)
+        count = getattr(catalog[IX_SITE], 'count', None) \
+                if current_site and catalog is not None else None
+        result = count(current_site) if count is not None else None
+        if result is None:
+            # no counts kept yet
+            pairs = self._iter_entry_course_intids(catalog)
+            result = len({ntiid for unused_intid, ntiid in pairs})
+        return result
 
     @property
     def _catalog_site(self):
@@ -475,12 +625,107 @@ class CourseCatalogFolder(_AbstractCourseCatalogMixin,
             if entry is not None:
                 yield entry
 
-    def _primary_query_my_entry(self, name):
+    def _merge_entries(self, catalog):
+        ntiids = set()
+        course_intids = []
+        deleted_extent = catalog[IX_TOPICS][TP_DELETED_COURSES].getExtent()
+        deleted = 0
+        current = self
+        while current is not None:
+            if not isinstance(current, CourseCatalogFolder):
+                break
+            # pylint: disable=protected-access
+            # Like the baseline iteration, deleted courses are included
+            pairs = current._iter_entry_course_intids(catalog, True)
+            for course_intid, ntiid in pairs:
+                if ntiid not in ntiids:
+                    ntiids.add(ntiid)
+                    course_intids.append(course_intid)
+                    deleted += course_intid in deleted_extent
+            current = current._next_catalog
+        return MergedCatalogEntries(course_intids, ntiids, current, deleted)
+
+    def merged_entries(self):
+        """
+        Return the :class:`MergedCatalogEntries` of this catalog and its
+        parents. This is cached (per connection) until the courses catalog
+        changes.
+        """
         catalog = get_courses_catalog()
+        catalog_stamp = getattr(catalog, 'stamp', None)
+        stamp = catalog_stamp() if catalog_stamp is not None else None
+        cached = getattr(self, '_v_merged_entries', None)
+        if stamp is not None and cached is not None and cached[0] == stamp:
+            return cached[1]
+        result = self._merge_entries(catalog)
+        if stamp is not None:
+            # pylint: disable=attribute-defined-outside-init
+            self._v_merged_entries = (stamp, result)
+        return result
+
+    def iterCatalogEntries(self):
+        return iter(self.merged_entries())
+
+    def _query_my_entry_course_intid(self, name, catalog=None):
+        catalog = get_courses_catalog() if catalog is None else catalog
         query = {IX_ENTRY: {'any_of': (name,)}}
         current_site = getattr(self._catalog_site, '__name__', None)
         if current_site:
             query[IX_SITE] = {'any_of': (current_site,)}
         rs = catalog.apply(query)
-        if rs:
-            return self._get_entry_from_course_intid(rs[0])
+        return rs[0] if rs else None
+
+    def _primary_query_my_entry(self, name):
+        course_intid = self._query_my_entry_course_intid(name)
+        if course_intid is not None:
+            return self._get_entry_from_course_intid(course_intid)
+
+    def _resolve_entry_course_intid(self, name, catalog):
+        """
+        Find the course intid of the named entry in this catalog or its
+        parents.
+
+        :return: A tuple of the catalog level the entry was found at (0 for
+            this catalog), its course intid (None if not found) and the
+            first parent catalog, if any, that is not backed by the courses
+            catalog and still has to be asked.
+        """
+        level = 0
+        current = self
+        while current is not None:
+            if not isinstance(current, CourseCatalogFolder):
+                return level, None, current
+            # pylint: disable=protected-access
+            course_intid = current._query_my_entry_course_intid(name, catalog)
+            if course_intid is not None:
+                return level, course_intid, None
+            current = current._next_catalog
+            level += 1
+        return level, None, None
+
+    def getCatalogEntry(self, name):
+        catalog = get_courses_catalog()
+        catalog_stamp = getattr(catalog, 'stamp', None)
+        current_site = getattr(self._catalog_site, '__name__', None)
+        if catalog_stamp is None or not current_site:
+            return super(CourseCatalogFolder, self).getCatalogEntry(name)
+        stamp = catalog_stamp()
+        key = (current_site, name)
+        cached = _entry_lookup_cache.get(key) if stamp is not None else None
+        if cached is not None and cached[0] == stamp:
+            course_intid = cached[2]
+        else:
+            level, course_intid, tail = self._resolve_entry_course_intid(name, catalog)
+            if tail is not None:
+                # Not something we can cache
+                return tail.getCatalogEntry(name)
+            # Only hits of committed state are cached
+            if stamp is not None and course_intid is not None:
+                _entry_lookup_cache.set(key, (stamp, level, course_intid))
+        if course_intid is None:
+            raise KeyError(name)
+        entry = self._get_entry_from_course_intid(course_intid)
+        if entry is None:
+            # Stale index data, let the regular lookup deal with it
+            return super(CourseCatalogFolder, self).getCatalogEntry(name)
+        return entry
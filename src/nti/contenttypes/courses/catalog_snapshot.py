@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Snapshots of the externalized course catalog of each site.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import copy
+import json
+import time
+import uuid
+import hashlib
+import tempfile
+import threading
+
+from weakref import WeakKeyDictionary
+
+import transaction
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import getSite
+
+from zope.security.management import endInteraction
+from zope.security.management import queryInteraction
+from zope.security.management import restoreInteraction
+
+from nti.contenttypes.courses.interfaces import ICourseCatalog
+from nti.contenttypes.courses.interfaces import ICourseCatalogSnapshotService
+
+from nti.externalization.externalization import to_external_object
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class MemoryCatalogSnapshotStore(object):
+    """
+    Keeps snapshots in memory, for a single process. Callers get copies,
+    so they cannot change the stored snapshots.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+        self._generations = {}
+
+    def get(self, key):
+        with self._lock:
+            snapshot = self._data.get(key)
+        return copy.deepcopy(snapshot)
+
+    def set(self, key, snapshot):
+        snapshot = copy.deepcopy(snapshot)
+        with self._lock:
+            self._data[key] = snapshot
+
+    def generation(self, site_name):
+        with self._lock:
+            return self._generations.get(site_name)
+
+    def bump(self, site_name):
+        with self._lock:
+            self._generations[site_name] = (self._generations.get(site_name) or 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+
+
+class FileCatalogSnapshotStore(object):
+    """
+    Keeps snapshots as JSON files in a local directory, so that they
+    can be shared by all the worker processes of a host.
+    """
+
+    suffix = '.snapshot.json'
+    generation_suffix = '.generation'
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, suffix=None):
+        name = u'\0'.join(key).encode('utf-8')
+        return os.path.join(self.directory,
+                            hashlib.sha1(name).hexdigest() + (suffix or self.suffix))
+
+    def _write(self, target, data):
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            # atomic on posix, readers see the old or the new file
+            os.rename(path, target)
+        except (IOError, OSError):
+            logger.exception("Cannot write catalog snapshot to %s",
+                             self.directory)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as fp:
+                return json.loads(fp.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, snapshot):
+        try:
+            data = json.dumps(snapshot).encode('utf-8')
+        except (TypeError, ValueError):
+            logger.exception("Cannot serialize catalog snapshot")
+            return
+        self._write(self._path(key), data)
+
+    def generation(self, site_name):
+        try:
+            with open(self._path((site_name,), self.generation_suffix), 'rb') as fp:
+                return fp.read().decode('ascii') or None
+        except (IOError, OSError):
+            return None
+
+    def bump(self, site_name):
+        # a new token rather than an increment, so that concurrent bumps
+        # from several processes cannot read and write the same value
+        self._write(self._path((site_name,), self.generation_suffix),
+                    uuid.uuid4().hex.encode('ascii'))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith((self.suffix, self.generation_suffix)):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:  # pragma: no cover
+                    pass
+
+
+def default_externalizer(entry):
+    return to_external_object(entry)
+
+
+def _catalog_site_names(catalog):
+    """
+    The names of the sites whose entries the given catalog shows, the
+    current site first.
+    """
+    result = [getattr(getSite(), '__name__', None) or u'']
+    current = catalog
+    while current is not None:
+        site = getattr(current, '_catalog_site', None)
+        name = getattr(site, '__name__', None)
+        if name and name not in result:
+            result.append(name)
+        current = getattr(current, '_next_catalog', None)
+    return result
+
+
+@interface.implementer(ICourseCatalogSnapshotService)
+class CourseCatalogSnapshotService(object):
+    """
+    Keeps, for each site and variant, the anonymous externalization of
+    the entries of the catalog along with the ``lastModified`` they were
+    externalized at. The entries are always externalized without an
+    interaction, so a snapshot never holds what only a given user may see.
+
+    A snapshot is served as is, without reading the database, while none
+    of the sites whose entries it shows was invalidated (a course added,
+    removed or synced, or an entry modified). After that, the entries are
+    walked again and only those whose ``lastModified`` changed are
+    re-externalized.
+    """
+
+    #: If not None, the number of seconds a snapshot is served without
+    #: checking the entries for modifications. Only needed if entries may
+    #: be modified without an invalidation reaching the store (e.g. a
+    #: memory store of a single one of several processes).
+    max_age = None
+
+    def __init__(self, store=None, max_age=None):
+        self.store = MemoryCatalogSnapshotStore() if store is None else store
+        if max_age is not None:
+            self.max_age = max_age
+
+    @staticmethod
+    def _entries(snapshot):
+        entries = snapshot['entries']
+        return [entries[ntiid][1] for ntiid in snapshot['ntiids']]
+
+    def _build(self, catalog, previous, externalizer, predicate):
+        ntiids = []
+        entries = {}
+        rebuilt = 0
+        previous = previous['entries'] if previous else {}
+        for entry in catalog.iterCatalogEntries():
+            if predicate is not None and not predicate(entry):
+                continue
+            ntiid = entry.ntiid
+            last_modified = getattr(entry, 'lastModified', None) or 0
+            old = previous.get(ntiid)
+            if old is not None and old[0] == last_modified:
+                ext = old[1]
+            else:
+                ext = externalizer(entry)
+                rebuilt += 1
+            ntiids.append(ntiid)
+            entries[ntiid] = [last_modified, ext]
+        logger.debug("Catalog snapshot with %s entries (%s externalized)",
+                     len(ntiids), rebuilt)
+        return {'ntiids': ntiids, 'entries': entries}
+
+    def _is_fresh(self, snapshot, stamp, now):
+        if snapshot is None or snapshot['stamp'] != stamp:
+            return False
+        return self.max_age is None or now - snapshot['built'] < self.max_age
+
+    def _build_anonymously(self, catalog, previous, externalizer, predicate):
+        if queryInteraction() is None:
+            return self._build(catalog, previous, externalizer, predicate)
+        endInteraction()
+        try:
+            return self._build(catalog, previous, externalizer, predicate)
+        finally:
+            restoreInteraction()
+
+    def snapshot(self, catalog=None, variant=u'', externalizer=None,
+                 predicate=None):
+        if catalog is None:
+            catalog = component.getUtility(ICourseCatalog)
+        externalizer = externalizer or default_externalizer
+        site_names = _catalog_site_names(catalog)
+        key = (site_names[0], variant)
+        # only the store is read, the invalidations change the stamp
+        stamp = [self.store.generation(x) for x in site_names]
+        now = time.time()
+        snapshot = self.store.get(key)
+        if self._is_fresh(snapshot, stamp, now):
+            return self._entries(snapshot)
+        result = self._build_anonymously(catalog, snapshot, externalizer,
+                                         predicate)
+        result['stamp'] = stamp
+        result['built'] = now
+        self.store.set(key, result)
+        return self._entries(result)
+
+    def invalidate(self, site_name=None):
+        if site_name is None:
+            self.store.clear()
+        else:
+            self.store.bump(site_name)
+
+
+class _PendingInvalidations(object):
+
+    def __init__(self):
+        self.pending = set()
+
+    def add(self, service, site_name):
+        self.pending.add((service, site_name))
+
+    def __call__(self, success):
+        if not success:
+            return
+        for service, site_name in self.pending:
+            try:
+                service.invalidate(site_name)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Cannot invalidate catalog snapshots of %s",
+                                 site_name)
+
+
+#: transaction -> _PendingInvalidations
+_pending_invalidations = WeakKeyDictionary()
+_pending_lock = threading.Lock()
+
+
+def invalidate_after_commit(service, site_name, txn=None):
+    """
+    Invalidate the snapshots of the given site (all of them if None)
+    once the given (or current) transaction has committed, so that the
+    store is not touched while the transaction may still abort.
+    """
+    txn = transaction.get() if txn is None else txn
+    with _pending_lock:
+        pending = _pending_invalidations.get(txn)
+        if pending is None:
+            pending = _pending_invalidations[txn] = _PendingInvalidations()
+            txn.addAfterCommitHook(pending)
+    pending.add(service, site_name)
+
+
+def get_catalog_snapshot_service():
+    return component.queryUtility(ICourseCatalogSnapshotService)
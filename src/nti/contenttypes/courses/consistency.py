@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Verify that the course catalogs agree with the objects in the database,
+and reindex the documents that do not.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+from multiprocessing import Pool
+
+from six import string_types
+
+from zope import component
+
+from zope.component.hooks import site as current_site
+
+from zope.intid.interfaces import IIntIds
+
+from nti.contenttypes.courses.index import IX_SITE
+from nti.contenttypes.courses.index import COURSES_CATALOG_NAME
+from nti.contenttypes.courses.index import ENROLLMENT_CATALOG_NAME
+from nti.contenttypes.courses.index import COURSE_OUTLINE_CATALOG_NAME
+
+from nti.contenttypes.courses.index import InterningIndexMixin
+
+from nti.contenttypes.courses.index import get_courses_catalog
+from nti.contenttypes.courses.index import get_index_doc_ids
+from nti.contenttypes.courses.index import get_enrollment_catalog
+from nti.contenttypes.courses.index import create_courses_catalog
+from nti.contenttypes.courses.index import create_enrollment_catalog
+from nti.contenttypes.courses.index import get_course_outline_catalog
+from nti.contenttypes.courses.index import create_course_outline_catalog
+
+from nti.contenttypes.courses.interfaces import ICourseCatalog
+from nti.contenttypes.courses.interfaces import ICourseInstance
+from nti.contenttypes.courses.interfaces import ICourseEnrollments
+from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
+from nti.contenttypes.courses.interfaces import IGlobalCourseCatalog
+from nti.contenttypes.courses.interfaces import ICourseAdministrativeLevel
+
+from nti.contenttypes.courses.utils import index_course_editors
+from nti.contenttypes.courses.utils import get_course_subinstances
+from nti.contenttypes.courses.utils import index_course_instructors
+
+from nti.site.hostpolicy import get_host_site
+from nti.site.hostpolicy import get_all_host_sites
+
+from nti.site.interfaces import IHostPolicyFolder
+
+from nti.traversal.traversal import find_interface
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Returned for the documents an index cannot tell apart
+_UNKNOWN = object()
+
+
+def _iter_folder_courses(folder):
+    for value in folder.values():
+        if ICourseAdministrativeLevel.providedBy(value):
+            for course in _iter_folder_courses(value):
+                yield course
+        elif ICourseInstance.providedBy(value):
+            yield value
+            for section in get_course_subinstances(value):
+                yield section
+
+
+def iter_site_courses(site):
+    """
+    Iterate the courses (and sections) stored in the catalog of the given
+    host site, walking the catalog folder rather than any index.
+    """
+    with current_site(site):
+        catalog = component.queryUtility(ICourseCatalog)
+        if      catalog is None \
+            or IGlobalCourseCatalog.providedBy(catalog) \
+            or find_interface(catalog, IHostPolicyFolder, strict=False) is not site:
+            return
+        for course in _iter_folder_courses(catalog):
+            yield course
+
+
+def _course_docs(course):
+    yield course, course
+    entry = ICourseCatalogEntry(course, None)
+    if entry is not None:
+        yield entry, entry
+
+
+class _RecordingCatalog(object):
+    """
+    Collects what the course role indexing functions would index.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def index_doc(self, unused_doc_id, record):
+        self.records.append(record)
+
+
+def _course_role_records(course):
+    entry = ICourseCatalogEntry(course, None)
+    if entry is None:
+        return ()
+    recorder = _RecordingCatalog()
+    index_course_editors(course, recorder, entry, None)
+    index_course_instructors(course, recorder, entry, None)
+    return recorder.records
+
+
+def _enrollment_docs(course):
+    enrollments = ICourseEnrollments(course, None)
+    for record in enrollments.iter_enrollments() if enrollments is not None else ():
+        yield record, record
+    # the course roles are indexed under the course's id
+    for record in _course_role_records(course):
+        yield course, record
+
+
+def _outline_docs(course):
+    def recur(node):
+        for child in node.values():
+            yield child
+            for descendant in recur(child):
+                yield descendant
+    outline = getattr(course, 'Outline', None)
+    if outline is not None:
+        for node in recur(outline):
+            yield node, node
+
+
+#: catalog name -> (catalog getter, scratch catalog factory, course docs)
+#: where course docs yields the (object, indexed value) pairs of a course
+CHECKED_CATALOGS = {
+    COURSES_CATALOG_NAME: (get_courses_catalog,
+                           create_courses_catalog,
+                           _course_docs),
+    ENROLLMENT_CATALOG_NAME: (get_enrollment_catalog,
+                              create_enrollment_catalog,
+                              _enrollment_docs),
+    COURSE_OUTLINE_CATALOG_NAME: (get_course_outline_catalog,
+                                  create_course_outline_catalog,
+                                  _outline_docs),
+}
+
+
+def _normalize(value):
+    if value is None or isinstance(value, string_types):
+        return value
+    try:
+        items = tuple(value)
+    except TypeError:
+        return value
+    try:
+        return tuple(sorted(items))
+    except TypeError:  # pragma: no cover
+        return items
+
+
+def _index_mapping(index):
+    index = getattr(index, 'index', index)  # normalization wrappers
+    for name in ('documents_to_values', '_rev_index', '_docs', '_rev'):
+        mapping = getattr(index, name, None)
+        if mapping is not None:
+            return mapping
+    return None
+
+
+def get_index_value(index, doc_id):
+    """
+    Return a comparable form of what the index holds for the given
+    document, or a marker if the index cannot tell.
+    """
+    if isinstance(index, InterningIndexMixin):
+        # ids differ between catalogs
+        return _normalize(index.values(doc_id))
+    mapping = _index_mapping(index)
+    if mapping is not None:
+        return _normalize(mapping.get(doc_id))
+    filters = getattr(index, '_filters', None)
+    if filters is not None:  # topic indexes
+        return tuple(sorted(name for name, the_filter in filters.items()
+                            if doc_id in the_filter.getIds()))
+    has_doc = getattr(index, 'has_doc', None)
+    if has_doc is not None:  # text indexes
+        return bool(has_doc(doc_id))
+    return _UNKNOWN
+
+
+def _indexed_doc_ids(catalog, sites):
+    """
+    Return the doc ids indexed for the given sites (all if None), or
+    None if the catalog cannot answer that.
+    """
+    if sites is not None:
+        if IX_SITE not in catalog:
+            return None
+        return set(get_index_doc_ids(catalog[IX_SITE], sites))
+    result = set()
+    for index in catalog.values():
+        mapping = _index_mapping(index)
+        if mapping is not None:
+            result.update(mapping.keys())
+    return result
+
+
+class CatalogCheckReport(object):
+    """
+    The drift found in a catalog: the doc ids of the walked objects that
+    are not indexed or indexed differently (with the names of the
+    differing indexes), and of the indexed documents that were not found
+    by the walk. Documents indexed with values other than their object
+    (e.g. course role records) have those values in :attr:`records`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.checked = 0
+        self.missing = set()
+        self.changed = {}
+        self.stale = set()
+        self.records = {}
+
+    @property
+    def drift(self):
+        return len(self.missing) + len(self.changed) + len(self.stale)
+
+    def __repr__(self):
+        return '<%s %s checked=%s missing=%s changed=%s stale=%s>' % (
+            self.__class__.__name__, self.name, self.checked,
+            len(self.missing), len(self.changed), len(self.stale))
+
+
+def check_catalog(name, sites=None, intids=None, check_stale=True):
+    """
+    Compare the named catalog with a walk of the courses of the given host
+    sites (all if None).
+
+    :return: A :class:`CatalogCheckReport`.
+    """
+    getter, factory, course_docs = CHECKED_CATALOGS[name]
+    catalog = getter()
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    scratch = factory(family=intids.family)
+    report = CatalogCheckReport(name)
+    all_sites = sites is None
+    if all_sites:
+        sites = get_all_host_sites()
+    else:
+        sites = [get_host_site(x) if isinstance(x, string_types) else x
+                 for x in sites]
+    walked = {}
+    for site in sites:
+        with current_site(site):
+            for course in iter_site_courses(site):
+                for obj, value in course_docs(course):
+                    doc_id = intids.queryId(obj)
+                    if doc_id is None:
+                        continue
+                    unused_obj, values = walked.setdefault(doc_id, (obj, []))
+                    if value is obj and values:
+                        continue
+                    values.append(value)
+                    scratch.index_doc(doc_id, value)
+    for doc_id, (obj, values) in walked.items():
+        report.checked += 1
+        changed = []
+        indexed = False
+        for index_name, index in scratch.items():
+            live_index = catalog.get(index_name)
+            expected = get_index_value(index, doc_id)
+            actual = get_index_value(live_index, doc_id) \
+                     if live_index is not None else None
+            indexed = indexed or actual not in (None, False, (), _UNKNOWN)
+            if expected is not _UNKNOWN and expected != actual:
+                changed.append(index_name)
+        if not indexed and changed:
+            report.missing.add(doc_id)
+        elif changed:
+            report.changed[doc_id] = changed
+        if changed and values[0] is not obj:
+            report.records[doc_id] = values
+    if check_stale:
+        site_names = None if all_sites else [x.__name__ for x in sites]
+        indexed = _indexed_doc_ids(catalog, site_names)
+        if indexed is not None:
+            report.stale.update(indexed.difference(walked))
+    logger.info("Checked %s. %r", name, report)
+    return report
+
+
+def repair_catalog(report, intids=None, batch_size=None, commit=None):
+    """
+    Reindex the missing and changed documents of the given report and
+    unindex its stale ones.
+
+    If a ``batch_size`` is given, the ``commit`` callable, if any, is
+    invoked (typically to commit the transaction) after each chunk of
+    that many documents.
+
+    :return: The number of documents fixed.
+    """
+    getter = CHECKED_CATALOGS[report.name][0]
+    catalog = getter()
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    work = [(x, True) for x in sorted(report.missing)]
+    work.extend((x, True) for x in sorted(report.changed))
+    work.extend((x, False) for x in sorted(report.stale))
+    total = len(work)
+    batch_size = batch_size or total or 1
+    start = time.time()
+    result = 0
+    for idx in range(0, total, batch_size):
+        for doc_id, reindex in work[idx:idx + batch_size]:
+            records = report.records.get(doc_id) if reindex else None
+            obj = intids.queryObject(doc_id) if reindex else None
+            if records:
+                # start over, the indexes keep the values of each record
+                catalog.unindex_doc(doc_id)
+                for record in records:
+                    catalog.index_doc(doc_id, record)
+            elif obj is not None:
+                catalog.index_doc(doc_id, obj)
+            else:
+                catalog.unindex_doc(doc_id)
+            result += 1
+        if commit is not None:
+            commit()
+        elapsed = time.time() - start
+        logger.info("Repaired %s/%s documents of %s (%.1f docs/s)",
+                    result, total, report.name,
+                    result / elapsed if elapsed else result)
+    return result
+
+
+def check_and_repair_site(site_name, names=None, repair=True,
+                          batch_size=None, commit=None):
+    """
+    Check (and optionally repair) the given catalogs (all if None) for a
+    single host site.
+
+    :return: A dict of catalog name -> drift found.
+    """
+    result = {}
+    intids = component.getUtility(IIntIds)
+    for name in names or sorted(CHECKED_CATALOGS):
+        report = check_catalog(name, (site_name,), intids=intids)
+        result[name] = report.drift
+        if repair and report.drift:
+            repair_catalog(report, intids=intids,
+                           batch_size=batch_size, commit=commit)
+    return result
+
+
+def check_and_repair_sites(site_names, worker=None, processes=None):
+    """
+    Run the given worker (by default :func:`check_and_repair_site`, in
+    the current database connection and transaction) for each of the site
+    names, in a pool of that many processes if ``processes`` is greater
+    than one, and report progress. The worker must be a callable taking a
+    site name and returning a dict of catalog name -> drift.
+
+    A worker must be given when ``processes`` is greater than one; it must
+    be a picklable module-level callable that opens its own database
+    connection and transactions in the process it runs in.
+
+    :return: A dict of catalog name -> total drift found.
+    """
+    site_names = list(site_names)
+    pool = None
+    if processes and processes > 1:
+        if worker is None:
+            raise ValueError("Must specify a worker to run in other processes")
+        pool = Pool(processes)
+        results = pool.imap_unordered(worker, site_names)
+    else:
+        worker = check_and_repair_site if worker is None else worker
+        results = (worker(x) for x in site_names)
+    totals = {}
+    start = time.time()
+    try:
+        for count, drift in enumerate(results, 1):
+            for name, value in drift.items():
+                totals[name] = totals.get(name, 0) + value
+            elapsed = time.time() - start
+            logger.info("Checked %s/%s sites (%.2f sites/s)",
+                        count, len(site_names),
+                        count / elapsed if elapsed else count)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return totals
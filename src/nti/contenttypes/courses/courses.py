@@ -10,8 +10,14 @@ from __future__ import absolute_import
 
 from Acquisition import Explicit
 
+from BTrees.OOBTree import OOBTree
+
 from Persistence import Persistent
 
+from persistent import Persistent as PersistentObject
+
+from ZODB.POSException import ConflictError
+
 from zope import interface
 
 from zope import lifecycleevent
@@ -29,6 +35,7 @@ from nti.contenttypes.courses.interfaces import ES_PUBLIC
 from nti.contenttypes.courses.interfaces import ICourseSeatLimit
 
 from nti.contenttypes.courses.interfaces import ICourseInstance
+from nti.contenttypes.courses.interfaces import ICourseEnrollments
 from nti.contenttypes.courses.interfaces import ICourseSubInstances
 from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
 from nti.contenttypes.courses.interfaces import IContentCourseInstance
@@ -61,6 +68,41 @@ class CourseAdministrativeLevel(CaseInsensitiveCheckingLastModifiedBTreeFolder):
     mime_type = mimeType = 'application/vnd.nextthought.courses.coursedaministrativelevel'
 
 
+class CourseSeatCounter(PersistentObject):
+    """
+    A counter of the seats reserved in a course.
+
+    Like :class:`BTrees.Length.Length`, concurrent changes are resolved
+    by adding up their deltas, except that a merge that would
+    take the count over the limit in effect is refused, so only one of
+    the competing transactions can take the last seat.
+    """
+
+    def __init__(self, value=0, limit=None):
+        self.value = value
+        self.limit = limit
+
+    def __call__(self):
+        return self.value
+
+    def change(self, delta, limit=None):
+        self.limit = limit
+        self.value += delta
+
+    def set(self, value):
+        self.value = value
+
+    def _p_resolveConflict(self, old, committed, new):
+        old_value = old.get('value', 0)
+        new_value = new.get('value', 0)
+        result = dict(new)
+        result['value'] = committed.get('value', 0) + new_value - old_value
+        limit = new.get('limit')
+        if limit and new_value > old_value and result['value'] > limit:
+            raise ConflictError("Course seat limit reached")
+        return result
+
+
 @WithRepr
 @interface.implementer(ICourseSeatLimit)
 class CourseSeatLimit(Persistent,
@@ -73,7 +115,85 @@ class CourseSeatLimit(Persistent,
     __parent__ = None
     hard_limit = True
     used_seats = 0
-    
+
+    # Seat limits may be shared by sections, so we keep
+    # a counter for each course keyed by its (OID) ntiid
+    _seat_counters = None
+
+    def _seat_counter(self, course, create=True):
+        key = getattr(course, 'ntiid', None)
+        if key is None:
+            # Not yet persistent, nothing to count against
+            return None
+        counters = self._seat_counters
+        if counters is None:
+            if not create:
+                return None
+            counters = self._seat_counters = OOBTree()
+        counter = counters.get(key)
+        if counter is None and create:
+            # Initialize from the actual records
+            enrollments = ICourseEnrollments(course)
+            # pylint: disable=too-many-function-args
+            counter = counters[key] = CourseSeatCounter(enrollments.count_enrollments())
+        return counter
+
+    def reserve_seat(self, course):
+        """
+        Reserve a seat in the given course.
+
+        :return: False if the course has a hard limit and it is full.
+        """
+        counter = self._seat_counter(course)
+        if counter is None:
+            return True
+        limit = self.max_seats if self.hard_limit else None
+        if limit and counter() >= limit:
+            return False
+        counter.change(1, limit)
+        return True
+
+    def release_seat(self, course):
+        """
+        Release a seat in the given course.
+        """
+        counter = self._seat_counter(course, False)
+        if counter is not None and counter() > 0:
+            counter.change(-1, counter.limit)
+
+    def adjust_seats(self, course, delta):
+        """
+        Change the seats reserved in the given course by the given delta
+        without checking the limit, e.g. as records are moved between
+        courses. Courses without a counter are left alone.
+        """
+        counter = self._seat_counter(course, False)
+        if counter is not None:
+            counter.change(delta)
+            if counter() < 0:
+                counter.set(0)
+
+    def reserved_seats(self, course):
+        counter = self._seat_counter(course, False)
+        return counter() if counter is not None else None
+
+    def reconcile_seats(self, course):
+        """
+        Make the seat counter of the given course match its actual
+        number of enrollment records.
+
+        :return: A tuple of the previous and actual seat counts.
+        """
+        # pylint: disable=too-many-function-args
+        actual = ICourseEnrollments(course).count_enrollments()
+        counter = self._seat_counter(course)
+        if counter is None:
+            return None, actual
+        previous = counter()
+        if previous != actual:
+            counter.set(actual)
+        return previous, actual
+
 
 @interface.implementer(ICourseSubInstances)
 class CourseSubInstances(CaseInsensitiveCheckingLastModifiedBTreeContainer):
@@ -11,12 +11,18 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import sys
+import time
 import random
+import threading
 from collections import Mapping
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import total_ordering
 
 import BTrees
 
+from BTrees.Length import Length
+
 from persistent import Persistent
 
 import six
@@ -30,6 +36,8 @@ from zope import interface
 
 from zope.annotation.factory import factory as an_factory
 
+from zope.annotation.interfaces import IAnnotations
+
 from zope.cachedescriptors.method import cachedIn
 
 from zope.cachedescriptors.property import Lazy
@@ -41,6 +49,8 @@ from zope.event import notify
 
 from zope.interface import ro
 
+from zope.lifecycleevent.interfaces import IObjectMovedEvent
+
 from zope.keyreference.interfaces import NotYet
 from zope.keyreference.interfaces import IKeyReference
 
@@ -54,24 +64,42 @@ from nti.containers.containers import CaseInsensitiveCheckingLastModifiedBTreeCo
 
 from nti.contentlibrary.bundle import _readCurrent
 
+from nti.contenttypes.courses.index import IX_ENTRY
+from nti.contenttypes.courses.index import IX_ENROLLMENT_COUNT
+
+from nti.contenttypes.courses.index import get_doc_values
+from nti.contenttypes.courses.index import get_courses_catalog
+from nti.contenttypes.courses.index import get_enrollment_meta_catalog
+
+from nti.contenttypes.courses.indexing import TransactionBound
+from nti.contenttypes.courses.indexing import batch_index_updates
+
 from nti.contenttypes.courses.interfaces import ES_PUBLIC
 from nti.contenttypes.courses.interfaces import ES_CREDIT
 from nti.contenttypes.courses.interfaces import ENROLLMENT_SCOPE_VOCABULARY
 
 from nti.contenttypes.courses.interfaces import ICourseCatalog
 from nti.contenttypes.courses.interfaces import ICourseInstance
+from nti.contenttypes.courses.interfaces import ICourseSubInstance
 from nti.contenttypes.courses.interfaces import ICourseEnrollments
 from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
 from nti.contenttypes.courses.interfaces import IGlobalCourseCatalog
 from nti.contenttypes.courses.interfaces import IPrincipalEnrollments
 from nti.contenttypes.courses.interfaces import ICourseEnrollmentManager
 from nti.contenttypes.courses.interfaces import InstructorEnrolledException
+from nti.contenttypes.courses.interfaces import CourseSeatLimitReachedException
 from nti.contenttypes.courses.interfaces import ICourseInstanceEnrollmentRecord
 from nti.contenttypes.courses.interfaces import IDefaultCourseCatalogEnrollmentStorage
 from nti.contenttypes.courses.interfaces import IDefaultCourseInstanceEnrollmentStorage
 from nti.contenttypes.courses.interfaces import ICourseInstanceEnrollmentRecordContainer
 
+from nti.contenttypes.courses.utils import get_sites_4_index
+from nti.contenttypes.courses.utils import get_parent_course
+from nti.contenttypes.courses.utils import deny_access_to_course
+from nti.contenttypes.courses.utils import get_enrollments_query
+from nti.contenttypes.courses.utils import adjust_scope_membership
 from nti.contenttypes.courses.utils import is_instructor_in_hierarchy
+from nti.contenttypes.courses.utils import add_principals_to_course_content_roles
 
 from nti.dataserver.users.users import User
 
@@ -79,6 +107,8 @@ from nti.dublincore.time_mixins import PersistentCreatedAndModifiedTimeObject
 
 from nti.externalization.persistence import NoPickle
 
+from nti.metadata import queue_metadata_modififed
+
 from nti.externalization.representation import WithRepr
 
 from nti.property.property import alias
@@ -104,7 +134,132 @@ ICourseInstanceEnrollmentRecordContainer = ICourseInstanceEnrollmentRecordContai
 @component.adapter(ICourseInstance)
 @interface.implementer(IDefaultCourseInstanceEnrollmentStorage)
 class DefaultCourseInstanceEnrollmentStorage(CaseInsensitiveCheckingLastModifiedBTreeContainer):
-    pass
+    """
+    In addition to the records, we keep a map from scope name to a
+    (conflict-resolving) :class:`BTrees.Length.Length` holding the
+    number of records in that scope, so that counting the
+    enrollments in a scope does not require waking every record.
+
+    Records whose principal no longer exists are counted, but are
+    remembered as they are added (and when the counters are built) so
+    they can be excluded from :meth:`count_scope`.
+    """
+
+    #: The (lower case) keys of the records whose principal is missing
+    _orphans = ()
+
+    def __init__(self):
+        super(DefaultCourseInstanceEnrollmentStorage, self).__init__()
+        self._scope_counts = BTrees.OOBTree.OOBTree()
+
+    @Lazy
+    def _scope_counts(self):  # pylint: disable=method-hidden
+        # Storages created before we kept the counters. We migrate
+        # these at runtime by counting the records once; the
+        # generation takes care of the bulk of the existing data.
+        result = self._build_scope_counts()
+        # pylint: disable=attribute-defined-outside-init
+        self._p_changed = True
+        return result
+
+    def _build_scope_counts(self):
+        result = BTrees.OOBTree.OOBTree()
+        orphans = BTrees.OOBTree.OOTreeSet()
+        for key, record in self.items():
+            scope = record.Scope
+            if scope not in result:
+                result[scope] = Length()
+            result[scope].change(1)
+            if record.Principal is None:
+                orphans.add(key.lower())
+        if orphans or self._orphans:
+            # pylint: disable=attribute-defined-outside-init
+            self._orphans = orphans
+        return result
+
+    def _update_orphan(self, key, record=None):
+        """
+        Remember the key of the given record if its principal is
+        missing, or forget it if there is no such record.
+        """
+        if key is None:
+            return
+        key = key.lower()
+        if record is not None and record.Principal is None:
+            if not self._orphans:
+                # pylint: disable=attribute-defined-outside-init
+                self._orphans = BTrees.OOBTree.OOTreeSet()
+            self._orphans.add(key)
+        elif self._orphans:
+            # pylint: disable=no-member
+            self._orphans.discard(key)
+
+    def _change_scope_count(self, scope, delta):
+        if scope is None:
+            return
+        # pylint: disable=unsupported-membership-test,unsubscriptable-object
+        counts = self._scope_counts
+        if scope not in counts:
+            counts[scope] = Length()
+        counts[scope].change(delta)
+
+    def _scope_changed(self, old_scope, new_scope):
+        """
+        Called by our records when their scope changes.
+        """
+        self._change_scope_count(old_scope, -1)
+        self._change_scope_count(new_scope, 1)
+
+    def _setitemf(self, key, value):
+        # Build the counters of old storages before the record is
+        # added, so it is not counted twice
+        self._scope_counts  # pylint: disable=pointless-statement
+        super(DefaultCourseInstanceEnrollmentStorage, self)._setitemf(key, value)
+        self._change_scope_count(getattr(value, 'Scope', None), 1)
+        self._update_orphan(key, value)
+
+    def __delitem__(self, key):
+        record = self[key]
+        self._scope_counts  # pylint: disable=pointless-statement
+        super(DefaultCourseInstanceEnrollmentStorage, self).__delitem__(key)
+        self._change_scope_count(getattr(record, 'Scope', None), -1)
+        self._update_orphan(key)
+
+    def count_scope(self, scope):
+        """
+        Return the number of records in the given scope whose principal
+        exists.
+        """
+        # pylint: disable=no-member
+        length = self._scope_counts.get(scope)
+        result = length() if length is not None else 0
+        for key in self._orphans:
+            record = self.get(key)
+            if record is not None and record.Scope == scope:
+                result -= 1
+        return result
+
+    def rebuild_scope_counts(self):
+        """
+        Recount the records of this storage by scope, replacing the
+        stored counters if they have drifted.
+
+        :return: A dictionary of scope name to (stored, actual) counts
+                for those scopes whose counters were incorrect.
+        """
+        # pylint: disable=no-member
+        result = {}
+        actual = self._build_scope_counts()
+        stored = self._scope_counts
+        for scope in set(actual.keys()).union(stored.keys()):
+            stored_count = stored[scope]() if scope in stored else 0
+            actual_count = actual[scope]() if scope in actual else 0
+            if stored_count != actual_count:
+                result[scope] = (stored_count, actual_count)
+        if result:
+            # pylint: disable=attribute-defined-outside-init
+            self._scope_counts = actual
+        return result
 
 
 _DefaultCourseInstanceEnrollmentStorageFactory = an_factory(DefaultCourseInstanceEnrollmentStorage,
@@ -252,6 +407,152 @@ def _global_course_catalog_storage(site_manager):
 from nti.contenttypes.courses.interfaces import CourseInstanceEnrollmentRecordCreatedEvent
 
 
+class DeferredEnrollmentEffects(object):
+    """
+    Collects the side effects of enrolling and dropping (scope
+    membership and content roles) while a bulk
+    enrollment operation is in progress, so that they can be applied
+    once per principal and course when it finishes.
+
+    The operations are netted per principal and course in the order
+    they happened: only the last one for each scope counts, and if the
+    last operation on the course is a drop, the access granted before
+    it is never applied.
+    """
+
+    def __init__(self):
+        # (principal id, course id) -> (principal, course, scope -> granted)
+        self._ops = OrderedDict()
+
+    def _add(self, record, course, granted):
+        course = course or record.CourseInstance
+        principal = record.Principal
+        key = (getattr(principal, 'id', None) or id(principal), id(course))
+        if key not in self._ops:
+            self._ops[key] = (principal, course, OrderedDict())
+        scopes = self._ops[key][2]
+        scopes.pop(record.Scope, None)
+        scopes[record.Scope] = granted
+
+    def grant(self, record, course=None):
+        self._add(record, course, True)
+
+    def deny(self, record, course=None):
+        self._add(record, course, False)
+
+    def _netted(self):
+        grants = OrderedDict()
+        denials = []
+        for principal, course, scopes in self._ops.values():
+            dropped = not list(scopes.values())[-1]
+            for scope, granted in scopes.items():
+                if not granted:
+                    denials.append((principal, course, scope))
+                elif not dropped:
+                    if id(course) not in grants:
+                        grants[id(course)] = (course, [])
+                    grants[id(course)][1].append((principal, scope))
+        return denials, list(grants.values())
+
+    def apply(self):
+        denials, grants = self._netted()
+        self._ops.clear()
+        # denials first, so they do not undo the access granted last
+        for principal, course, scope in denials:
+            deny_access_to_course(principal, course, scope)
+        for course, items in grants:
+            for principal, scope in items:
+                adjust_scope_membership(principal, scope, course,
+                                        'record_dynamic_membership',
+                                        'follow')
+            # content roles are computed once for the course
+            add_principals_to_course_content_roles([x[0] for x in items],
+                                                   course)
+
+
+_deferred_effects = threading.local()
+
+
+def get_deferred_enrollment_effects():
+    """
+    Return the :class:`DeferredEnrollmentEffects` of the bulk enrollment
+    operation in progress in this thread, if any.
+    """
+    return getattr(_deferred_effects, 'effects', None)
+
+
+@contextmanager
+def deferred_enrollment_effects():
+    """
+    A context manager that defers the side effects of the enrollments
+    and drops made inside it, and their enrollment catalog index updates,
+    until it exits. They are applied even if it exits with an error, so
+    that the records already created are complete. Nested uses share the
+    outermost collector.
+    """
+    effects = get_deferred_enrollment_effects()
+    if effects is not None:
+        yield effects
+        return
+    effects = _deferred_effects.effects = DeferredEnrollmentEffects()
+    try:
+        with batch_index_updates():
+            yield effects
+    finally:
+        _deferred_effects.effects = None
+        effects.apply()
+
+
+class EnrollmentCountDeltas(object):
+    """
+    Collects the net change in the number of enrollments of each course
+    in a transaction, and applies it in place to the enrollment count
+    index when the transaction commits, once per course rather than once
+    per enrollment record.
+    """
+
+    def __init__(self):
+        self.changes = 0
+        self._deltas = OrderedDict()
+
+    def add(self, course, delta):
+        self.changes += 1
+        key = id(course)
+        if key in self._deltas:
+            self._deltas[key][1] += delta
+        else:
+            self._deltas[key] = [course, delta]
+
+    def apply(self):
+        deltas = list(self._deltas.values())
+        self._deltas.clear()
+        catalog = get_enrollment_meta_catalog()
+        index = catalog.get(IX_ENROLLMENT_COUNT) if catalog is not None else None
+        intids = component.queryUtility(IIntIds)
+        for course, delta in deltas:
+            if not delta:
+                continue
+            doc_id = intids.queryId(course) if intids is not None else None
+            if     index is None or doc_id is None \
+                or not index.change_enrollment_count(doc_id, delta):
+                # not indexed yet (or drifted), count them all
+                queue_metadata_modififed(course)
+        logger.debug("Applied %s enrollment count changes to %s courses",
+                     self.changes, len(deltas))
+        self.changes = 0
+
+
+#: transaction -> EnrollmentCountDeltas
+_enrollment_count_deltas = TransactionBound(EnrollmentCountDeltas, 'apply')
+
+
+def get_enrollment_count_deltas():
+    """
+    Return the :class:`EnrollmentCountDeltas` of the current transaction.
+    """
+    return _enrollment_count_deltas.get()
+
+
 @component.adapter(ICourseInstance)
 @interface.implementer(ICourseEnrollmentManager)
 class DefaultCourseEnrollmentManager(object):
@@ -344,6 +645,13 @@ class DefaultCourseEnrollmentManager(object):
                            principal_id, entry_ntiid)
             raise InstructorEnrolledException()
 
+        seat_limit = self._seat_limit
+        if seat_limit is not None and not seat_limit.reserve_seat(self.context):
+            entry_ntiid = ICourseCatalogEntry(self.context).ntiid
+            logger.warning('Course seat limit reached (%s) (%s)',
+                           principal_id, entry_ntiid)
+            raise CourseSeatLimitReachedException()
+
         record = self._new_enrollment_record(principal, scope)
         notify(CourseInstanceEnrollmentRecordCreatedEvent(record, context))
 
@@ -355,6 +663,23 @@ class DefaultCourseEnrollmentManager(object):
         self._inst_enrollment_storage[principal_id] = record
         return record
 
+    @Lazy
+    def _seat_limit(self):
+        """
+        The seat limit of our course, if it is one we can reserve
+        seats with.
+        """
+        entry = ICourseCatalogEntry(self.context, None)
+        seat_limit = getattr(entry, 'seat_limit', None)
+        if getattr(seat_limit, 'reserve_seat', None) is None:
+            return None
+        return seat_limit
+
+    def _release_seat(self):
+        seat_limit = self._seat_limit
+        if seat_limit is not None:
+            seat_limit.release_seat(self.context)
+
     def _drop_record_for_principal_id(self, record, principal_id):
         # pylint: disable=no-member
         enrollments = self._cat_enrollment_storage.get(principal_id, ())
@@ -389,8 +714,50 @@ class DefaultCourseEnrollmentManager(object):
         # enrollment list then fire the event
         self._drop_record_for_principal_id(record, principal_id)
         del self._inst_enrollment_storage[principal_id]
+        self._release_seat()
         return record
 
+    def enroll_many(self, principals, scope=ES_PUBLIC, context=None):
+        """
+        Enroll all the given principals in the given scope.
+
+        This is intended for large roster loads. Records are created
+        in a single pass, while the scope membership, content roles
+        and enrollment catalog entries of the principals are applied
+        when all of them are enrolled, and the enrollment count of the
+        course is updated only once. Principals already enrolled and
+        instructors are skipped; if the seat limit of the course is
+        reached, :class:`.CourseSeatLimitReachedException` is raised
+        after the records created so far are completed.
+
+        :return: A list of the new enrollment records.
+        """
+        result = []
+        with deferred_enrollment_effects():
+            for principal in principals:
+                try:
+                    record = self.enroll(principal, scope=scope, context=context)
+                except InstructorEnrolledException:
+                    continue
+                if record:
+                    result.append(record)
+        return result
+
+    def drop_many(self, principals):
+        """
+        Drop all the given principals from this course, deferring the side
+        effects as :meth:`enroll_many` does.
+
+        :return: A list of the dropped enrollment records.
+        """
+        result = []
+        with deferred_enrollment_effects():
+            for principal in principals:
+                record = self.drop(principal)
+                if record:
+                    result.append(record)
+        return result
+
     def drop_all(self):
         # pylint: disable=unsubscriptable-object,unsupported-delete-operation
         storage = self._inst_enrollment_storage_rc
@@ -402,6 +769,7 @@ class DefaultCourseEnrollmentManager(object):
             records.append(record)
             self._drop_record_for_principal_id(record, pid)
             del storage[pid]
+            self._release_seat()
         return records
     reset = drop_all
 
@@ -503,36 +871,199 @@ def _get_enrollment_map(context):
     return result
 
 
+def _get_section_capacities(context):
+    return {
+        scope: dict(section_data)
+        for scope, section_data in _get_enrollment_map(context).items()
+    }
+
+
+class SectionSeatTable(Persistent):
+    """
+    The seats taken in the sections of an enrollment-mapped course.
+
+    For each section we keep a (conflict-resolving) count of its
+    enrollments, and for each mapped scope the (ordered) set of
+    sections that still have room, so that finding the section to
+    enroll in does not require counting every section. The table is
+    kept up to date as records are added to or removed from the
+    sections, and is rebuilt if the enrollment map changes.
+    """
+
+    __parent__ = None
+
+    def __init__(self):
+        self._enrollment_map = {}
+        self._counts = BTrees.OOBTree.OOBTree()
+        self._open = BTrees.OOBTree.OOBTree()
+
+    def _capacity(self, scope, section_name):
+        return self._enrollment_map.get(scope, {}).get(section_name)
+
+    def _update_open(self, section_name):
+        count = self.count(section_name)
+        # pylint: disable=no-member
+        for scope, section_data in self._enrollment_map.items():
+            capacity = section_data.get(section_name)
+            if capacity is None:
+                continue
+            open_sections = self._open[scope]
+            if count < capacity:
+                open_sections.add(section_name)
+            elif section_name in open_sections:
+                open_sections.remove(section_name)
+
+    def count(self, section_name):
+        # pylint: disable=no-member
+        length = self._counts.get(section_name)
+        return length() if length is not None else 0
+
+    def section_changed(self, section_name, delta):
+        """
+        Called when the number of enrollments in a section changes.
+        """
+        # pylint: disable=no-member,unsupported-membership-test
+        if section_name not in self._counts:
+            return
+        self._counts[section_name].change(delta)
+        self._update_open(section_name)
+
+    def rebuild(self, course, enrollment_map=None):
+        """
+        Recount the enrollments of the mapped sections of the course.
+        """
+        if enrollment_map is None:
+            enrollment_map = _get_section_capacities(course)
+        self._enrollment_map = enrollment_map
+        self._counts = BTrees.OOBTree.OOBTree()
+        self._open = BTrees.OOBTree.OOBTree()
+        for scope, section_data in enrollment_map.items():
+            self._open[scope] = BTrees.OOBTree.OOTreeSet()
+            for section_name in section_data.keys():
+                # pylint: disable=unsupported-membership-test
+                if section_name in self._counts:
+                    continue
+                # fail loudly rather than silently enroll in the wrong place
+                section = course.SubInstances[section_name]
+                # pylint: disable=too-many-function-args
+                count = ICourseEnrollments(section).count_enrollments()
+                self._counts[section_name] = Length(count)
+        for section_name in self._counts.keys():
+            self._update_open(section_name)
+
+    def update(self, course):
+        """
+        Make sure the table reflects the current enrollment map of
+        the course.
+        """
+        enrollment_map = _get_section_capacities(course)
+        if enrollment_map != self._enrollment_map:
+            self.rebuild(course, enrollment_map)
+
+    def find_section(self, scope):
+        """
+        Return the name of the first (by name) section mapped to the scope
+        that still has room, or None.
+        """
+        # pylint: disable=no-member
+        open_sections = self._open.get(scope)
+        if open_sections:
+            return open_sections.minKey()
+        return None
+
+    def sections(self, scope):
+        return sorted(self._enrollment_map.get(scope, {}).keys())
+
+    def seats(self):
+        """
+        Return a dictionary of scope to a dictionary of section name
+        to a tuple of its current count and its capacity.
+        """
+        result = {}
+        for scope, section_data in self._enrollment_map.items():
+            result[scope] = {
+                name: (self.count(name), capacity)
+                for name, capacity in section_data.items()
+            }
+        return result
+
+
+SECTION_SEAT_TABLE_KEY = u'SectionSeatTable'
+
+_SectionSeatTableFactory = an_factory(SectionSeatTable,
+                                      SECTION_SEAT_TABLE_KEY)
+
+
+def get_section_seat_table(course, create=True):
+    """
+    Return the up-to-date :class:`SectionSeatTable` of the given
+    enrollment-mapped course.
+    """
+    if not create:
+        annotations = IAnnotations(course, None)
+        return annotations.get(SECTION_SEAT_TABLE_KEY) if annotations else None
+    # pylint: disable=too-many-function-args
+    table = _SectionSeatTableFactory(course)
+    table.update(course)
+    return table
+
+
 def _find_mapped_course_for_scope(course, scope):
     enrollment_map = _get_enrollment_map(course)
-    section_data = enrollment_map.get(scope)
-    if section_data:
-        items = []
-        for section_name in section_data.keys():
-            # fail loudly rather than silently enroll in the wrong place
-            section = course.SubInstances[section_name]
-            # pylint: disable=too-many-function-args
-            enrollment_count = ICourseEnrollments(section).count_enrollments()
-            items.append(SectionSeat(section_name, enrollment_count))
-        # sort by lowest section name, seat count
-        # fill one section at a time
-        items.sort()
-        section = None
-        for item in items:
-            section_name, estimated_seat_count = item.section_name, item.seat_count
-            max_seat_count = section_data[section_name]
-            if estimated_seat_count < max_seat_count:
-                return course.SubInstances[section_name]
-
-        # could not find a section simply pick at random
-        index = random.randint(0, len(items) - 1)
-        section_name = items[index].section_name
-        section = course.SubInstances[section_name]
-        logger.warning("Seat count exceed for section %s",
-                       section_name)
-        return section
-
-    return course
+    if not enrollment_map.get(scope):
+        return course
+
+    table = get_section_seat_table(course)
+    # fill one section at a time
+    section_name = table.find_section(scope)
+    if section_name is not None:
+        return course.SubInstances[section_name]
+
+    # could not find a section simply pick at random
+    sections = table.sections(scope)
+    section_name = sections[random.randint(0, len(sections) - 1)]
+    logger.warning("Seat count exceed for section %s",
+                   section_name)
+    return course.SubInstances[section_name]
+
+
+def _update_section_seat_table(storage, delta):
+    section = getattr(storage, '__parent__', None)
+    if not ICourseSubInstance.providedBy(section):
+        return
+    course = get_parent_course(section)
+    if not IEnrollmentMappedCourseInstance.providedBy(course):
+        return
+    table = get_section_seat_table(course, create=False)
+    if table is not None:
+        table.section_changed(section.__name__, delta)
+
+
+def _update_seat_counter(storage, delta):
+    course = ICourseInstance(getattr(storage, '__parent__', None), None)
+    entry = ICourseCatalogEntry(course, None)
+    seat_limit = getattr(entry, 'seat_limit', None)
+    if getattr(seat_limit, 'adjust_seats', None) is not None:
+        seat_limit.adjust_seats(course, delta)
+
+
+@component.adapter(ICourseInstanceEnrollmentRecord, IObjectMovedEvent)
+def on_enrollment_moved_update_section_seats(unused_record, event):
+    """
+    Keep the section seat table of enrollment-mapped courses up to
+    date as records are added, removed and moved between sections, and
+    the course seat counters as records are moved between courses
+    (the enrollment manager reserves and releases seats otherwise).
+    """
+    if event.oldParent is event.newParent:
+        return
+    if event.oldParent is not None:
+        _update_section_seat_table(event.oldParent, -1)
+    if event.newParent is not None:
+        _update_section_seat_table(event.newParent, 1)
+    if event.oldParent is not None and event.newParent is not None:
+        _update_seat_counter(event.oldParent, -1)
+        _update_seat_counter(event.newParent, 1)
 
 
 @component.adapter(IEnrollmentMappedCourseInstance)
@@ -643,11 +1174,7 @@ class DefaultCourseEnrollments(object):
                 len_scope -= 1
         return len_scope
 
-    # If we really wanted to, we could cache these persistently on the
-    # enrollment storage object.
-
-    @cachedIn('_v_count_scope_enrollments')
-    def count_scope_enrollments(self, scope):
+    def _scan_scope_enrollments(self, scope):
         # pylint: disable=no-member
         instructor_usernames = {x.id.lower() for x in self.context.instructors}
         # This might not be very performant
@@ -658,6 +1185,23 @@ class DefaultCourseEnrollments(object):
         return len([x for x in self._inst_enrollment_storage.values()
                     if include_record(x)])
 
+    def count_scope_enrollments(self, scope):
+        storage = self._inst_enrollment_storage
+        count_scope = getattr(storage, 'count_scope', None)
+        if count_scope is None:
+            # Not one of our storages; no counters to read
+            return self._scan_scope_enrollments(scope)
+        result = count_scope(scope)
+        # Instructors do not count. We expect only a handful of them,
+        # so look their records up rather than scanning the storage.
+        for instructor in self.context.instructors or ():
+            # pylint: disable=no-member
+            record = storage.get(instructor.id)
+            if      record is not None and record.Scope == scope \
+                and record.Principal is not None:  # orphans are not counted
+                result -= 1
+        return result
+
 
     @cachedIn('_v_count_credit_enrollments')
     def count_legacy_forcredit_enrollments(self):
@@ -681,11 +1225,76 @@ class DefaultPrincipalEnrollments(object):
     def _all_enrollments(self):
         return list(self._query_enrollments())
 
+    @CachedProperty
+    def _record_intids(self):
+        """
+        The intids of the principal's enrollment records in the current
+        site hierarchy, according to the enrollment catalog, or None if
+        the catalog is not available.
+        """
+        iprincipal = IPrincipal(self.principal, None)
+        catalog = get_enrollment_catalog()
+        if iprincipal is None or catalog is None:
+            return None
+        query = get_enrollments_query(catalog=catalog,
+                                      usernames=(iprincipal.id,),
+                                      site_names=get_sites_4_index())
+        return catalog.apply(query) or catalog.family.IF.Set()
+
+    @CachedProperty
+    def _live_record_intids(self):
+        """
+        The record intids whose course still exists. Records whose course
+        is in the courses catalog, according to the catalog entry ntiids
+        the enrollment catalog holds for them, are kept without waking
+        them. The others (e.g. courses of the global catalog) are checked
+        as the storage walk does. Records with no indexed ntiid are kept;
+        iterating checks their course.
+        """
+        doc_ids = self._record_intids
+        courses_catalog = get_courses_catalog()
+        if not doc_ids or courses_catalog is None:
+            return doc_ids
+        intids = component.getUtility(IIntIds)
+        entry_index = get_enrollment_catalog()[IX_ENTRY]
+        courses = courses_catalog[IX_ENTRY].values_to_documents
+        live = {}
+        result = []
+        for doc_id in doc_ids:
+            ntiids = get_doc_values(entry_index, doc_id)
+            for ntiid in ntiids:
+                if ntiid not in live:
+                    live[ntiid] = bool(courses.get(ntiid))
+            if not ntiids or any(live[x] for x in ntiids):
+                result.append(doc_id)
+            elif ICourseInstance(intids.queryObject(doc_id), None) is not None:
+                result.append(doc_id)
+        return result
+
     def iter_enrollments(self):
-        return iter(self._all_enrollments)
+        if self._record_intids is None:
+            return iter(self._all_enrollments)
+        return self._iter_indexed_enrollments()
 
     def count_enrollments(self):
-        return len(self._all_enrollments)
+        """
+        Return the number of records :meth:`iter_enrollments` yields, as
+        long as the catalogs agree with the database (see
+        :mod:`nti.contenttypes.courses.consistency`).
+        """
+        if self._record_intids is None:
+            return len(self._all_enrollments)
+        return len(self._live_record_intids)
+
+    def _iter_indexed_enrollments(self):
+        # Intids are unique, so we don't need to check for duplicates,
+        # and records are only woken up as they are iterated
+        intids = component.getUtility(IIntIds)
+        for doc_id in self._live_record_intids:
+            record = intids.queryObject(doc_id)
+            if      ICourseInstanceEnrollmentRecord.providedBy(record) \
+                and ICourseInstance(record, None) is not None:
+                yield record
 
     def _query_enrollments(self):
         iprincipal = IPrincipal(self.principal, None)
@@ -698,7 +1307,7 @@ class DefaultPrincipalEnrollments(object):
         catalogs = reversed(catalogs)
         seen_cats = []
         seen_storages = []
-        seen_records = []
+        seen_records = set()
 
         for catalog in catalogs:
             # Protect against accidentally hitting the same catalog
@@ -731,9 +1340,14 @@ class DefaultPrincipalEnrollments(object):
 
             if principal_id in storage:
                 for record in storage[principal_id]:
-                    if record in seen_records:
+                    # key references are hashable and cheap to compare
+                    try:
+                        ref = IKeyReference(record)
+                    except (NotYet, TypeError):
+                        ref = id(record)
+                    if ref in seen_records:
                         continue
-                    seen_records.append(record)
+                    seen_records.add(ref)
 
                     # If the course instance is gone, don't pretend to be enrolled
                     # because most things depend on getting the course from the
@@ -753,6 +1367,27 @@ class DefaultPrincipalEnrollments(object):
 from nti.dataserver.interfaces import IUser
 
 
+class EnrollmentScopeFieldProperty(FieldProperty):
+    """
+    A field property for the scope of a record that lets the
+    storage holding the record know when the scope changes, so
+    its per-scope counters stay accurate.
+    """
+
+    def __set__(self, inst, value):
+        # Accessing our parent activates us, so our state is loaded
+        storage = inst.__parent__
+        old_scope = inst.__dict__.get('Scope')
+        # Build the counters of old storages before the scope changes
+        getattr(storage, '_scope_counts', None)
+        super(EnrollmentScopeFieldProperty, self).__set__(inst, value)
+        if storage is not None and old_scope != value:
+            scope_changed = getattr(storage, '_scope_changed', None)
+            if scope_changed is not None:
+                # pylint: disable=not-callable
+                scope_changed(old_scope, value)
+
+
 @interface.implementer(ICourseInstanceEnrollmentRecord, IContentTypeAware)
 class DefaultCourseInstanceEnrollmentRecord(SchemaConfigured,
                                             PersistentCreatedAndModifiedTimeObject):
@@ -769,7 +1404,7 @@ class DefaultCourseInstanceEnrollmentRecord(SchemaConfigured,
     parameters = {}
     mime_type = mimeType = 'application/vnd.nextthought.courses.defaultcourseinstanceenrollmentrecord'
 
-    Scope = FieldProperty(ICourseInstanceEnrollmentRecord['Scope'])
+    Scope = EnrollmentScopeFieldProperty(ICourseInstanceEnrollmentRecord['Scope'])
 
     def __init__(self, **kwargs):
         PersistentCreatedAndModifiedTimeObject.__init__(self)
@@ -892,7 +1527,39 @@ def on_course_deletion_unenroll(course, event):
 from zope.copypastemove.interfaces import IObjectMover
 
 
-def migrate_enrollments_from_course_to_course(source, dest, verbose=False, result=None):
+def _migration_checkpoint_key(dest):
+    entry = ICourseCatalogEntry(dest, None)
+    return getattr(entry, 'ntiid', None) or getattr(dest, 'ntiid', None)
+
+
+def get_migration_checkpoint(source, dest):
+    """
+    Return the id of the last principal whose enrollment was processed
+    by an interrupted, chunked migration from ``source`` to ``dest``,
+    or None.
+    """
+    storage = IDefaultCourseInstanceEnrollmentStorage(source)
+    checkpoints = getattr(storage, '_migration_checkpoints', None)
+    if not checkpoints:
+        return None
+    return checkpoints.get(_migration_checkpoint_key(dest))
+
+
+def _set_migration_checkpoint(source_enrollments, dest, principal_id):
+    key = _migration_checkpoint_key(dest)
+    checkpoints = getattr(source_enrollments, '_migration_checkpoints', None)
+    if principal_id is None:
+        if checkpoints and key in checkpoints:
+            del checkpoints[key]
+        return
+    if checkpoints is None:
+        checkpoints = BTrees.OOBTree.OOBTree()
+        source_enrollments._migration_checkpoints = checkpoints
+    checkpoints[key] = principal_id
+
+
+def migrate_enrollments_from_course_to_course(source, dest, verbose=False, result=None,
+                                              batch_size=None, commit=None):
     """
     Move all the enrollments from the ``source`` course to the ``dest``
     course. Sharing will be updated, but no emails will be sent.
@@ -904,6 +1571,14 @@ def migrate_enrollments_from_course_to_course(source, dest, verbose=False, resul
     already moved and he re-enrolled in the source course, or he already
     independently enrolled in the destination course.
 
+    If a ``batch_size`` is given, the records are moved in chunks of
+    that many principals (in case insensitive principal id order);
+    after each chunk a checkpoint is recorded on the source storage and
+    the ``commit`` callable, if any, is invoked (typically to commit the
+    transaction).
+    A migration that is interrupted resumes after its last checkpoint
+    when run again; the checkpoint is removed once it completes.
+
     :return: A value that can be used like a boolean to say if
             any enrollments migrated.
     """
@@ -924,15 +1599,15 @@ def migrate_enrollments_from_course_to_course(source, dest, verbose=False, resul
     dest_enrollments = IDefaultCourseInstanceEnrollmentStorage(dest)
     source_enrollments = IDefaultCourseInstanceEnrollmentStorage(source)
 
-    for source_prin_id in list(source_enrollments):  # copy, we're mutating
+    def _move(source_prin_id):
         if not source_prin_id or source_prin_id in dest_enrollments:
             log("Ignoring dup enrollment for %s", source_prin_id)
-            continue
+            return False
 
         source_enrollment = source_enrollments[source_prin_id]
         if IPrincipal(source_enrollment.Principal, None) is None:
             log("Ignoring dup enrollment for %s", source_prin_id)
-            continue
+            return False
 
         mover = IObjectMover(source_enrollment)
         mover.moveTo(dest_enrollments)
@@ -940,8 +1615,45 @@ def migrate_enrollments_from_course_to_course(source, dest, verbose=False, resul
 
         log('Enrollment record for %s (scope=%s) moved',
             source_prin_id, source_enrollment.Scope)
-
-        count += 1
-
+        return True
+
+    if not batch_size:
+        for source_prin_id in list(source_enrollments):  # copy, we're mutating
+            if _move(source_prin_id):
+                count += 1
+        log('%s enrollment record(s) moved', count)
+        return count
+
+    # principal ids are case insensitive; order them the same way the
+    # checkpoint is compared
+    principal_ids = sorted((x for x in source_enrollments if x),
+                           key=lambda x: x.lower())
+    checkpoint = get_migration_checkpoint(source, dest)
+    if checkpoint is not None:
+        # moved records have left the source, but the ones we could not
+        # move (duplicates) are skipped without checking them again
+        checkpoint = checkpoint.lower()
+        principal_ids = [x for x in principal_ids if x.lower() > checkpoint]
+        log('Resuming migration after %s', checkpoint)
+
+    for idx in range(0, len(principal_ids), batch_size):
+        now = time.time()
+        chunk = principal_ids[idx:idx + batch_size]
+        moved = 0
+        for source_prin_id in chunk:
+            if source_prin_id in source_enrollments and _move(source_prin_id):
+                moved += 1
+        count += moved
+        _set_migration_checkpoint(source_enrollments, dest, chunk[-1])
+        if commit is not None:
+            commit()
+        elapsed = max(time.time() - now, 0.001)
+        log('%s of %s enrollment record(s) processed; %s moved in %.2f(s) (%.2f/s)',
+            idx + len(chunk), len(principal_ids), moved, elapsed,
+            len(chunk) / elapsed)
+
+    _set_migration_checkpoint(source_enrollments, dest, None)
+    if commit is not None:
+        commit()
     log('%s enrollment record(s) moved', count)
     return count
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+
+from zope.component.hooks import site as current_site
+
+from zope.intid.interfaces import IIntIds
+
+from zope.location import locate
+
+from nti.contenttypes.courses.index import IX_SCOPE
+from nti.contenttypes.courses.index import IX_ENROLLMENT_TOPICS
+from nti.contenttypes.courses.index import TP_ENROLLMENT_RECORDS
+
+from nti.contenttypes.courses.index import EnrollmentRecordExtentFilteredSet
+
+from nti.contenttypes.courses.index import install_enrollment_catalog
+
+from nti.contenttypes.courses.interfaces import ICourseInstanceEnrollmentRecord
+
+from nti.contenttypes.courses.utils import get_enrollment_scopes
+
+from nti.zope_catalog.topic import TopicIndex
+
+generation = 55
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def do_evolve(context, generation=generation):
+    conn = context.connection
+    ds_folder = conn.root()['nti.dataserver']
+
+    with current_site(ds_folder):
+        assert component.getSiteManager() == ds_folder.getSiteManager(), \
+               "Hooks not installed?"
+
+        lsm = ds_folder.getSiteManager()
+        intids = lsm.getUtility(IIntIds)
+        catalog = install_enrollment_catalog(ds_folder, intids)
+        if IX_ENROLLMENT_TOPICS not in catalog:
+            new_idx = TopicIndex(family=intids.family)
+            intids.register(new_idx)
+            locate(new_idx, catalog, IX_ENROLLMENT_TOPICS)
+            catalog[IX_ENROLLMENT_TOPICS] = new_idx
+
+        topic_index = catalog[IX_ENROLLMENT_TOPICS]
+        try:
+            the_filter = topic_index[TP_ENROLLMENT_RECORDS]
+        except KeyError:
+            the_filter = EnrollmentRecordExtentFilteredSet(TP_ENROLLMENT_RECORDS,
+                                                           family=intids.family)
+            topic_index.addFilter(the_filter)
+
+        # Only enrollment records are indexed with enrollment scopes, so
+        # there is no need to walk the sites
+        count = 0
+        query = {
+            IX_SCOPE: {'any_of': get_enrollment_scopes(catalog=catalog)}
+        }
+        for doc_id in catalog.apply(query) or ():
+            record = intids.queryObject(doc_id)
+            if ICourseInstanceEnrollmentRecord.providedBy(record):
+                the_filter.index_doc(doc_id, record)
+                count += 1
+
+    logger.info('Evolution %s done. Indexed %s enrollment records',
+                generation, count)
+
+
+def evolve(context):
+    """
+    Evolve to generation 55 by adding an enrollment record extent
+    to the enrollment catalog.
+    """
+    do_evolve(context, generation)
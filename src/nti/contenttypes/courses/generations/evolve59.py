@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import site as current_site
+
+from zope.intid.interfaces import IIntIds
+
+from nti.contenttypes.courses.index import IX_SITE
+from nti.contenttypes.courses.index import IX_ENTRY
+from nti.contenttypes.courses.index import IX_TOPICS
+from nti.contenttypes.courses.index import TP_DELETED_COURSES
+
+from nti.contenttypes.courses.index import install_courses_catalog
+
+from nti.dataserver.interfaces import IDataserver
+from nti.dataserver.interfaces import IOIDResolver
+
+generation = 59
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IDataserver)
+class MockDataserver(object):
+
+    root = None
+
+    def get_by_oid(self, oid, ignore_creator=False):
+        resolver = component.queryUtility(IOIDResolver)
+        if resolver is None:
+            logger.warn("Using dataserver without a proper ISiteManager.")
+        else:
+            return resolver.get_object_by_oid(oid, ignore_creator=ignore_creator)
+        return None
+
+
+def do_evolve(context, generation=generation):
+    conn = context.connection
+    ds_folder = conn.root()['nti.dataserver']
+
+    mock_ds = MockDataserver()
+    mock_ds.root = ds_folder
+    component.provideUtility(mock_ds, IDataserver)
+
+    with current_site(ds_folder):
+        assert component.getSiteManager() == ds_folder.getSiteManager(), \
+               "Hooks not installed?"
+
+        lsm = ds_folder.getSiteManager()
+        intids = lsm.getUtility(IIntIds)
+        catalog = install_courses_catalog(ds_folder, intids)
+        index = catalog[IX_SITE]
+        rebuild_counts = getattr(index, 'rebuild_counts', None)
+        if rebuild_counts is not None:
+            # the courses have an entry ntiid, their entries do not
+            family = intids.family
+            courses = family.IF.Set(catalog[IX_ENTRY].documents_to_values.keys())
+            deleted = catalog[IX_TOPICS][TP_DELETED_COURSES].getExtent()
+            rebuild_counts(family.IF.difference(courses, deleted))
+
+    component.getGlobalSiteManager().unregisterUtility(mock_ds, IDataserver)
+    logger.info('Evolution %s done.', generation)
+
+
+def evolve(context):
+    """
+    Evolve to generation 59 by counting the courses that are not deleted
+    of each site in the courses catalog site index.
+    """
+    do_evolve(context, generation)
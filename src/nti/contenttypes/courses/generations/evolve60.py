@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import site as current_site
+
+from zope.intid.interfaces import IIntIds
+
+from zope.location import locate
+
+from nti.contenttypes.courses.index import INTERNED_ENROLLMENT_INDEXES
+
+from nti.contenttypes.courses.index import install_enrollment_catalog
+
+from nti.dataserver.interfaces import IDataserver
+from nti.dataserver.interfaces import IOIDResolver
+
+generation = 60
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IDataserver)
+class MockDataserver(object):
+
+    root = None
+
+    def get_by_oid(self, oid, ignore_creator=False):
+        resolver = component.queryUtility(IOIDResolver)
+        if resolver is None:
+            logger.warn("Using dataserver without a proper ISiteManager.")
+        else:
+            return resolver.get_object_by_oid(oid, ignore_creator=ignore_creator)
+        return None
+
+
+def convert_index(catalog, name, clazz, intids):
+    old_index = catalog.get(name)
+    if old_index is None or isinstance(old_index, clazz):
+        return 0
+    new_index = clazz(family=intids.family)
+    # copy the stored values, without waking any record
+    for doc_id, value in old_index.documents_to_values.items():
+        new_index.index_value(doc_id, value)
+    intids.unregister(old_index)
+    del catalog[name]
+    intids.register(new_index)
+    locate(new_index, catalog, name)
+    # pylint: disable=protected-access
+    # no added event, the index must not be rebuilt from the records
+    catalog._setitemf(name, new_index)
+    return new_index.documentCount()
+
+
+def do_evolve(context, generation=generation):
+    conn = context.connection
+    ds_folder = conn.root()['nti.dataserver']
+
+    mock_ds = MockDataserver()
+    mock_ds.root = ds_folder
+    component.provideUtility(mock_ds, IDataserver)
+
+    with current_site(ds_folder):
+        assert component.getSiteManager() == ds_folder.getSiteManager(), \
+               "Hooks not installed?"
+
+        lsm = ds_folder.getSiteManager()
+        intids = lsm.getUtility(IIntIds)
+        catalog = install_enrollment_catalog(ds_folder, intids)
+        for name, clazz in INTERNED_ENROLLMENT_INDEXES:
+            count = convert_index(catalog, name, clazz, intids)
+            logger.info("Converted %s documents of index %s", count, name)
+
+    component.getGlobalSiteManager().unregisterUtility(mock_ds, IDataserver)
+    logger.info('Evolution %s done.', generation)
+
+
+def evolve(context):
+    """
+    Evolve to generation 60 by storing interned ids of the sites, entry
+    ntiids and usernames in the enrollment catalog.
+    """
+    do_evolve(context, generation)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import site as current_site
+
+from zope.intid.interfaces import IIntIds
+
+from zope.location import locate
+
+from nti.contenttypes.courses.index import IX_SITE
+from nti.contenttypes.courses.index import IX_COURSE
+from nti.contenttypes.courses.index import NodeSiteIndex
+from nti.contenttypes.courses.index import NodeCourseIndex
+from nti.contenttypes.courses.index import install_course_outline_catalog
+
+from nti.contenttypes.courses.interfaces import ICourseCatalog
+from nti.contenttypes.courses.interfaces import ICourseOutline
+from nti.contenttypes.courses.interfaces import ICourseInstance
+
+from nti.dataserver.interfaces import IDataserver
+from nti.dataserver.interfaces import IOIDResolver
+
+from nti.site.hostpolicy import get_all_host_sites
+
+generation = 61
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IDataserver)
+class MockDataserver(object):
+
+    root = None
+
+    def get_by_oid(self, oid, ignore_creator=False):
+        resolver = component.queryUtility(IOIDResolver)
+        if resolver is None:
+            logger.warn("Using dataserver without a proper ISiteManager.")
+        else:
+            return resolver.get_object_by_oid(oid, ignore_creator=ignore_creator)
+        return None
+
+
+def index_nodes(indexes, course_catalog, intids, seen):
+    count = 0
+    for entry in course_catalog.iterCatalogEntries():
+        course = ICourseInstance(entry, None)
+        outline = getattr(course, 'Outline', None)
+        # sections may share the outline of their parent
+        if not outline or id(outline) in seen:
+            continue
+        seen.add(id(outline))
+
+        def recur(node):
+            result = 0
+            for child in node.values():
+                result += recur(child)
+            doc_id = intids.queryId(node)
+            if doc_id is not None and not ICourseOutline.providedBy(node):
+                for index in indexes:
+                    index.index_doc(doc_id, node)
+                result += 1
+            return result
+        count += recur(outline)
+    return count
+
+
+def do_evolve(context, generation=generation):
+    conn = context.connection
+    ds_folder = conn.root()['nti.dataserver']
+
+    mock_ds = MockDataserver()
+    mock_ds.root = ds_folder
+    component.provideUtility(mock_ds, IDataserver)
+
+    with current_site(ds_folder):
+        assert component.getSiteManager() == ds_folder.getSiteManager(), \
+               "Hooks not installed?"
+
+        lsm = ds_folder.getSiteManager()
+        intids = lsm.getUtility(IIntIds)
+
+        logger.info('Evolution %s started.', generation)
+
+        catalog = install_course_outline_catalog(ds_folder, intids)
+        indexes = []
+        for name, clazz in ((IX_SITE, NodeSiteIndex),
+                            (IX_COURSE, NodeCourseIndex)):
+            if name not in catalog:
+                index = clazz(family=intids.family)
+                intids.register(index)
+                locate(index, catalog, name)
+                # pylint: disable=protected-access
+                # no added event, only the outline nodes are indexed below
+                catalog._setitemf(name, index)
+                indexes.append(index)
+
+        count = 0
+        seen = set()
+        for site in get_all_host_sites() if indexes else ():
+            with current_site(site):
+                course_catalog = component.queryUtility(ICourseCatalog)
+                if course_catalog is not None and not course_catalog.isEmpty():
+                    count += index_nodes(indexes, course_catalog, intids, seen)
+
+    component.getGlobalSiteManager().unregisterUtility(mock_ds, IDataserver)
+    logger.info('Evolution %s done (%s nodes indexed)', generation, count)
+
+
+def evolve(context):
+    """
+    Evolve to generation 61 by adding the site and course indexes to the
+    outline catalog.
+    """
+    do_evolve(context, generation)
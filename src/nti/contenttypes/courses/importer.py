@@ -64,6 +64,9 @@ from nti.contenttypes.courses import COURSE_TAB_PREFERENCES_INFO_NAME
 
 from nti.contenttypes.courses.common import get_course_site_registry
 
+from nti.contenttypes.courses.indexing import deferred_index_updates
+from nti.contenttypes.courses.indexing import immediate_index_updates
+
 from nti.contenttypes.courses.interfaces import SECTIONS
 from nti.contenttypes.courses.interfaces import NTI_COURSE_OUTLINE_NODE
 
@@ -554,6 +557,19 @@ class CourseImporter(object):
             except AttributeError:
                 pass
 
+    def _process_sections(self, course, filer, writeout):
+        for name, importer in sorted(component.getUtilitiesFor(ICourseSectionImporter)):
+            current = time.time()
+            logger.info("Processing %s", name)
+            try:
+                importer.process(course, filer, writeout)
+                notify(CourseSectionImporterExecutedEvent(course, importer, filer, writeout))
+                logger.info("%s processed in %s(s)",
+                            name, time.time() - current)
+            except Exception as e:
+                logger.exception("Error while processing %s", name)
+                raise e
+
     def _prepare_entry(self, course):
         entry = ICourseCatalogEntry(course)
         intids = component.queryUtility(IIntIds)
@@ -571,24 +587,17 @@ class CourseImporter(object):
             self.makedirs(course.root.absolute_path)
         # prepare entry
         self._prepare_entry(course)
-        # run import sections
-        for name, importer in sorted(component.getUtilitiesFor(ICourseSectionImporter)):
-            current = time.time()
-            logger.info("Processing %s", name)
-            try:
-                importer.process(course, filer, writeout)
-                notify(CourseSectionImporterExecutedEvent(course, importer, filer, writeout))
-                logger.info("%s processed in %s(s)",
-                            name, time.time() - current)
-            except Exception as e:
-                logger.exception("Error while processing %s", name)
-                raise e
-        # notify
-        self._mark_sync(course)
-        notify(CourseInstanceImportedEvent(course))
-        for subinstance in get_course_subinstances(course):
-            self._mark_sync(subinstance)
-            notify(CourseInstanceImportedEvent(subinstance))
+        # run import sections, indexing the courses catalog once per
+        # document when they are done
+        with deferred_index_updates():
+            self._process_sections(course, filer, writeout)
+        # notify, listeners may query the catalog
+        with immediate_index_updates():
+            self._mark_sync(course)
+            notify(CourseInstanceImportedEvent(course))
+            for subinstance in get_course_subinstances(course):
+                self._mark_sync(subinstance)
+                notify(CourseInstanceImportedEvent(subinstance))
         result = time.time() - now
         logger.info("Course %s imported in %s(s)",
                     ICourseCatalogEntry(course).ntiid, result)
@@ -8,17 +8,33 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import sys
 import time
+import heapq
+import hashlib
+import threading
 
 import BTrees
 
+from BTrees.Length import Length
+
+import six
+from six import string_types
+
+import transaction
+
 from zope import component
 from zope import interface
 
+from zope.catalog.attribute import AttributeIndex
+
 from zope.catalog.interfaces import ICatalog
+from zope.catalog.interfaces import ICatalogIndex
 
 from zope.component.hooks import getSite
 
+from zope.container.contained import Contained
+
 from zope.deprecation import deprecated
 
 from zope.index.text.lexicon import Lexicon
@@ -32,6 +48,8 @@ from zope.intid.interfaces import IIntIds
 
 from zope.location import locate
 
+from persistent import Persistent
+
 from nti.base._compat import text_
 
 from nti.contenttypes.courses.common import get_course_site
@@ -39,6 +57,9 @@ from nti.contenttypes.courses.common import get_course_packages
 from nti.contenttypes.courses.common import get_course_editors
 from nti.contenttypes.courses.common import get_course_instructors
 
+from nti.contenttypes.courses.indexing import get_index_queue
+from nti.contenttypes.courses.indexing import get_batch_index_queue
+
 from nti.contenttypes.courses.interfaces import ICourseInstance
 from nti.contenttypes.courses.interfaces import ICourseEnrollments
 from nti.contenttypes.courses.interfaces import IDeletedCourse
@@ -114,17 +135,464 @@ class KeepSetIndex(RawSetIndex):
             value.update(current)
             return super(KeepSetIndex, self).index_doc(doc_id, value)
 
+    def to_removed_iterable(self, value):
+        return self.to_iterable(value)
+
     def remove(self, doc_id, value):
         current = set(self.documents_to_values.get(doc_id) or ())
         if not current:
             return
-        for v in self.to_iterable(value):
+        for v in self.to_removed_iterable(value):
             current.discard(v)
         if current:
             return super(KeepSetIndex, self).index_doc(doc_id, current)
         return super(KeepSetIndex, self).unindex_doc(doc_id)
 
 
+def _intern_hash(value):
+    """
+    Return a 60-bit hash of the given text value, the same in all
+    processes.
+    """
+    digest = hashlib.sha1(text_(value).encode('utf-8')).hexdigest()
+    return int(digest[:15], 16)
+
+
+class InternTable(Persistent):
+    """
+    Maps the (text) values of an index to integers and back.
+    """
+
+    family = BTrees.family64
+
+    def __init__(self, family=None):
+        if family is not None:
+            self.family = family
+        self._ids = self.family.OI.BTree()
+        self._values = self.family.IO.BTree()
+        # the number of values interned
+        self._last = Length()
+
+    def __len__(self):
+        return self._last()
+
+    def intern(self, value):
+        vid = self._ids.get(value)
+        if vid is None:
+            # ids are derived from the values rather than handed out in
+            # sequence, so that concurrent interning of different values
+            # does not write the same keys
+            vid = _intern_hash(value)
+            while vid in self._values:  # collision
+                vid += 1
+            self._ids[value] = vid
+            self._values[vid] = value
+            self._last.change(1)
+        return vid
+
+    def query_id(self, value):
+        return self._ids.get(value)
+
+    def ids_by_value(self):
+        """
+        Return the mapping of values to ids, in value order.
+        """
+        return self._ids
+
+    def value(self, vid):
+        return self._values.get(vid)
+
+    def ids_between(self, min_value=None, max_value=None,
+                    excludemin=False, excludemax=False):
+        return list(self._ids.values(min_value, max_value,
+                                     excludemin=excludemin,
+                                     excludemax=excludemax))
+
+
+class InterningIndexMixin(object):
+    """
+    Stores small integer ids in place of the (text) values of a value or
+    set index, translating values as documents are indexed and queried.
+    """
+
+    def clear(self):
+        super(InterningIndexMixin, self).clear()
+        self.intern_table = InternTable(family=self.family)
+        self.values_to_documents = self.family.IO.BTree()
+
+    def value_ids(self, values):
+        """
+        Return the ids of the given values that have been interned.
+        """
+        if isinstance(values, string_types):
+            values = (values,)
+        query_id = self.intern_table.query_id
+        return [x for x in (query_id(v) for v in values or ()) if x is not None]
+
+    def _translate_query(self, query):
+        if not isinstance(query, dict) or len(query) != 1:
+            return query
+        (query_type, value), = query.items()
+        if query_type == 'any_of':
+            return {'any_of': self.value_ids(value)}
+        if query_type == 'all_of':
+            ids = self.value_ids(value)
+            if len(ids) != len(set(value)):
+                return None  # some value was never indexed
+            return {'all_of': ids}
+        if query_type == 'between':
+            return {'any_of': self.intern_table.ids_between(*value)}
+        return query
+
+    def apply(self, query):
+        translated = self._translate_query(query)
+        if translated is None:
+            return self.family.IF.Set()
+        return super(InterningIndexMixin, self).apply(translated)
+
+    def containsValue(self, value):
+        vid = self.intern_table.query_id(value)
+        return vid is not None and vid in self.values_to_documents
+
+    def values(self, doc_id=None):
+        if doc_id is None:
+            ids = self.values_to_documents.keys()
+        else:
+            ids = self.documents_to_values.get(doc_id)
+            if ids is None:
+                return ()
+            if isinstance(ids, six.integer_types):
+                ids = (ids,)
+        value = self.intern_table.value
+        return [value(x) for x in ids]
+
+
+def get_doc_values(index, doc_id):
+    """
+    Return the (uninterned) values the given value or set index holds for
+    the given document.
+    """
+    if isinstance(index, InterningIndexMixin):
+        return index.values(doc_id)
+    index = getattr(index, 'index', index)  # normalization wrapper
+    value = index.documents_to_values.get(doc_id)
+    if value is None:
+        return ()
+    if isinstance(value, string_types) or not hasattr(value, '__iter__'):
+        return (value,)
+    return list(value)
+
+
+def _iter_interned_items(index, reverse=False):
+    values_to_documents = index.values_to_documents
+    ids_by_value = index.intern_table.ids_by_value()
+    for value, vid in _iter_index_items(ids_by_value, reverse):
+        docs = values_to_documents.get(vid)
+        if docs:
+            yield value, docs
+
+
+def _sort_value(value):
+    # Set indexes keep a set of values for each document
+    if value is not None \
+        and not isinstance(value, string_types) \
+        and hasattr(value, '__iter__'):
+        value = min(value) if value else None
+    return value
+
+
+def sort_doc_ids_by_index(index, doc_ids, reverse=False, limit=None, key=None):
+    """
+    Return a list of the given doc ids sorted by their values in the
+    given value (or normalized value) index, without waking any object.
+    Documents without a value in the index sort last.
+
+    :param limit: The maximum number of doc ids to return.
+    :param key: A callable applied to the indexed values before sorting.
+    """
+    index = getattr(index, 'index', index)  # normalization wrapper
+    documents_to_values = index.documents_to_values
+    values_to_documents = index.values_to_documents
+    size = len(doc_ids)
+    if not size or (limit is not None and limit <= 0):
+        return []
+
+    family = getattr(index, 'family', BTrees.family64)
+    interned = isinstance(index, InterningIndexMixin)
+    walk_values = key is None \
+              and limit is not None \
+              and limit * index.documentCount() < size * size
+    if walk_values:
+        # The documents are a good part of the index, so it is cheaper to
+        # walk the values in order until we have collected enough of them.
+        result = []
+        if not isinstance(doc_ids, (family.IF.Set, family.IF.TreeSet)):
+            doc_ids = family.IF.Set(doc_ids)
+        if interned:
+            # ids are not in value order, walk the values
+            items = _iter_interned_items(index, reverse)
+        else:
+            items = _iter_index_items(values_to_documents, reverse)
+        seen = family.IF.Set()
+        for unused_value, docs in items:
+            # set indexes may hold a document under several values
+            docs = family.IF.difference(family.IF.intersection(docs, doc_ids),
+                                        seen)
+            seen.update(docs)
+            result.extend(reversed(docs) if reverse else docs)
+            if len(result) >= limit:
+                return result[:limit]
+        # remaining documents have no value
+        missing = family.IF.difference(doc_ids, seen)
+        result.extend(missing)
+        return result[:limit]
+
+    if interned:
+        def indexed_value(doc_id):
+            values = index.values(doc_id)
+            return values or None
+    else:
+        indexed_value = documents_to_values.get
+
+    def sort_key(doc_id):
+        value = _sort_value(indexed_value(doc_id))
+        if value is not None and key is not None:
+            value = key(value)
+        # (x is None) keeps documents without value at the end
+        return (value is None) != reverse, value
+
+    if limit is not None and limit < size:
+        method = heapq.nlargest if reverse else heapq.nsmallest
+        return method(limit, doc_ids, key=sort_key)
+    return sorted(doc_ids, key=sort_key, reverse=reverse)
+
+
+def sort_doc_ids_by_field_index(index, doc_ids, reverse=False, limit=None,
+                                family=BTrees.family64):
+    """
+    Return a list of the given doc ids sorted by their values in the
+    given field index, without waking any object. Documents without a
+    value in the index sort last.
+    """
+    index = getattr(index, 'index', index)  # normalization wrapper
+    if limit is not None and limit <= 0:
+        return []
+    family = getattr(index, 'family', family)
+    if not isinstance(doc_ids, (family.IF.Set, family.IF.TreeSet)):
+        doc_ids = family.IF.Set(doc_ids)
+    if not doc_ids:
+        return []
+    result = list(index.sort(doc_ids, limit=limit, reverse=reverse))
+    if limit is None or len(result) < limit:
+        # the remaining documents have no value
+        result.extend(family.IF.difference(doc_ids, family.IF.Set(result)))
+    return result[:limit] if limit is not None else result
+
+
+def _iter_reversed_bucket(items):
+    for i in range(len(items) - 1, -1, -1):
+        yield items[i]
+
+
+def _iter_reversed_items(tree):
+    """
+    Iterate over the items of the given BTree in reverse key order. BTrees
+    cannot be iterated backwards, so we walk the children of its nodes
+    (from their pickled state) right to left, loading only the buckets
+    we reach.
+    """
+    state = tree.__getstate__()
+    if not state:
+        return
+    if len(state) == 1:
+        # a single bucket, kept inline
+        for item in _iter_reversed_bucket(tree.items()):
+            yield item
+        return
+    children = state[0]
+    for i in range(len(children) - 1, -1, -2):
+        child = children[i]
+        if isinstance(child, type(tree)):
+            items = _iter_reversed_items(child)
+        else:
+            items = _iter_reversed_bucket(child.items())
+        for item in items:
+            yield item
+
+
+def _iter_index_items(values_to_documents, reverse=False):
+    if not reverse:
+        return iter(values_to_documents.items())
+    return _iter_reversed_items(values_to_documents)
+
+
+def get_index_doc_ids(index, values, family=BTrees.family64):
+    """
+    Return the set of doc ids that have any of the given values in the
+    given value or set index, straight from its reverse mapping.
+    """
+    index = getattr(index, 'index', index)  # normalization wrapper
+    values_to_documents = index.values_to_documents
+    family = getattr(index, 'family', family)
+    if isinstance(values, string_types):
+        values = (values,)
+    if isinstance(index, InterningIndexMixin):
+        values = index.value_ids(values)
+    sets = []
+    for value in values or ():
+        docs = values_to_documents.get(value)
+        if docs:
+            sets.append(docs)
+    if len(sets) == 1:
+        return sets[0]
+    return family.IF.multiunion(sets) if sets else family.IF.Set()
+
+
+def has_common_doc_ids(doc_ids_sets, family=BTrees.family64):
+    """
+    Return whether the given doc id sets have any doc id in common.
+    The smallest sets are intersected first so that we can stop as soon
+    as the intersection is empty; None entries are ignored.
+    """
+    sets = sorted((x for x in doc_ids_sets if x is not None), key=len)
+    if not sets:
+        return False
+    result = sets[0]
+    for docs in sets[1:]:
+        if not result:
+            break
+        result = family.IF.intersection(result, docs)
+    return bool(result)
+
+
+#: index name -> [number of applies, total seconds]
+_query_timings = {}
+_query_timings_lock = threading.Lock()
+
+
+def _record_query_timing(name, elapsed):
+    with _query_timings_lock:
+        timing = _query_timings.get(name)
+        if timing is None:
+            timing = _query_timings[name] = [0, 0.0]
+        timing[0] += 1
+        timing[1] += elapsed
+
+
+def get_query_timings():
+    """
+    Return a dict of index name -> (number of applies, total seconds) of
+    the queries run through :func:`apply_query` in this process.
+    """
+    with _query_timings_lock:
+        return {k: tuple(v) for k, v in _query_timings.items()}
+
+
+def reset_query_timings():
+    with _query_timings_lock:
+        _query_timings.clear()
+
+
+def _query_term(index, query):
+    # normalized indexes take the values before normalization
+    if      isinstance(query, dict) and len(query) == 1 \
+        and getattr(index, 'normalizer', None) is None:
+        return list(query.items())[0]
+    return None, None
+
+
+def _query_value_keys(index, values):
+    if isinstance(values, string_types):
+        values = (values,)
+    if isinstance(index, InterningIndexMixin):
+        return index.value_ids(values)
+    return values or ()
+
+
+def estimate_query_size(index, query):
+    """
+    Estimate the number of documents the given single index query
+    matches from the index reverse mapping, without applying it. Returns
+    None if it cannot be estimated.
+    """
+    values_to_documents = getattr(index, 'values_to_documents', None)
+    query_type, value = _query_term(index, query)
+    if values_to_documents is None or query_type is None:
+        return None
+    if query_type == 'any':
+        return index.documentCount()
+    if query_type in ('any_of', 'all_of'):
+        sizes = [len(values_to_documents.get(x) or ())
+                 for x in _query_value_keys(index, value)]
+        if query_type == 'any_of':
+            return sum(sizes)
+        return min(sizes) if sizes else 0
+    return None
+
+
+def _filter_doc_ids(index, query, doc_ids):
+    """
+    Return the given doc ids that match an ``any_of`` query on a value or
+    set index, looking each document up rather than applying the query,
+    or None if the query cannot be checked that way.
+    """
+    documents_to_values = getattr(index, 'documents_to_values', None)
+    query_type, value = _query_term(index, query)
+    if documents_to_values is None or query_type != 'any_of':
+        return None
+    keys = set(_query_value_keys(index, value))
+    result = []
+    for doc_id in doc_ids:
+        values = documents_to_values.get(doc_id)
+        if values is None:
+            continue
+        if isinstance(values, (six.integer_types, string_types)):
+            if values in keys:
+                result.append(doc_id)
+        elif not keys.isdisjoint(values):
+            result.append(doc_id)
+    return result
+
+
+def apply_query(catalog, query, family=None):
+    """
+    Apply the given query (index name -> index query) to the catalog as
+    its ``apply`` would, but evaluating the most selective index first,
+    filtering small intermediate results instead of materializing large
+    index results, and stopping as soon as the result is empty. The time
+    spent in each index is recorded, see :func:`get_query_timings`.
+    """
+    family = getattr(catalog, 'family', None) if family is None else family
+    family = family or BTrees.family64
+    terms = []
+    for name, index_query in query.items():
+        index = catalog[name]
+        size = estimate_query_size(index, index_query)
+        if size == 0:
+            return family.IF.Set()
+        terms.append((sys.maxsize if size is None else size, name, index, index_query))
+    terms.sort(key=lambda x: x[0])
+    result = None
+    for size, name, index, index_query in terms:
+        start = time.time()
+        docs = None
+        if result is not None and len(result) * 4 < size:
+            docs = _filter_doc_ids(index, index_query, result)
+            if docs is not None:
+                docs = family.IF.Set(docs)
+        if docs is None:
+            docs = index.apply(index_query)
+            if docs is not None and result is not None:
+                docs = family.IF.intersection(result, docs)
+        _record_query_timing(name, time.time() - start)
+        if docs is None:
+            continue  # no constraint
+        result = docs
+        if not result:
+            return family.IF.Set()
+    return result
+
+
 # Enrollment catalog
 
 
@@ -150,7 +618,9 @@ IX_SCOPE = 'scope'
 IX_CREATEDTIME = 'createdTime'
 IX_ENTRY = IX_COURSE = 'course'
 IX_LASTMODIFIED = 'lastModified'
+IX_ENROLLMENT_TOPICS = 'topics'
 IX_USERNAME = IX_STUDENT = IX_INSTRUCTOR = 'username'
+TP_ENROLLMENT_RECORDS = 'enrollmentRecords'
 
 
 class ValidatingSiteName(object):
@@ -231,6 +701,81 @@ class CatalogEntryIDIndex(ValueIndex):
     default_interface = ValidatingCatalogEntryID
 
 
+class InterningAttributeValueIndex(InterningIndexMixin, ValueIndex):
+    """
+    A value index of the interned id of an attribute value.
+    """
+
+    def _attribute_value(self, obj):
+        # As in :meth:`AttributeIndex.index_doc`
+        if self.interface is not None:
+            obj = self.interface(obj, None)
+            if obj is None:
+                return None
+        value = getattr(obj, self.field_name, None)
+        if value is not None and self.field_callable:
+            value = value()
+        return value
+
+    def index_value(self, doc_id, value):
+        if value is None:
+            return self.unindex_doc(doc_id)
+        vid = self.intern_table.intern(value)
+        # skip the attribute lookup
+        return super(AttributeIndex, self).index_doc(doc_id, vid)
+
+    def index_doc(self, doc_id, obj):
+        return self.index_value(doc_id, self._attribute_value(obj))
+
+    def clear(self):
+        super(InterningAttributeValueIndex, self).clear()
+        self.documents_to_values = self.family.II.BTree()
+
+
+class InterningKeepSetIndex(InterningIndexMixin, KeepSetIndex):
+    """
+    A :class:`KeepSetIndex` of the interned ids of its values.
+    """
+
+    def _raw_values(self, value):
+        return [v for v in super(InterningKeepSetIndex, self).to_iterable(value)
+                if v is not None]
+
+    def to_iterable(self, value):
+        intern = self.intern_table.intern
+        return [intern(v) for v in self._raw_values(value)]
+
+    def to_removed_iterable(self, value):
+        # values never interned cannot be indexed, do not intern them now
+        query_id = self.intern_table.query_id
+        return [x for x in (query_id(v) for v in self._raw_values(value))
+                if x is not None]
+
+    def index_value(self, doc_id, values):
+        values = {self.intern_table.intern(v) for v in values or () if v is not None}
+        if not values:
+            return RawSetIndex.unindex_doc(self, doc_id)
+        return RawSetIndex.index_doc(self, doc_id, values)
+
+
+class InternedSingleSiteIndex(InterningAttributeValueIndex, SingleSiteIndex):
+    pass
+
+
+class InternedCatalogEntryIDIndex(InterningAttributeValueIndex, CatalogEntryIDIndex):
+    pass
+
+
+class InternedUsernameIndex(InterningKeepSetIndex, UsernameIndex):
+    pass
+
+
+#: The enrollment catalog indexes that store interned values
+INTERNED_ENROLLMENT_INDEXES = ((IX_SITE, InternedSingleSiteIndex),
+                               (IX_ENTRY, InternedCatalogEntryIDIndex),
+                               (IX_USERNAME, InternedUsernameIndex))
+
+
 class RecordCreatedTimeRawIndex(RawIntegerValueIndex):
     pass
 
@@ -253,9 +798,41 @@ def RecordLastModifiedIndex(family=BTrees.family64):
                                 normalizer=TimestampToNormalized64BitIntNormalizer())
 
 
+def is_enrollment_record(unused_extent, unused_docid, document):
+    # NOTE: This is referenced by persistent objects, must stay.
+    return ICourseInstanceEnrollmentRecord.providedBy(document)
+
+
+class EnrollmentRecordExtentFilteredSet(ExtentFilteredSet):
+    """
+    A filter for a topic index that collects enrollment records only,
+    leaving out the course documents indexed for course roles.
+    """
+
+    def __init__(self, fid, family=BTrees.family64):
+        super(EnrollmentRecordExtentFilteredSet, self).__init__(fid,
+                                                                is_enrollment_record,
+                                                                family=family)
+
+
 @interface.implementer(ICatalog)
 class EnrollmentCatalog(Catalog):
-    pass
+    """
+    Queues its index updates while a batch (e.g. a roster load) is in
+    progress, so that they are applied in one pass when it finishes.
+    """
+
+    def index_doc(self, docid, ob):
+        queue = get_batch_index_queue()
+        if queue is not None and queue.add(self, docid, ob):
+            return
+        super(EnrollmentCatalog, self).index_doc(docid, ob)
+
+    def unindex_doc(self, docid):
+        queue = get_batch_index_queue()
+        if queue is not None:
+            queue.discard(self, docid)
+        super(EnrollmentCatalog, self).unindex_doc(docid)
 
 
 def get_enrollment_catalog(registry=component):
@@ -266,17 +843,34 @@ def create_enrollment_catalog(catalog=None, family=BTrees.family64):
     if catalog is None:
         catalog = EnrollmentCatalog(family=family)
     for name, clazz in ((IX_SCOPE, ScopeSetIndex),
-                        (IX_SITE, SingleSiteIndex),
-                        (IX_USERNAME, UsernameIndex),
-                        (IX_ENTRY, CatalogEntryIDIndex),
+                        (IX_SITE, InternedSingleSiteIndex),
+                        (IX_USERNAME, InternedUsernameIndex),
+                        (IX_ENTRY, InternedCatalogEntryIDIndex),
                         (IX_CREATEDTIME, RecordCreatedTimeIndex),
-                        (IX_LASTMODIFIED, RecordLastModifiedIndex)):
+                        (IX_LASTMODIFIED, RecordLastModifiedIndex),
+                        (IX_ENROLLMENT_TOPICS, TopicIndex)):
         index = clazz(family=family)
         locate(index, catalog, name)
         catalog[name] = index
+    topic_index = catalog[IX_ENROLLMENT_TOPICS]
+    the_filter = EnrollmentRecordExtentFilteredSet(TP_ENROLLMENT_RECORDS,
+                                                   family=family)
+    topic_index.addFilter(the_filter)
     return catalog
 
 
+def get_enrollment_records_extent(catalog=None):
+    """
+    Return the extent of the doc ids of the enrollment records in the
+    enrollment catalog, or None if the catalog does not have one.
+    """
+    catalog = get_enrollment_catalog() if catalog is None else catalog
+    try:
+        return catalog[IX_ENROLLMENT_TOPICS][TP_ENROLLMENT_RECORDS].getExtent()
+    except (KeyError, TypeError):
+        return None
+
+
 def install_enrollment_catalog(site_manager_container, intids=None):
     lsm = site_manager_container.getSiteManager()
     catalog = get_enrollment_catalog(lsm)
@@ -308,6 +902,8 @@ IX_NAME = 'name'
 IX_TAGS = 'tags'
 IX_TOPICS = 'topics'
 IX_KEYWORDS = 'keywords'
+IX_TAG_COUNTS = 'tag_counts'
+IX_ENTRY_SUBSTRING = 'substring'
 IX_PACKAGES = 'packages'
 IX_IMPORT_HASH = 'import_hash'
 IX_COURSE_INSTRUCTOR = 'instructor'
@@ -319,6 +915,7 @@ IX_ENTRY_TITLE_SORT = 'title_sort'
 IX_ENTRY_PUID_SORT = 'provider_unique_id_sort'
 IX_ENTRY_START_DATE = 'StartDate'
 IX_ENTRY_END_DATE = 'EndDate'
+IX_ENTRY_PREVIEW = 'preview'
 IX_ENTRY_TO_COURSE_INTID = 'course_intid'
 IX_COURSE_TO_ENTRY_INTID = 'entry_intid'
 TP_DELETED_COURSES = 'deletedCourses'
@@ -372,9 +969,94 @@ class ValidatingCourseSiteName(object):
 
 
 class CourseSiteIndex(ValueIndex):
+    """
+    Indexes the site of courses (and entries), keeping the number of
+    courses that are not deleted in each site so that it can be answered
+    without building the result set.
+    """
+
     default_field_name = 'site'
     default_interface = ValidatingCourseSiteName
 
+    #: site -> :class:`Length`. Indexes created before these were kept
+    #: have none until :meth:`rebuild_counts` is called.
+    _site_counts = None
+
+    #: doc id -> the site it is counted in
+    _counted = None
+
+    def clear(self):
+        super(CourseSiteIndex, self).clear()
+        self._site_counts = BTrees.OOBTree.OOBTree()
+        self._counted = self.family.IO.BTree()
+
+    def _change_count(self, site, delta):
+        length = self._site_counts.get(site)
+        if length is None:
+            length = self._site_counts[site] = Length()
+        length.change(delta)
+        if length() <= 0:
+            del self._site_counts[site]
+
+    def _recount(self, doc_id, counted):
+        """
+        Make the given document counted (or not) in the site it is indexed
+        under. Safe to call several times for the same change.
+        """
+        if self._site_counts is None:
+            return
+        site = self.documents_to_values.get(doc_id) if counted else None
+        site = site or None
+        old_site = self._counted.get(doc_id)
+        if old_site == site:
+            return
+        if old_site is not None:
+            self._change_count(old_site, -1)
+            del self._counted[doc_id]
+        if site is not None:
+            self._change_count(site, 1)
+            self._counted[doc_id] = site
+
+    def index_doc(self, doc_id, value):
+        result = super(CourseSiteIndex, self).index_doc(doc_id, value)
+        # entries and deleted courses are indexed but not counted
+        counted =     ICourseInstance.providedBy(value) \
+                  and not IDeletedCourse.providedBy(value)
+        self._recount(doc_id, counted)
+        return result
+
+    def unindex_doc(self, doc_id):
+        result = super(CourseSiteIndex, self).unindex_doc(doc_id)
+        self._recount(doc_id, False)
+        return result
+
+    def rebuild_counts(self, doc_ids):
+        """
+        Count the given documents (the courses that are not deleted) in the
+        sites they are indexed under.
+        """
+        self._site_counts = BTrees.OOBTree.OOBTree()
+        self._counted = self.family.IO.BTree()
+        for doc_id in doc_ids:
+            self._recount(doc_id, True)
+
+    def has_documents(self, site):
+        """
+        Return whether there is any document in the given site.
+        """
+        # empty document sets are removed on unindex
+        return site in self.values_to_documents
+
+    def count(self, site):
+        """
+        Return the number of courses that are not deleted in the given
+        site, or None if this index does not keep counts.
+        """
+        if self._site_counts is None:
+            return None
+        length = self._site_counts.get(site)
+        return length() if length is not None else 0
+
 
 class CourseImportHashIndex(ValueIndex):
     default_field_name = 'import_hash'
@@ -569,6 +1251,48 @@ def CourseCatalogEntryEndDateIndex(family=BTrees.family64):
                                 normalizer=TimestampToNormalized64BitIntNormalizer())
 
 
+def get_entry_preview_flag(entry):
+    """
+    Return the preview flag explicitly in effect for the given entry,
+    or None if its preview status is derived from its start date.
+    """
+    if not hasattr(entry, 'PreviewRawValue'):
+        return bool(getattr(entry, 'Preview', False))
+    raw = entry.PreviewRawValue
+    if raw is not None:
+        return bool(raw)
+    # Section entries without their own start date inherit
+    # the preview status of their parent
+    next_entry = getattr(entry, '_next_entry', None)
+    if next_entry is not None and 'StartDate' not in entry.__dict__:
+        return get_entry_preview_flag(next_entry)
+    return None
+
+
+class ValidatingCourseCatalogEntryPreview(object):
+
+    __slots__ = ('preview',)
+
+    def __init__(self, obj, unused_default=None):
+        if ICourseCatalogEntry.providedBy(obj):
+            preview = get_entry_preview_flag(obj)
+            if preview is not None:
+                self.preview = preview
+
+    def __reduce__(self):
+        raise TypeError()
+
+
+class CourseCatalogEntryPreviewIndex(ValueIndex):
+    """
+    Indexes the explicit preview flag of catalog entries; entries whose
+    preview status is derived from their start date are not indexed
+    here and should be looked up in the start date index.
+    """
+    default_field_name = 'preview'
+    default_interface = ValidatingCourseCatalogEntryPreview
+
+
 class ValidatingCoursePackages(object):
 
     __slots__ = ('packages',)
@@ -607,6 +1331,228 @@ class CourseTagsIndex(AttributeKeywordIndex):
     default_interface = ValidatingCourseTags
 
 
+@interface.implementer(ICatalogIndex)
+class CourseTagCountIndex(Persistent, Contained):
+    """
+    Keeps, for each site, the number of (non-deleted) catalog entries
+    with each tag, and the number of those that are public, as they
+    are indexed. This is not a searchable index; it answers tag
+    counts without visiting the entries.
+    """
+
+    family = BTrees.family64
+
+    def __init__(self, family=None):
+        if family is not None:
+            self.family = family
+        self.clear()
+
+    def clear(self):
+        self._docs = self.family.IO.BTree()
+        self._counts = BTrees.OOBTree.OOBTree()
+        self._public_counts = BTrees.OOBTree.OOBTree()
+
+    def documentCount(self):
+        return len(self._docs)
+
+    @staticmethod
+    def _doc_state(obj):
+        if not ICourseCatalogEntry.providedBy(obj):
+            return None
+        course = ICourseInstance(obj, None)
+        if IDeletedCourse.providedBy(course):
+            return None
+        tags = tuple(sorted({
+            text_(x).lower() for x in getattr(obj, 'tags', None) or () if x
+        }))
+        if not tags:
+            return None
+        site = text_(get_course_site(obj) or '')
+        public = not INonPublicCourseInstance.providedBy(obj)
+        return (site, tags, public)
+
+    @staticmethod
+    def _change(counts, site, tags, delta):
+        site_counts = counts.get(site)
+        if site_counts is None:
+            site_counts = counts[site] = BTrees.OOBTree.OOBTree()
+        for tag in tags:
+            length = site_counts.get(tag)
+            if length is None:
+                length = site_counts[tag] = Length()
+            length.change(delta)
+            if length() <= 0:
+                del site_counts[tag]
+
+    def _apply_state(self, state, delta):
+        site, tags, public = state
+        self._change(self._counts, site, tags, delta)
+        if public:
+            self._change(self._public_counts, site, tags, delta)
+
+    def index_doc(self, docid, obj):
+        state = self._doc_state(obj)
+        old_state = self._docs.get(docid)
+        if state == old_state:
+            return
+        if old_state is not None:
+            self._apply_state(old_state, -1)
+            del self._docs[docid]
+        if state is not None:
+            self._apply_state(state, 1)
+            self._docs[docid] = state
+
+    def unindex_doc(self, docid):
+        old_state = self._docs.get(docid)
+        if old_state is not None:
+            self._apply_state(old_state, -1)
+            del self._docs[docid]
+
+    def apply(self, unused_query):
+        # Not searchable, places no constraint on the results
+        return None
+
+    def tag_counts(self, sites, public_only=True, prefix=None):
+        """
+        Return a dict of tag -> number of entries with that tag in the
+        given sites (all sites if None), optionally only for the tags
+        with the given prefix.
+        """
+        result = dict()
+        counts = self._public_counts if public_only else self._counts
+        if sites is None:
+            sites = list(counts.keys())
+        elif isinstance(sites, string_types):
+            sites = sites.split()
+        for site in sites:
+            site_counts = counts.get(site)
+            if not site_counts:
+                continue
+            if prefix:
+                items = site_counts.items(min=prefix)
+            else:
+                items = site_counts.items()
+            for tag, length in items:
+                if prefix and not tag.startswith(prefix):
+                    break
+                result[tag] = result.get(tag, 0) + length()
+        return result
+
+
+def get_trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+@interface.implementer(ICatalogIndex)
+class CourseEntrySubstringIndex(Persistent, Contained):
+    """
+    A trigram index of the (lower case) title, provider unique id and
+    tags of catalog entries, answering case-insensitive substring
+    queries on them. Tags only match as a whole, as they do when
+    filtering entries.
+
+    Query with a string or with ``{'query': text}``.
+    """
+
+    family = BTrees.family64
+
+    def __init__(self, family=None):
+        if family is not None:
+            self.family = family
+        self.clear()
+
+    def clear(self):
+        self._fwd = BTrees.OOBTree.OOBTree()
+        self._rev = self.family.IO.BTree()
+
+    def documentCount(self):
+        return len(self._rev)
+
+    @staticmethod
+    def _doc_values(obj):
+        if not ICourseCatalogEntry.providedBy(obj):
+            return None
+        texts = tuple(
+            text_(x).lower() for x in (getattr(obj, 'title', None),
+                                       getattr(obj, 'ProviderUniqueID', None)) if x
+        )
+        tags = tuple(sorted({
+            text_(x).lower() for x in getattr(obj, 'tags', None) or () if x
+        }))
+        if not texts and not tags:
+            return None
+        return texts, tags
+
+    @staticmethod
+    def _trigrams(values):
+        texts, tags = values
+        result = set()
+        for text in texts + tags:
+            result.update(get_trigrams(text))
+        return result
+
+    def index_doc(self, docid, obj):
+        values = self._doc_values(obj)
+        old_values = self._rev.get(docid)
+        if values == old_values:
+            return
+        old = self._trigrams(old_values) if old_values is not None else set()
+        new = self._trigrams(values) if values is not None else set()
+        for trigram in old - new:
+            docs = self._fwd.get(trigram)
+            if docs is not None:
+                docs.remove(docid)
+                if not docs:
+                    del self._fwd[trigram]
+        for trigram in new - old:
+            docs = self._fwd.get(trigram)
+            if docs is None:
+                docs = self._fwd[trigram] = self.family.IF.TreeSet()
+            docs.add(docid)
+        if values is None:
+            del self._rev[docid]
+        else:
+            self._rev[docid] = values
+
+    def unindex_doc(self, docid):
+        if docid in self._rev:
+            self.index_doc(docid, None)
+
+    def has_doc(self, docid):
+        return docid in self._rev
+
+    def _matches(self, docid, text):
+        texts, tags = self._rev[docid]
+        return text in tags or any(text in x for x in texts)
+
+    def apply(self, query):
+        if isinstance(query, dict):
+            query = query.get('query')
+        text = text_(query or '').strip().lower()
+        if not text:
+            return self.family.IF.Set()
+        trigrams = get_trigrams(text)
+        if trigrams:
+            sets = []
+            for trigram in trigrams:
+                docs = self._fwd.get(trigram)
+                if not docs:
+                    return self.family.IF.Set()
+                sets.append(docs)
+            candidates = sets.pop(sets.index(min(sets, key=len)))
+            for docs in sets:
+                candidates = self.family.IF.intersection(candidates, docs)
+                if not candidates:
+                    return self.family.IF.Set()
+        else:
+            # too short for trigrams, check every document
+            candidates = self._rev.keys()
+        # trigrams do not keep their positions, verify the candidates
+        return self.family.IF.Set(
+            x for x in candidates if self._matches(x, text)
+        )
+
+
 class CourseKeywordsIndex(AttributeKeywordIndex):
     default_field_name = 'keywords'
     default_interface = ICourseKeywords
@@ -651,7 +1597,61 @@ class IsNonPublicCourseExtentFilteredSet(ExtentFilteredSet):
 
 @interface.implementer(ICatalog)
 class CoursesCatalog(Catalog):
-    pass
+    """
+    Keeps a (conflict-resolving) count of the documents indexed and
+    unindexed, so that views derived from the indexes can tell when
+    they are stale.
+    """
+
+    _changes = None
+
+    def _note_change(self):
+        if self._changes is None:
+            self._changes = Length()
+        self._changes.change(1)
+        # pylint: disable=attribute-defined-outside-init
+        self._v_changed_in = transaction.get()
+
+    def change_count(self):
+        # pylint: disable=not-callable
+        return self._changes() if self._changes is not None else 0
+
+    def stamp(self):
+        """
+        Return a value that changes whenever the contents of this catalog
+        may have changed, suitable to key caches derived from it.
+
+        For a stored catalog this is the serial of the last committed
+        change, which is unique per commit. While the current transaction
+        has changes of its own that are not committed, this returns None,
+        and nothing derived from the indexes should be cached.
+        """
+        jar = self._p_jar
+        if jar is None:
+            return (id(self), None, self.change_count())
+        if getattr(self, '_v_changed_in', None) is transaction.get():
+            return None
+        changes = self._changes
+        serial = None
+        if changes is not None:
+            changes._p_activate()
+            serial = changes._p_serial
+        return (id(jar.db()), self._p_oid, serial)
+
+    def index_doc(self, docid, ob):
+        # Only the stored catalog defers, scratch catalogs are not queued
+        queue = get_index_queue() if self._p_jar is not None else None
+        if queue is not None and queue.add(self, docid, ob):
+            return
+        super(CoursesCatalog, self).index_doc(docid, ob)
+        self._note_change()
+
+    def unindex_doc(self, docid):
+        queue = get_index_queue() if self._p_jar is not None else None
+        if queue is not None:
+            queue.discard(self, docid)
+        super(CoursesCatalog, self).unindex_doc(docid)
+        self._note_change()
 
 
 def get_courses_catalog(registry=component):
@@ -667,6 +1667,8 @@ def create_courses_catalog(catalog=None, family=BTrees.family64):
                         (IX_TAGS, CourseTagsIndex),
                         (IX_PACKAGES, CoursePackagesIndex),
                         (IX_KEYWORDS, CourseKeywordsIndex),
+                        (IX_TAG_COUNTS, CourseTagCountIndex),
+                        (IX_ENTRY_SUBSTRING, CourseEntrySubstringIndex),
                         (IX_ENTRY, CourseCatalogEntryIndex),
                         (IX_ENTRY_TITLE, CourseCatalogEntryTitleIndex),
                         (IX_ENTRY_DESC, CourseCatalogEntryDescriptionIndex),
@@ -675,6 +1677,7 @@ def create_courses_catalog(catalog=None, family=BTrees.family64):
                         (IX_ENTRY_PUID_SORT, CourseCatalogEntryPUIDSortIndex),
                         (IX_ENTRY_START_DATE, CourseCatalogEntryStartDateIndex),
                         (IX_ENTRY_END_DATE, CourseCatalogEntryEndDateIndex),
+                        (IX_ENTRY_PREVIEW, CourseCatalogEntryPreviewIndex),
                         (IX_ENTRY_TO_COURSE_INTID, EntryToCourseIntidIndex),
                         (IX_COURSE_TO_ENTRY_INTID, CourseToEntryIntidIndex),
                         (IX_IMPORT_HASH, CourseImportHashIndex),
@@ -786,6 +1789,45 @@ def NodeAvailableEndingIndex(family=BTrees.family64):
                                 normalizer=TimestampToNormalized64BitIntNormalizer())
 
 
+class ValidatingNodeSite(object):
+
+    __slots__ = ('site',)
+
+    def __init__(self, obj, unused_default=None):
+        if ICourseOutlineNode.providedBy(obj):
+            self.site = get_course_site(ICourseInstance(obj, None))
+
+    def __reduce__(self):
+        raise TypeError()
+
+
+class NodeSiteIndex(ValueIndex):
+    default_field_name = 'site'
+    default_interface = ValidatingNodeSite
+
+
+class ValidatingNodeCourse(object):
+    """
+    The ntiid of the catalog entry of the course that owns the outline of
+    a node. Sections sharing the outline of their parent share its nodes.
+    """
+
+    __slots__ = ('ntiid',)
+
+    def __init__(self, obj, unused_default=None):
+        if ICourseOutlineNode.providedBy(obj):
+            entry = ICourseCatalogEntry(ICourseInstance(obj, None), None)
+            self.ntiid = getattr(entry, 'ntiid', None)
+
+    def __reduce__(self):
+        raise TypeError()
+
+
+class NodeCourseIndex(ValueIndex):
+    default_field_name = 'ntiid'
+    default_interface = ValidatingNodeCourse
+
+
 @interface.implementer(ICatalog)
 class CourseOutlineCatalog(Catalog):
     pass
@@ -802,7 +1844,9 @@ def create_course_outline_catalog(catalog=None, family=BTrees.family64):
                         (IX_CONTENT_UNIT, NodeContentUnitIndex),
                         (IX_LESSON_OVERVIEW, NodeLessonOverviewIndex),
                         (IX_AVAILABLE_ENDING, NodeAvailableEndingIndex),
-                        (IX_AVAILABLE_BEGINNING, NodeAvailableBeginningIndex)):
+                        (IX_AVAILABLE_BEGINNING, NodeAvailableBeginningIndex),
+                        (IX_SITE, NodeSiteIndex),
+                        (IX_COURSE, NodeCourseIndex)):
         index = clazz(family=family)
         locate(index, catalog, name)
         catalog[name] = index
@@ -851,6 +1895,21 @@ class EnrollmentCountIndex(IntegerAttributeIndex):
     default_field_name = 'count'
     default_interface = ValidatingEnrollmentCount
 
+    def change_enrollment_count(self, doc_id, delta):
+        """
+        Adjust the indexed count of the given course in place, without
+        counting its enrollments. Returns False if the course is not
+        indexed or its count has drifted below zero, in which case its
+        enrollments must be counted.
+        """
+        count = self.documents_to_values.get(doc_id)
+        if count is None or count + delta < 0:
+            return False
+        if delta:
+            # skip the attribute lookup
+            super(AttributeIndex, self).index_doc(doc_id, count + delta)
+        return True
+
 
 @interface.implementer(ICatalog)
 class EnrollmentMetadataCatalog(DeferredCatalog):
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A transaction-bound queue that coalesces the repeated indexing of the
+same documents (e.g. during sync or import) into one index call per
+document at commit time.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+
+from collections import OrderedDict
+
+from contextlib import contextmanager
+
+from weakref import WeakKeyDictionary
+
+import transaction
+
+logger = __import__('logging').getLogger(__name__)
+
+_stats_lock = threading.Lock()
+_stats = {'queued': 0, 'indexed': 0, 'avoided': 0}
+
+
+class TransactionBound(object):
+    """
+    Keeps an instance of a factory for each transaction that asks for one,
+    and calls one of its methods right before that transaction commits.
+    """
+
+    def __init__(self, factory, hook_name):
+        self.factory = factory
+        self.hook_name = hook_name
+        self._lock = threading.Lock()
+        self._data = WeakKeyDictionary()
+
+    def query(self, txn=None):
+        if not self._data:
+            return None
+        txn = transaction.get() if txn is None else txn
+        return self._data.get(txn)
+
+    def get(self, txn=None):
+        txn = transaction.get() if txn is None else txn
+        with self._lock:
+            result = self._data.get(txn)
+            if result is None:
+                result = self._data[txn] = self.factory()
+                txn.addBeforeCommitHook(getattr(result, self.hook_name))
+        return result
+
+    def pop(self, txn=None):
+        """
+        Forget the instance of the given (or current) transaction, if any,
+        and return it. Its hook still runs when the transaction commits.
+        """
+        txn = transaction.get() if txn is None else txn
+        with self._lock:
+            return self._data.pop(txn, None)
+
+
+class IndexQueue(object):
+    """
+    The documents to (re)index when the transaction commits, each with
+    the last object it was indexed with.
+    """
+
+    def __init__(self):
+        self.queued = 0
+        self.avoided = 0
+        self.flushing = False
+        self._pending = OrderedDict()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, catalog, doc_id, obj):
+        """
+        Queue the indexing of the given document, returning False if it
+        must be indexed right away.
+        """
+        if self.flushing:
+            return False
+        key = (id(catalog), doc_id)
+        if key in self._pending:
+            self.avoided += 1
+            del self._pending[key]  # index in the order last seen
+        self.queued += 1
+        self._pending[key] = (catalog, doc_id, obj)
+        return True
+
+    def discard(self, catalog, doc_id):
+        self._pending.pop((id(catalog), doc_id), None)
+
+    def flush(self):
+        """
+        Index the queued documents now.
+        """
+        if self.flushing or not self._pending:
+            return 0
+        self.flushing = True
+        try:
+            count = 0
+            while self._pending:
+                unused_key, (catalog, doc_id, obj) = self._pending.popitem(last=False)
+                catalog.index_doc(doc_id, obj)
+                count += 1
+        finally:
+            self.flushing = False
+        with _stats_lock:
+            _stats['queued'] += self.queued
+            _stats['indexed'] += count
+            _stats['avoided'] += self.avoided
+        logger.debug("Indexed %s queued documents (%s duplicate index calls avoided)",
+                     count, self.avoided)
+        self.queued = self.avoided = 0
+        return count
+
+
+#: transaction -> IndexQueue
+_queues = TransactionBound(IndexQueue, 'flush')
+
+
+def get_index_queue(txn=None):
+    """
+    Return the :class:`IndexQueue` of the given (or current) transaction,
+    or None if indexing is not deferred in it.
+    """
+    return _queues.query(txn)
+
+
+def defer_index_updates(txn=None):
+    """
+    Queue the course catalog index updates made in the given (or current)
+    transaction until it commits. Returns the :class:`IndexQueue`.
+    """
+    return _queues.get(txn)
+
+
+@contextmanager
+def deferred_index_updates():
+    """
+    A context manager that queues the course catalog index updates made
+    inside it, and indexes them (once per document) when it exits, even if
+    it exits with an error. Index updates are applied right away again
+    afterwards. Inside a deferral of the whole transaction, it does nothing.
+    """
+    queue = get_index_queue()
+    if queue is not None:
+        yield queue
+        return
+    queue = defer_index_updates()
+    try:
+        yield queue
+    finally:
+        _queues.pop()
+        queue.flush()
+
+
+def flush_index_updates(txn=None):
+    """
+    Index the queued documents of the given (or current) transaction now,
+    e.g. before querying the catalog for them. Returns the number of
+    documents indexed.
+    """
+    queue = get_index_queue(txn)
+    return queue.flush() if queue is not None else 0
+
+
+@contextmanager
+def immediate_index_updates():
+    """
+    A context manager in which index updates are applied right away,
+    even if they are deferred in the current transaction. The documents
+    already queued are indexed on entry.
+    """
+    queue = get_index_queue()
+    if queue is None or queue.flushing:
+        yield
+        return
+    queue.flush()
+    queue.flushing = True
+    try:
+        yield
+    finally:
+        queue.flushing = False
+
+
+_batches = threading.local()
+
+
+def get_batch_index_queue():
+    """
+    Return the :class:`IndexQueue` of the batch in progress in this thread,
+    if any.
+    """
+    return getattr(_batches, 'queue', None)
+
+
+@contextmanager
+def batch_index_updates():
+    """
+    A context manager that queues the index updates of the catalogs that
+    honor it (the enrollment catalog) made inside it, and indexes them in
+    one pass when it exits, even if it exits with an error. Nested uses
+    share the outermost queue.
+    """
+    queue = get_batch_index_queue()
+    if queue is not None:
+        yield queue
+        return
+    queue = _batches.queue = IndexQueue()
+    try:
+        yield queue
+    finally:
+        _batches.queue = None
+        queue.flush()
+
+
+def get_index_queue_stats():
+    """
+    Return the number of index calls queued, documents indexed and
+    duplicate index calls avoided by the committed queues of this process.
+    """
+    with _stats_lock:
+        return dict(_stats)
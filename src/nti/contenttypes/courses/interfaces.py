@@ -757,6 +757,15 @@ class ICourseCatalog(interface.Interface):
         account.
         """
 
+    def count_entries(include_parents=False):
+        """
+        Return the number of entries in this catalog, not counting those
+        of deleted courses.
+
+        :keyword bool include_parents: If true, count the entries of the
+                site hierarchy as well, as returned by :meth:`iterCatalogEntries`.
+        """
+
     def iterCatalogEntries():
         """
         Iterate across the installed catalog entries.
@@ -1902,6 +1911,44 @@ class ICourseCatalogEntryFilterUtility(interface.Interface):
         Return catalog entries in the given boundaries.
         """
 
+    def faceted_search(filter_strs=None, union=True, sites=None,
+                       exclude_non_public=True, start_terms=(), filter_hidden=True):
+        """
+        Return the set of entry intids matching the given filter strs
+        (all entries in the sites if none) and a dict of facet counts
+        (tags, sites, active, upcoming, archived and start terms) over
+        that set.
+        """
+
+
+class ICourseCatalogSnapshotService(interface.Interface):
+    """
+    A utility that keeps the anonymously externalized entries of the
+    catalog of each site, re-externalizing only the entries that have
+    changed.
+    """
+
+    def snapshot(catalog=None, variant=u'', externalizer=None, predicate=None):
+        """
+        Return a list of the externalized entries of the given catalog
+        (the current one if None), in catalog order. The entries are
+        externalized without an interaction, so this must not stand in
+        for what a given user sees.
+
+        :keyword variant: Distinguishes snapshots of the same catalog
+                built with different externalizers or predicates.
+        :keyword externalizer: A callable returning the external form of
+                an entry.
+        :keyword predicate: If given, only the entries for which it
+                returns true are included.
+        """
+
+    def invalidate(site_name=None):
+        """
+        Mark the snapshots showing the entries of the named site as stale,
+        or discard all snapshots if no site is given.
+        """
+
 # Invitations
 
 
@@ -34,6 +34,8 @@ from nti.base._compat import text_
 
 from nti.containers.containers import CheckingLastModifiedBTreeContainer
 
+from nti.contenttypes.courses.enrollment import get_deferred_enrollment_effects
+
 from nti.contenttypes.courses.interfaces import ENROLLMENT_SCOPE_VOCABULARY
 
 from nti.contenttypes.courses.interfaces import ICourseInstance
@@ -255,6 +257,11 @@ def on_enroll_record_scope_membership(record, unused_event, course=None):
     When you enroll in a course, record your membership in the
     proper scopes, including content access.
     """
+    if course is None:
+        effects = get_deferred_enrollment_effects()
+        if effects is not None:
+            effects.grant(record)
+            return
     course = course or record.CourseInstance
     grant_access_to_course(record.Principal, course, record.Scope)
 
@@ -268,6 +275,11 @@ def on_drop_exit_scope_membership(record, unused_event, course=None):
     When you drop a course, leave the scopes you were in, including
     content access.
     """
+    if course is None:
+        effects = get_deferred_enrollment_effects()
+        if effects is not None:
+            effects.deny(record)
+            return
     course = course or record.CourseInstance
     deny_access_to_course(record.Principal, course, record.Scope)
 
@@ -14,6 +14,7 @@ from zope import component
 from zope import lifecycleevent
 
 from zope.component.hooks import site
+from zope.component.hooks import getSite
 
 from zope.event import notify
 
@@ -28,6 +29,7 @@ from zope.interface.interfaces import IUnregistered
 from zope.lifecycleevent import ObjectModifiedEvent
 
 from zope.lifecycleevent.interfaces import IObjectCreatedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
 from zope.lifecycleevent.interfaces import IObjectRemovedEvent
 
 from nti.assessment.interfaces import IQAssessmentPolicies
@@ -53,6 +55,14 @@ from nti.contenttypes.courses.common import get_course_site_registry
 
 from nti.contenttypes.courses.catalog import CourseCatalogFolder
 
+from nti.contenttypes.courses.catalog_snapshot import invalidate_after_commit
+from nti.contenttypes.courses.catalog_snapshot import get_catalog_snapshot_service
+
+from nti.contenttypes.courses.enrollment import get_enrollment_count_deltas
+
+from nti.contenttypes.courses.indexing import deferred_index_updates
+from nti.contenttypes.courses.indexing import immediate_index_updates
+
 from nti.contenttypes.courses.index import IX_SITE
 from nti.contenttypes.courses.index import IX_COURSE
 from nti.contenttypes.courses.index import IX_USERNAME
@@ -80,6 +90,7 @@ from nti.contenttypes.courses.interfaces import IPersistentCourseCatalog
 from nti.contenttypes.courses.interfaces import CourseBundleUpdatedEvent
 from nti.contenttypes.courses.interfaces import CourseCatalogDidSyncEvent
 from nti.contenttypes.courses.interfaces import ICourseBundleUpdatedEvent
+from nti.contenttypes.courses.interfaces import ICourseCatalogDidSyncEvent
 from nti.contenttypes.courses.interfaces import CourseBundleWillUpdateEvent
 from nti.contenttypes.courses.interfaces import ICourseInstructorAddedEvent
 from nti.contenttypes.courses.interfaces import ICourseBundleWillUpdateEvent
@@ -118,8 +129,6 @@ from nti.externalization.interfaces import IObjectModifiedFromExternalEvent
 from nti.intid.common import addIntId
 from nti.intid.common import removeIntId
 
-from nti.metadata import queue_metadata_modififed
-
 from nti.recorder.utils import record_transaction
 
 from nti.site.localutility import install_utility
@@ -254,13 +263,15 @@ def sync_catalog_when_library_synched(library, event):
 
     synchronizer = component.getMultiAdapter((catalog, courses_bucket),
                                              IObjectEntrySynchronizer)
-    synchronizer.synchronize(catalog,
-                             courses_bucket,
-                             params=params,
-                             results=results)
+    with deferred_index_updates():
+        synchronizer.synchronize(catalog,
+                                 courses_bucket,
+                                 params=params,
+                                 results=results)
 
-    # Course catalog has been synced
-    notify(CourseCatalogDidSyncEvent(catalog, params, results))
+    # Course catalog has been synced, listeners may query it
+    with immediate_index_updates():
+        notify(CourseCatalogDidSyncEvent(catalog, params, results))
 
 
 @component.adapter(ICourseInstance, ICourseRolesSynchronized)
@@ -625,21 +636,62 @@ def _update_sections_on_tag_update(entry, event):
                 notify(ObjectModifiedEvent(section_entry))
             
 
-def _update_enrollment_meta(record):
+def _invalidate_site_catalog_snapshots(site_name):
+    """
+    Invalidate the catalog snapshots of the given site (all of them if
+    None), once the transaction has committed.
+    """
+    service = get_catalog_snapshot_service()
+    if service is not None:
+        invalidate_after_commit(service, site_name or None)
+
+
+@component.adapter(ICourseCatalogEntry, IObjectModifiedEvent)
+def _invalidate_catalog_snapshots(entry, unused_event=None):
+    """
+    Invalidate the catalog snapshots of the site of an entry when it
+    changes.
+    """
+    site_name = get_course_site_name(entry)
+    if site_name:
+        _invalidate_site_catalog_snapshots(site_name)
+
+
+@component.adapter(ICourseInstance, IIntIdAddedEvent)
+def _invalidate_catalog_snapshots_on_course_added(course, unused_event=None):
+    _invalidate_site_catalog_snapshots(get_course_site_name(course))
+
+
+@component.adapter(ICourseInstance, IBeforeIdRemovedEvent)
+def _invalidate_catalog_snapshots_on_course_removed(course, unused_event=None):
+    # if the site of the course is gone, so are all the snapshots
+    _invalidate_site_catalog_snapshots(get_course_site_name(course))
+
+
+@component.adapter(ICourseCatalogDidSyncEvent)
+def _invalidate_catalog_snapshots_on_sync(unused_event):
+    _invalidate_site_catalog_snapshots(getattr(getSite(), '__name__', None))
+
+
+def _update_enrollment_meta(record, delta):
     """
-    On an enrollment added or removed, we want to send our
-    course to update its metadata.
+    On an enrollment added or removed, we want to update the
+    enrollment count of our course. The changes are summed per course
+    and applied in place to the metadata catalog when the transaction
+    commits, rather than queueing the course to be counted again.
     We do not want to just notify cause that may cause conflicts
     on the in process catalog.
     """
-    queue_metadata_modififed(record.CourseInstance)
+    course = record.CourseInstance
+    if course is not None:
+        get_enrollment_count_deltas().add(course, delta)
 
 
 @component.adapter(ICourseInstanceEnrollmentRecord, IObjectCreatedEvent)
 def _update_meta_on_enrollment_created(record, unused_event):
-    _update_enrollment_meta(record)
+    _update_enrollment_meta(record, 1)
 
 
 @component.adapter(ICourseInstanceEnrollmentRecord, IObjectRemovedEvent)
 def _update_meta_on_enrollment_removed(record, unused_event):
-    _update_enrollment_meta(record)
+    _update_enrollment_meta(record, -1)
@@ -10,10 +10,13 @@ from __future__ import absolute_import
 
 from hamcrest import is_
 from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
 from hamcrest import is_not
 from hamcrest import equal_to
 from hamcrest import not_none
 from hamcrest import has_items
+from hamcrest import has_length
 from hamcrest import has_entries
 from hamcrest import assert_that
 from hamcrest import has_property
@@ -22,21 +25,42 @@ does_not = is_not
 from nti.testing.matchers import validly_provides
 from nti.testing.matchers import verifiably_provides
 
+import fudge
+
 import isodate
 
+import BTrees
+
 from Persistence import Persistent
 
+from zope import component
+
+from zope.catalog.attribute import AttributeIndex
+
+from zope.intid.interfaces import IIntIds
+
 from zope.location.interfaces import ILocation
 
+from nti.contenttypes.courses.catalog import _LookupCache
 from nti.contenttypes.courses.catalog import CourseCatalogEntry
 from nti.contenttypes.courses.catalog import CourseCatalogFolder
 from nti.contenttypes.courses.catalog import GlobalCourseCatalog
 
 from nti.contenttypes.courses.courses import CourseSeatLimit
+from nti.contenttypes.courses.courses import CourseSeatCounter
 from nti.contenttypes.courses.courses import ContentCourseInstance
 from nti.contenttypes.courses.courses import ContentCourseSubInstance
 from nti.contenttypes.courses.courses import CourseAdministrativeLevel
 
+from nti.contenttypes.courses.enrollment import migrate_enrollments_from_course_to_course
+
+from nti.contenttypes.courses.index import IX_SITE
+from nti.contenttypes.courses.index import IX_ENTRY
+from nti.contenttypes.courses.index import IX_TOPICS
+from nti.contenttypes.courses.index import TP_DELETED_COURSES
+from nti.contenttypes.courses.index import CourseSiteIndex
+from nti.contenttypes.courses.index import CourseCatalogEntryIndex
+
 from nti.contenttypes.courses.legacy_catalog import CourseCatalogLegacyEntry
 from nti.contenttypes.courses.legacy_catalog import _CourseSubInstanceCatalogLegacyEntry
 
@@ -44,13 +68,17 @@ from nti.contenttypes.courses.interfaces import ICourseCatalog
 from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
 from nti.contenttypes.courses.interfaces import IGlobalCourseCatalog
 from nti.contenttypes.courses.interfaces import ICourseEnrollmentManager
+from nti.contenttypes.courses.interfaces import CourseSeatLimitReachedException
 
 from nti.contenttypes.courses.utils import _used_seats
 from nti.contenttypes.courses.utils import can_user_enroll
+from nti.contenttypes.courses.utils import reconcile_course_seats
 
 from nti.contenttypes.courses.tests import MockPrincipal
 from nti.contenttypes.courses.tests import CourseLayerTest
 
+from ZODB.POSException import ConflictError
+
 from nti.dataserver.tests.mock_dataserver import WithMockDSTrans
 
 from nti.externalization.externalization import to_external_object
@@ -242,6 +270,142 @@ class TestCatalog(CourseLayerTest):
                                                 'max_seats', 10,
                                                 'used_seats', 0))
         
+    @WithMockDSTrans
+    def test_seat_reservation(self):
+        prin1 = MockPrincipal()
+        self.ds.root[prin1.id] = prin1
+        prin2 = MockPrincipal()
+        prin2.id = prin2.username = u'OtherPrincipal'
+        self.ds.root[prin2.id] = prin2
+        admin = CourseAdministrativeLevel()
+        self.ds.root[u'admin'] = admin
+
+        course = ContentCourseInstance()
+        admin['course'] = course
+        manager = ICourseEnrollmentManager(course)
+        entry = ICourseCatalogEntry(course)
+        entry.seat_limit = seat_limit = CourseSeatLimit()
+        seat_limit.max_seats = 1
+
+        manager.enroll(prin1)
+        assert_that(seat_limit.reserved_seats(course), is_(1))
+        assert_that(calling(manager.enroll).with_args(prin2),
+                    raises(CourseSeatLimitReachedException))
+        assert_that(seat_limit.reserved_seats(course), is_(1))
+
+        manager.drop(prin1)
+        assert_that(seat_limit.reserved_seats(course), is_(0))
+        manager.enroll(prin2)
+        assert_that(seat_limit.reserved_seats(course), is_(1))
+
+        # Drifted counters are brought back in line
+        seat_limit._seat_counter(course).set(5)
+        assert_that(reconcile_course_seats(course), is_((5, 1)))
+        assert_that(reconcile_course_seats(course), is_((1, 1)))
+        assert_that(_used_seats(seat_limit), is_(1))
+        assert_that(can_user_enroll(seat_limit), is_(False))
+
+        # Moved records take their seats along
+        course2 = ContentCourseInstance()
+        admin['course2'] = course2
+        entry2 = ICourseCatalogEntry(course2)
+        entry2.seat_limit = seat_limit2 = CourseSeatLimit()
+        seat_limit2.max_seats = 5
+        ICourseEnrollmentManager(course2).enroll(prin1)
+        assert_that(seat_limit2.reserved_seats(course2), is_(1))
+        migrate_enrollments_from_course_to_course(course, course2)
+        assert_that(seat_limit.reserved_seats(course), is_(0))
+        assert_that(seat_limit2.reserved_seats(course2), is_(2))
+        assert_that(_used_seats(seat_limit2), is_(2))
+
+        # Concurrent reservations cannot exceed the limit
+        counter = CourseSeatCounter()
+        assert_that(calling(counter._p_resolveConflict).with_args({'value': 0, 'limit': 1},
+                                                                  {'value': 1, 'limit': 1},
+                                                                  {'value': 1, 'limit': 1}),
+                    raises(ConflictError))
+        # but releases are merged
+        state = counter._p_resolveConflict({'value': 2, 'limit': 2},
+                                           {'value': 1, 'limit': 2},
+                                           {'value': 1, 'limit': 2})
+        assert_that(state, has_entries('value', 0))
+
+    @fudge.patch('nti.contenttypes.courses.catalog.get_courses_catalog')
+    def test_folder_count_entries(self, mock_get_catalog):
+        site_index = CourseSiteIndex()
+        entry_index = CourseCatalogEntryIndex()
+        # courses 1-3 and their entries 11-13 (course 3 is deleted)
+        for doc_id, ntiid in ((1, u'a'), (2, u'b'), (3, u'c')):
+            super(AttributeIndex, site_index).index_doc(doc_id, u'alpha')
+            super(AttributeIndex, site_index).index_doc(doc_id + 10, u'alpha')
+            super(AttributeIndex, entry_index).index_doc(doc_id, ntiid)
+        super(AttributeIndex, site_index).index_doc(4, u'beta')
+        super(AttributeIndex, entry_index).index_doc(4, u'd')
+
+        class Extent(object):
+            def getExtent(self):
+                return BTrees.family64.IF.Set((3,))
+
+        catalog = {IX_SITE: site_index,
+                   IX_ENTRY: entry_index,
+                   IX_TOPICS: {TP_DELETED_COURSES: Extent()}}
+        mock_get_catalog.is_callable().returns(catalog)
+        # counts of the courses that are not deleted
+        site_index.rebuild_counts((1, 2, 4))
+
+        class Site(object):
+            def __init__(self, name):
+                self.__name__ = name
+
+        class Folder(CourseCatalogFolder):
+            _catalog_site = Site(u'alpha')
+            _next_catalog = None
+
+        class IntIds(object):
+            courses = {x: ContentCourseInstance() for x in (1, 2, 3, 4)}
+
+            def queryObject(self, doc_id, default=None):
+                return self.courses.get(doc_id, default)
+
+        intids = IntIds()
+        gsm = component.getGlobalSiteManager()
+        registered = gsm.queryUtility(IIntIds)
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            folder = Folder()
+            # like the baseline, the iteration includes deleted courses
+            entries = list(folder.iterCatalogEntries())
+            assert_that(entries, has_length(3))
+            # but the counts do not
+            assert_that(folder.count_entries(), is_(2))
+            assert_that(folder.count_entries(True), is_(2))
+            assert_that(folder.isEmpty(), is_(False))
+
+            # without counts, the site documents are walked
+            site_index._site_counts = None
+            assert_that(folder.count_entries(), is_(2))
+
+            Folder._catalog_site = Site(u'gamma')
+            assert_that(folder.count_entries(), is_(0))
+            assert_that(folder.isEmpty(), is_(True))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+            if registered is not None:
+                gsm.registerUtility(registered, IIntIds)
+
+    def test_lookup_cache(self):
+        cache = _LookupCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert_that(cache.get('a'), is_(1))
+        # 'b' is the least recently used
+        cache.set('c', 3)
+        assert_that(cache.get('b'), is_(none()))
+        assert_that(cache.get('a'), is_(1))
+        assert_that(cache.get('c'), is_(3))
+        cache.clear()
+        assert_that(cache.get('a'), is_(none()))
+
     def test_entry_acquisition(self):
         """
         Validate our class hierarchy properly gets Persistence.Persistence
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import assert_that
+
+import shutil
+import tempfile
+
+import transaction
+
+from zope.security.management import newInteraction
+from zope.security.management import endInteraction
+from zope.security.management import queryInteraction
+
+from nti.contenttypes.courses.catalog_snapshot import invalidate_after_commit
+from nti.contenttypes.courses.catalog_snapshot import FileCatalogSnapshotStore
+from nti.contenttypes.courses.catalog_snapshot import MemoryCatalogSnapshotStore
+from nti.contenttypes.courses.catalog_snapshot import CourseCatalogSnapshotService
+
+from nti.contenttypes.courses.tests import CourseLayerTest
+
+
+class _Entry(object):
+
+    def __init__(self, ntiid, lastModified):
+        self.ntiid = ntiid
+        self.lastModified = lastModified
+
+
+class _Catalog(object):
+
+    lastModified = 0
+
+    def __init__(self, *entries):
+        self.entries = list(entries)
+
+    def iterCatalogEntries(self):
+        return iter(self.entries)
+
+
+class TestCatalogSnapshot(CourseLayerTest):
+
+    def _check_service(self, service):
+        externalized = []
+
+        def externalizer(entry):
+            externalized.append(entry.ntiid)
+            return {u'NTIID': entry.ntiid, u'Last Modified': entry.lastModified}
+
+        entry1 = _Entry(u'a', 1)
+        entry2 = _Entry(u'b', 1)
+        catalog = _Catalog(entry1, entry2)
+        result = service.snapshot(catalog, externalizer=externalizer)
+        assert_that([x[u'NTIID'] for x in result], is_([u'a', u'b']))
+        assert_that(externalized, is_([u'a', u'b']))
+
+        # served as is while fresh
+        entry2.lastModified = 2
+        service.snapshot(catalog, externalizer=externalizer)
+        assert_that(externalized, is_([u'a', u'b']))
+
+        # invalidating another site does not matter
+        service.invalidate(u'other')
+        service.snapshot(catalog, externalizer=externalizer)
+        assert_that(externalized, is_([u'a', u'b']))
+
+        # only the modified entry is externalized again
+        service.invalidate(u'')
+        result = service.snapshot(catalog, externalizer=externalizer)
+        assert_that(externalized, is_([u'a', u'b', u'b']))
+        assert_that(result[1][u'Last Modified'], is_(2))
+
+        # after the time limit, if any
+        entry1.lastModified = 2
+        service.max_age = 0
+        service.snapshot(catalog, externalizer=externalizer)
+        assert_that(externalized, is_([u'a', u'b', u'b', u'a']))
+        service.max_age = None
+
+        # variants are kept apart
+        result = service.snapshot(catalog, variant=u'public',
+                                  externalizer=externalizer,
+                                  predicate=lambda x: x.ntiid == u'a')
+        assert_that([x[u'NTIID'] for x in result], is_([u'a']))
+
+        service.invalidate()
+        service.snapshot(catalog, externalizer=externalizer)
+        assert_that(externalized,
+                    is_([u'a', u'b', u'b', u'a', u'a', u'a', u'b']))
+
+    def test_anonymous(self):
+        interactions = []
+
+        def externalizer(entry):
+            interactions.append(queryInteraction())
+            return {u'NTIID': entry.ntiid}
+
+        service = CourseCatalogSnapshotService(MemoryCatalogSnapshotStore())
+        newInteraction()
+        try:
+            interaction = queryInteraction()
+            service.snapshot(_Catalog(_Entry(u'a', 1)),
+                             externalizer=externalizer)
+            assert_that(interactions, is_([None]))
+            assert_that(queryInteraction(), is_(interaction))
+        finally:
+            endInteraction()
+
+    def test_invalidate_after_commit(self):
+        store = MemoryCatalogSnapshotStore()
+        service = CourseCatalogSnapshotService(store)
+
+        transaction.begin()
+        invalidate_after_commit(service, u'bleach.org')
+        transaction.abort()
+        assert_that(store.generation(u'bleach.org'), is_(none()))
+
+        transaction.begin()
+        invalidate_after_commit(service, u'bleach.org')
+        invalidate_after_commit(service, u'bleach.org')
+        assert_that(store.generation(u'bleach.org'), is_(none()))
+        transaction.commit()
+        assert_that(store.generation(u'bleach.org'), is_(1))
+
+    def test_memory_store(self):
+        store = MemoryCatalogSnapshotStore()
+        self._check_service(CourseCatalogSnapshotService(store))
+        # the stored snapshots cannot be changed by callers
+        snapshot = {u'ntiids': [u'a']}
+        store.set((u'', u'xyz'), snapshot)
+        snapshot[u'ntiids'].append(u'b')
+        store.get((u'', u'xyz'))[u'ntiids'].append(u'c')
+        assert_that(store.get((u'', u'xyz')), is_({u'ntiids': [u'a']}))
+
+    def test_file_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = FileCatalogSnapshotStore(directory)
+            self._check_service(CourseCatalogSnapshotService(store))
+            assert_that(store.get((u'', u'xyz')), is_(None))
+            store.set((u'', u'xyz'), {u'entries': object()})
+            assert_that(store.get((u'', u'xyz')), is_(None))
+            generation = store.generation(u'')
+            assert_that(generation, is_(none()))
+            store.bump(u'')
+            generation = store.generation(u'')
+            store.bump(u'')
+            assert_that(store.generation(u''), is_not(generation))
+        finally:
+            shutil.rmtree(directory, True)
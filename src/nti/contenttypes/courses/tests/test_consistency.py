@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import fudge
+
+from zope import component
+
+from zope.component.hooks import getSite
+
+from zope.intid.interfaces import IIntIds
+
+from nti.contenttypes.courses.catalog import CourseCatalogEntry
+
+from nti.contenttypes.courses.consistency import _UNKNOWN
+from nti.contenttypes.courses.consistency import check_catalog
+from nti.contenttypes.courses.consistency import repair_catalog
+from nti.contenttypes.courses.consistency import get_index_value
+from nti.contenttypes.courses.consistency import CatalogCheckReport
+from nti.contenttypes.courses.consistency import check_and_repair_sites
+
+from nti.contenttypes.courses.courses import ContentCourseInstance
+
+from nti.contenttypes.courses.index import ENROLLMENT_CATALOG_NAME
+
+from nti.contenttypes.courses.index import CourseTagCountIndex
+from nti.contenttypes.courses.index import CourseEntrySubstringIndex
+from nti.contenttypes.courses.index import CourseCatalogEntryPreviewIndex
+
+from nti.contenttypes.courses.index import get_enrollment_catalog
+from nti.contenttypes.courses.index import install_enrollment_catalog
+
+from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
+from nti.contenttypes.courses.interfaces import ICourseEnrollmentManager
+
+from nti.contenttypes.courses.utils import index_course_roles
+from nti.contenttypes.courses.utils import get_instructed_courses
+
+from nti.contenttypes.courses.tests import CourseLayerTest
+
+from nti.dataserver.tests.mock_dataserver import WithMockDSTrans
+
+from nti.dataserver.users import User
+
+from nti.intid.common import addIntId
+
+
+class TestConsistency(CourseLayerTest):
+
+    def test_index_value(self):
+        entry = CourseCatalogEntry()
+        entry.title = u'Chemistry'
+        entry.tags = (u'lab',)
+        entry.Preview = True
+        for factory in (CourseTagCountIndex,
+                        CourseEntrySubstringIndex,
+                        CourseCatalogEntryPreviewIndex):
+            live = factory()
+            scratch = factory()
+            scratch.index_doc(1, entry)
+            expected = get_index_value(scratch, 1)
+            assert_that(expected, is_not(_UNKNOWN))
+            assert_that(expected, is_not(get_index_value(live, 1)))
+            live.index_doc(1, entry)
+            assert_that(get_index_value(live, 1), is_(expected))
+        assert_that(get_index_value(object(), 1), is_(_UNKNOWN))
+
+    def test_report(self):
+        report = CatalogCheckReport(u'catalog')
+        report.missing.add(1)
+        report.changed[2] = ['site']
+        report.stale.update((3, 4))
+        assert_that(report.drift, is_(4))
+        assert_that(repr(report),
+                    is_('<CatalogCheckReport catalog checked=0 missing=1 changed=1 stale=2>'))
+
+    def test_check_and_repair_sites(self):
+        def worker(site_name):
+            return {u'catalog': len(site_name)}
+        assert_that(check_and_repair_sites((u'a', u'bb'), worker),
+                    is_({u'catalog': 3}))
+        # other processes need a worker with its own connection
+        assert_that(calling(check_and_repair_sites).with_args((u'a',),
+                                                              processes=2),
+                    raises(ValueError))
+
+    def _add_course(self, ds_folder, name, instructors=()):
+        course = ContentCourseInstance()
+        entry = ICourseCatalogEntry(course)
+        entry.title = name
+        entry.ntiid = u'tag:nextthought.com,2011-10:NTI-CourseInfo-%s' % name
+        ds_folder._p_jar.add(course)
+        addIntId(course)
+        course.instructors = instructors
+        return course
+
+    @WithMockDSTrans
+    @fudge.patch('nti.contenttypes.courses.consistency.get_all_host_sites',
+                 'nti.contenttypes.courses.consistency.iter_site_courses')
+    def test_check_and_repair_enrollment_catalog(self, mock_sites, mock_courses):
+        ds_folder = self.ds.dataserver_folder
+        install_enrollment_catalog(ds_folder)
+        intids = component.getUtility(IIntIds)
+        catalog = get_enrollment_catalog()
+
+        instructor = User.create_user(username=u'ichigo')
+        student = User.create_user(username=u'rukia')
+        course = self._add_course(ds_folder, u'course1', (instructor,))
+        gone = self._add_course(ds_folder, u'course2', (instructor,))
+        index_course_roles(course, catalog=catalog, intids=intids)
+        record = ICourseEnrollmentManager(course).enroll(student)
+        catalog.index_doc(intids.getId(record), record)
+
+        mock_sites.is_callable().returns((getSite(),))
+        mock_courses.is_callable().calls(lambda unused_site: iter((course,)))
+
+        # The course role docs are walked, not reported stale
+        report = check_catalog(ENROLLMENT_CATALOG_NAME)
+        assert_that(report.checked, is_(2))
+        assert_that(report.drift, is_(0))
+
+        # drift
+        substitute = User.create_user(username=u'renji')
+        course.instructors = (substitute,)
+        catalog.unindex_doc(intids.getId(record))
+        index_course_roles(gone, catalog=catalog, intids=intids)
+
+        report = check_catalog(ENROLLMENT_CATALOG_NAME)
+        assert_that(report.missing, is_({intids.getId(record)}))
+        assert_that(report.changed, has_length(1))
+        assert_that(report.records, has_length(1))
+        assert_that(report.stale, is_({intids.getId(gone)}))
+
+        assert_that(repair_catalog(report, intids=intids), is_(3))
+        assert_that(check_catalog(ENROLLMENT_CATALOG_NAME).drift, is_(0))
+        assert_that(get_instructed_courses(substitute), contains(course))
+        assert_that(get_instructed_courses(instructor), has_length(0))
@@ -20,6 +20,7 @@ from hamcrest import has_item
 from hamcrest import not_none
 from hamcrest import has_entry
 from hamcrest import has_length
+from hamcrest import has_entries
 from hamcrest import assert_that
 from hamcrest import has_property
 from hamcrest import same_instance
@@ -28,20 +29,30 @@ from nti.testing.matchers import is_empty
 from nti.testing.matchers import is_false
 from nti.testing.matchers import validly_provides
 
+import fudge
+
 import unittest
 
+import transaction
+
 from zope import component
 from zope import interface
 from zope import lifecycleevent
 
 from zope.dublincore.interfaces import IWriteZopeDublinCore
 
+from zope.intid.interfaces import IIntIds
+
 from zope.schema.interfaces import ConstraintNotSatisfied
 
 from nti.contenttypes.courses import courses
 from nti.contenttypes.courses import enrollment
 from nti.contenttypes.courses import interfaces
 
+from nti.contenttypes.courses.index import IX_SCOPE
+from nti.contenttypes.courses.index import EnrollmentCountIndex
+from nti.contenttypes.courses.index import get_enrollment_catalog
+
 from nti.contenttypes.courses.tests import CourseLayerTest
 
 from nti.dataserver.tests.mock_dataserver import WithMockDSTrans
@@ -89,6 +100,8 @@ from nti.contenttypes.courses.interfaces import ENROLLMENT_LINEAGE_MAP
 
 from nti.contenttypes.courses.interfaces import ICourseInstance
 from nti.contenttypes.courses.interfaces import ICourseEnrollments
+from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
+from nti.contenttypes.courses.interfaces import CourseSeatLimitReachedException
 from nti.contenttypes.courses.interfaces import ICourseInstanceVendorInfo
 from nti.contenttypes.courses.interfaces import IEnrollmentMappedCourseInstance
 
@@ -309,6 +322,7 @@ class TestFunctionalEnrollment(CourseLayerTest):
         assert_that(pin, is_(enrollment.DefaultPrincipalEnrollments))
 
         assert_that(list(pin.iter_enrollments()), contains(record))
+        assert_that(pin.count_enrollments(), is_(1))
 
         # ... plus the scope memberships
         public_scope = course.SharingScopes['Public']
@@ -534,3 +548,246 @@ class TestFunctionalEnrollment(CourseLayerTest):
         self._do_test_add_drop(self.principal, self.course, enroll_scope=ES_CREDIT, extra_enroll_test=verify_credit)
 
 
+    @WithMockDSTrans
+    def test_scope_counts(self):
+        self._shared_setup()
+
+        manager = interfaces.ICourseEnrollmentManager(self.course)
+        record = manager.enroll(self.principal, scope=ES_PUBLIC)
+
+        storage = interfaces.IDefaultCourseInstanceEnrollmentStorage(self.course)
+        assert_that(storage.count_scope(ES_PUBLIC), is_(1))
+        assert_that(storage.count_scope(ES_CREDIT), is_(0))
+
+        # Changing the scope moves the count
+        record.Scope = ES_CREDIT
+        assert_that(storage.count_scope(ES_PUBLIC), is_(0))
+        assert_that(storage.count_scope(ES_CREDIT), is_(1))
+
+        enrollments = ICourseEnrollments(self.course)
+        assert_that(enrollments.count_scope_enrollments(ES_CREDIT), is_(1))
+
+        # Nothing has drifted
+        assert_that(storage.rebuild_scope_counts(), is_empty())
+
+        # Drifted counters are repaired
+        storage._scope_counts[ES_PUBLIC].change(3)
+        assert_that(storage.rebuild_scope_counts(),
+                    has_entry(ES_PUBLIC, is_((3, 0))))
+        assert_that(storage.count_scope(ES_PUBLIC), is_(0))
+
+        # Storages without counters count each change once
+        del storage._scope_counts
+        record.Scope = ES_PUBLIC
+        assert_that(storage.count_scope(ES_PUBLIC), is_(1))
+        assert_that(storage.count_scope(ES_CREDIT), is_(0))
+
+        # Records without a principal are not counted
+        storage._orphans = (self.principal.id.lower(),)
+        assert_that(storage.count_scope(ES_PUBLIC), is_(0))
+        del storage._orphans
+
+        del storage._scope_counts
+        manager.drop(self.principal)
+        assert_that(storage.count_scope(ES_PUBLIC), is_(0))
+
+        # Records added without a principal are remembered as they come
+        orphan = enrollment.DefaultCourseInstanceEnrollmentRecord(Scope=ES_PUBLIC)
+        storage._setitemf(u'Orphan', orphan)
+        assert_that(list(storage._orphans), is_([u'orphan']))
+        assert_that(storage.count_scope(ES_PUBLIC), is_(0))
+
+    @WithMockDSTrans
+    def test_enroll_drop_many(self):
+        self._shared_setup()
+        principal = self.principal
+        manager = interfaces.ICourseEnrollmentManager(self.course)
+
+        records = manager.enroll_many([principal, principal], scope=ES_CREDIT)
+        assert_that(records, has_length(1))
+        self._check_enrolled(records[0], principal, self.course)
+        assert_that(enrollment.get_deferred_enrollment_effects(), is_(none()))
+
+        credit = self.course.SharingScopes[ES_CREDIT]
+        assert_that(principal, is_in(credit))
+
+        records = manager.drop_many([principal])
+        assert_that(records, has_length(1))
+        assert_that(principal, is_not(is_in(credit)))
+        self._check_not_enrolled(principal, self.course)
+
+    @WithMockDSTrans
+    def test_enroll_many_seat_limit(self):
+        self._shared_setup()
+        principal = self.principal
+        other = MockPrincipal()
+        other.id = other.username = u'OtherPrincipal'
+        self.ds.root[other.id] = other
+        entry = ICourseCatalogEntry(self.course)
+        entry.seat_limit = seat_limit = courses.CourseSeatLimit()
+        seat_limit.max_seats = 1
+
+        manager = interfaces.ICourseEnrollmentManager(self.course)
+        assert_that(calling(manager.enroll_many).with_args([principal, other]),
+                    raises(CourseSeatLimitReachedException))
+        assert_that(enrollment.get_deferred_enrollment_effects(), is_(none()))
+
+        # the record created before the limit was reached is complete
+        record = ICourseEnrollments(self.course).get_enrollment_for_principal(principal)
+        assert_that(record, not_none())
+        assert_that(principal, is_in(self.course.SharingScopes[ES_PUBLIC]))
+        doc_id = component.getUtility(IIntIds).getId(record)
+        scope_index = get_enrollment_catalog()[IX_SCOPE]
+        assert_that(scope_index.documents_to_values.get(doc_id),
+                    contains(ES_PUBLIC))
+
+    @WithMockDSTrans
+    @fudge.patch('nti.contenttypes.courses.enrollment.queue_metadata_modififed')
+    def test_enrollment_count_at_commit(self, mock_queue):
+        self._shared_setup()
+        queued = []
+        mock_queue.is_callable().calls(queued.append)
+        principal = self.principal
+        interfaces.ICourseEnrollmentManager(self.course).enroll(principal)
+        manager = interfaces.ICourseEnrollmentManager(self.course2)
+        manager.enroll(principal)
+        manager.drop(principal)
+        assert_that(queued, is_([]))
+
+        # what commit does
+        for hook, args, kwargs in transaction.get().getBeforeCommitHooks():
+            hook(*args, **kwargs)
+        # not indexed yet, so the course is queued once to be counted
+        assert_that(queued, is_([self.course]))
+
+        # the metadata processor then counts it
+        index = EnrollmentCountIndex()
+        index.index_doc(1, self.course)
+        assert_that(index.documents_to_values.get(1), is_(1))
+
+    def test_deferred_effects_netted(self):
+        class Record(object):
+            def __init__(self, principal, course, scope):
+                self.Principal = principal
+                self.CourseInstance = course
+                self.Scope = scope
+
+        course = object()
+        principal = MockPrincipal()
+        other = MockPrincipal()
+        other.id = other.username = u'OtherPrincipal'
+        effects = enrollment.DeferredEnrollmentEffects()
+        # enrolled and then dropped
+        effects.grant(Record(principal, course, ES_PUBLIC))
+        effects.deny(Record(principal, course, ES_PUBLIC))
+        # dropped, then enrolled in another scope
+        effects.deny(Record(other, course, ES_CREDIT))
+        effects.grant(Record(other, course, ES_PUBLIC))
+        denials, grants = effects._netted()
+        assert_that(denials, is_([(principal, course, ES_PUBLIC),
+                                  (other, course, ES_CREDIT)]))
+        assert_that(grants, is_([(course, [(other, ES_PUBLIC)])]))
+
+        # dropped last wins over an earlier grant in another scope
+        effects = enrollment.DeferredEnrollmentEffects()
+        effects.grant(Record(principal, course, ES_PUBLIC))
+        effects.deny(Record(principal, course, ES_CREDIT))
+        denials, grants = effects._netted()
+        assert_that(denials, is_([(principal, course, ES_CREDIT)]))
+        assert_that(grants, is_([]))
+
+    @WithMockDSTrans
+    def test_migrate_enrollments_chunked(self):
+        self._shared_setup()
+        principal = self.principal
+        other = MockPrincipal()
+        other.id = other.username = u'OtherPrincipal'
+        self.ds.root[other.id] = other
+        interface.alsoProvides(other, IUser)
+
+        manager = interfaces.ICourseEnrollmentManager(self.course)
+        manager.enroll(principal, scope=ES_CREDIT)
+        manager.enroll(other)
+
+        commits = []
+        def commit():
+            commits.append(enrollment.get_migration_checkpoint(self.course,
+                                                               self.course2))
+
+        count = enrollment.migrate_enrollments_from_course_to_course(self.course,
+                                                                     self.course2,
+                                                                     batch_size=1,
+                                                                     commit=commit)
+        assert_that(count, is_(2))
+        # one commit per chunk, then one to clear the checkpoint
+        assert_that(commits, has_length(3))
+        assert_that(commits[-1], is_(none()))
+        assert_that(ICourseEnrollments(self.course).count_enrollments(), is_(0))
+        assert_that(ICourseEnrollments(self.course2).count_enrollments(), is_(2))
+
+        credit = self.course2.SharingScopes[ES_CREDIT]
+        assert_that(principal, is_in(credit))
+
+    @WithMockDSTrans
+    def test_migrate_enrollments_resumed(self):
+        self._shared_setup()
+        principal = self.principal
+        other = MockPrincipal()
+        other.id = other.username = u'aizen'
+        self.ds.root[other.id] = other
+        interface.alsoProvides(other, IUser)
+
+        manager = interfaces.ICourseEnrollmentManager(self.course)
+        manager.enroll(principal)
+        manager.enroll(other)
+
+        # interrupted after the first chunk, in case insensitive order
+        storage = interfaces.IDefaultCourseInstanceEnrollmentStorage(self.course)
+        enrollment._set_migration_checkpoint(storage, self.course2, u'aizen')
+        result = []
+        count = enrollment.migrate_enrollments_from_course_to_course(self.course,
+                                                                     self.course2,
+                                                                     result=result,
+                                                                     batch_size=1)
+        assert_that(count, is_(1))
+        assert_that(result, is_([principal.id]))
+        assert_that(enrollment.get_migration_checkpoint(self.course,
+                                                        self.course2),
+                    is_(none()))
+
+    @WithMockDSTrans
+    def test_section_seat_table(self):
+        self._shared_setup()
+        other = MockPrincipal()
+        other.id = other.username = u'OtherPrincipal'
+        self.ds.root[other.id] = other
+        interface.alsoProvides(other, IUser)
+
+        section2 = self.course.SubInstances[u'section2'] = courses.ContentCourseSubInstance()
+        vendor_info = ICourseInstanceVendorInfo(self.course)
+        vendor_info.setdefault('NTI', dict()).setdefault('EnrollmentMap', {})
+        vendor_info['NTI']['EnrollmentMap'][ES_CREDIT_NONDEGREE] = {'section1': 1,
+                                                                    'section2': 5}
+        interface.alsoProvides(self.course, IEnrollmentMappedCourseInstance)
+
+        manager = interfaces.ICourseEnrollmentManager(self.course)
+        record = manager.enroll(self.principal, scope=ES_CREDIT_NONDEGREE)
+        assert_that(record.CourseInstance, is_(self.section))
+
+        table = enrollment.get_section_seat_table(self.course)
+        assert_that(table.seats(),
+                    has_entry(ES_CREDIT_NONDEGREE,
+                              has_entries('section1', (1, 1),
+                                          'section2', (0, 5))))
+
+        # the first section is full
+        record = manager.enroll(other, scope=ES_CREDIT_NONDEGREE)
+        assert_that(record.CourseInstance, is_(section2))
+        assert_that(table.find_section(ES_CREDIT_NONDEGREE), is_(u'section2'))
+
+        interfaces.ICourseEnrollmentManager(self.section).drop(self.principal)
+        assert_that(table.seats(),
+                    has_entry(ES_CREDIT_NONDEGREE,
+                              has_entries('section1', (0, 1),
+                                          'section2', (1, 5))))
+        assert_that(table.find_section(ES_CREDIT_NONDEGREE), is_(u'section1'))
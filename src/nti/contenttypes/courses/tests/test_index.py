@@ -1,17 +1,72 @@
 import fudge
 
+import BTrees
+
 from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_key
 from hamcrest import assert_that
 from hamcrest import has_length
 from hamcrest import has_items
 
+from datetime import datetime
+from datetime import timedelta
+
+from zope import component
+from zope import interface
+
+from zope.catalog.attribute import AttributeIndex
+
+from zope.intid.interfaces import IIntIds
+
+from nti.contenttypes.courses.catalog import CourseCatalogEntry
+
 from nti.contenttypes.courses.courses import ContentCourseInstance
+from nti.contenttypes.courses.courses import ContentCourseSubInstance
+
+from nti.contenttypes.courses.legacy_catalog import CourseCatalogLegacyEntry
+
+from nti.contenttypes.courses.index import IX_COURSE
+from nti.contenttypes.courses.index import IX_ENROLLMENT_COUNT
 
 from nti.contenttypes.courses.index import InstructorSetIndex
+from nti.contenttypes.courses.index import IndexRecord
+from nti.contenttypes.courses.index import InternTable
+from nti.contenttypes.courses.index import _iter_index_items
+from nti.contenttypes.courses.index import CoursesCatalog
+from nti.contenttypes.courses.index import EnrollmentCountIndex
+from nti.contenttypes.courses.index import InternedUsernameIndex
+from nti.contenttypes.courses.index import InternedSingleSiteIndex
+from nti.contenttypes.courses.index import apply_query
+from nti.contenttypes.courses.index import get_index_doc_ids
+from nti.contenttypes.courses.index import get_query_timings
+from nti.contenttypes.courses.index import sort_doc_ids_by_index
+from nti.contenttypes.courses.index import estimate_query_size
+from nti.contenttypes.courses.index import CourseSiteIndex
+from nti.contenttypes.courses.index import CourseTagCountIndex
+from nti.contenttypes.courses.index import CourseEntrySubstringIndex
 from nti.contenttypes.courses.index import EditorSetIndex
+from nti.contenttypes.courses.index import CourseCatalogEntryPreviewIndex
+from nti.contenttypes.courses.index import create_course_outline_catalog
+
+from nti.contenttypes.courses.enrollment import EnrollmentCountDeltas
+
+from nti.contenttypes.courses.interfaces import IDeletedCourse
+from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
+
+from nti.contenttypes.courses.outlines import CourseOutlineContentNode
+
+from nti.contenttypes.courses.utils import get_site_outline_nodes_opening
+from nti.contenttypes.courses.utils import get_course_outline_nodes_opening
+from nti.contenttypes.courses.utils import get_outline_node_intids_by_dates
 
 from nti.contenttypes.courses.tests import CourseLayerTest
 
+from nti.dataserver.tests.mock_dataserver import WithMockDSTrans
+
+from nti.intid.common import addIntId
+
 
 class TestIndex(CourseLayerTest):
 
@@ -90,3 +145,355 @@ class TestIndex(CourseLayerTest):
         assert_that(list(index.ids()), has_items(1, 2))
         assert_that(list(index.values()), has_length(2))
         assert_that(list(index.values()), has_items('test001', 'test002'))
+
+    def testEntryPreviewIndex(self):
+        index = CourseCatalogEntryPreviewIndex()
+
+        # derived from the start date, not indexed
+        entry = CourseCatalogLegacyEntry()
+        entry.StartDate = datetime.utcnow() + timedelta(days=1)
+        index.index_doc(1, entry)
+        assert_that(list(index.ids()), has_length(0))
+
+        entry.Preview = True
+        index.index_doc(1, entry)
+        assert_that(index.documents_to_values.get(1), is_(True))
+
+        entry.Preview = False
+        index.index_doc(1, entry)
+        assert_that(index.documents_to_values.get(1), is_(False))
+
+        index.index_doc(2, CourseCatalogEntry())
+        assert_that(index.documents_to_values.get(2), is_(False))
+
+    def testCoursesCatalogChangeCount(self):
+        catalog = CoursesCatalog()
+        assert_that(catalog.change_count(), is_(0))
+        catalog.index_doc(1, ContentCourseInstance())
+        assert_that(catalog.change_count(), is_(1))
+        catalog.unindex_doc(1)
+        assert_that(catalog.change_count(), is_(2))
+
+    @WithMockDSTrans
+    def testCoursesCatalogStamp(self):
+        catalog = CoursesCatalog()
+        self.ds.dataserver_folder._p_jar.add(catalog)
+        assert_that(catalog.stamp(), is_not(none()))
+        # uncommitted changes are not to be cached
+        catalog.index_doc(1, ContentCourseInstance())
+        assert_that(catalog.stamp(), is_(none()))
+
+    def testCourseTagCountIndex(self):
+        index = CourseTagCountIndex()
+        entry1 = CourseCatalogEntry()
+        entry1.tags = (u'Math', u'science')
+        entry2 = CourseCatalogEntry()
+        entry2.tags = (u'math',)
+        index.index_doc(1, entry1)
+        index.index_doc(2, entry2)
+        assert_that(index.documentCount(), is_(2))
+        assert_that(index.tag_counts(None), is_({u'math': 2, u'science': 1}))
+        assert_that(index.tag_counts(None, prefix=u'sc'), is_({u'science': 1}))
+        assert_that(index.tag_counts((u'xxx',)), is_({}))
+
+        entry1.tags = (u'science',)
+        index.index_doc(1, entry1)
+        assert_that(index.tag_counts(None), is_({u'math': 1, u'science': 1}))
+
+        index.unindex_doc(2)
+        assert_that(index.tag_counts(None), is_({u'science': 1}))
+
+    def testCourseEntrySubstringIndex(self):
+        index = CourseEntrySubstringIndex()
+        entry1 = CourseCatalogEntry()
+        entry1.title = u'Introduction to Chemistry'
+        entry1.ProviderUniqueID = u'CHEM 1315'
+        entry2 = CourseCatalogEntry()
+        entry2.title = u'Organic chemistry'
+        entry2.tags = (u'lab',)
+        index.index_doc(1, entry1)
+        index.index_doc(2, entry2)
+
+        assert_that(list(index.apply(u'CHEMIS')), is_([1, 2]))
+        assert_that(list(index.apply({'query': u'm 13'})), is_([1]))
+        assert_that(list(index.apply(u'ic ch')), is_([2]))
+        assert_that(list(index.apply(u'lab')), is_([2]))
+        assert_that(list(index.apply(u'la')), is_([]))
+        assert_that(list(index.apply(u'xyz')), is_([]))
+        assert_that(list(index.apply(u' ')), is_([]))
+
+        entry2.title = u'Physics'
+        index.index_doc(2, entry2)
+        assert_that(list(index.apply(u'chemistry')), is_([1]))
+        index.unindex_doc(1)
+        assert_that(list(index.apply(u'chemistry')), is_([]))
+        assert_that(index.documentCount(), is_(1))
+
+    @fudge.patch('nti.contenttypes.courses.index.get_course_site')
+    def testCourseSiteIndexCounts(self, mock_course_site):
+        index = CourseSiteIndex()
+        mock_course_site.is_callable().returns(u'alpha')
+        index.index_doc(1, ContentCourseInstance())
+        index.index_doc(2, ContentCourseInstance())
+        assert_that(index.has_documents(u'alpha'), is_(True))
+        assert_that(index.has_documents(u'beta'), is_(False))
+        assert_that(index.count(u'alpha'), is_(2))
+        assert_that(index.count(u'beta'), is_(0))
+
+        mock_course_site.is_callable().returns(u'beta')
+        index.index_doc(2, ContentCourseInstance())
+        assert_that(index.count(u'alpha'), is_(1))
+        assert_that(index.count(u'beta'), is_(1))
+
+        index.unindex_doc(1)
+        assert_that(index.has_documents(u'alpha'), is_(False))
+        assert_that(index.count(u'alpha'), is_(0))
+
+        # entries and deleted courses are indexed, not counted
+        index.index_doc(3, CourseCatalogEntry())
+        deleted = ContentCourseInstance()
+        interface.alsoProvides(deleted, IDeletedCourse)
+        index.index_doc(4, deleted)
+        assert_that(index.count(u'beta'), is_(1))
+        index.index_doc(2, deleted)
+        assert_that(index.has_documents(u'beta'), is_(True))
+        assert_that(index.count(u'beta'), is_(0))
+        index.index_doc(2, ContentCourseInstance())
+        assert_that(index.count(u'beta'), is_(1))
+
+        # no longer indexed, uncounted once
+        index.index_doc(2, object())
+        assert_that(index.count(u'beta'), is_(0))
+        assert_that(index._site_counts.get(u'beta'), is_(none()))
+
+        # indexes without counts
+        mock_course_site.is_callable().returns(u'beta')
+        index.index_doc(2, ContentCourseInstance())
+        index._site_counts = None
+        assert_that(index.count(u'beta'), is_(none()))
+        index.rebuild_counts((2, 4))
+        assert_that(index.count(u'beta'), is_(2))
+
+    @fudge.patch('nti.contenttypes.courses.index._intern_hash')
+    def testInternTableCollisions(self, mock_hash):
+        mock_hash.is_callable().returns(7)
+        table = InternTable()
+        assert_that(table.intern(u'ichigo'), is_(7))
+        assert_that(table.intern(u'rukia'), is_(8))
+        assert_that(table.intern(u'ichigo'), is_(7))
+        assert_that(table.value(8), is_(u'rukia'))
+        assert_that(len(table), is_(2))
+
+    def testIterIndexItemsReversed(self):
+        tree = BTrees.family64.OI.BTree()
+        assert_that(list(_iter_index_items(tree, True)), is_([]))
+        tree[u'a'] = 1
+        assert_that(list(_iter_index_items(tree, True)), is_([(u'a', 1)]))
+        # deep enough to have several levels of buckets
+        for i in range(5000):
+            tree[u'%05d' % i] = i
+        assert_that(list(_iter_index_items(tree, True)),
+                    is_(list(reversed(list(tree.items())))))
+
+    def testInternedEnrollmentIndexes(self):
+        index = InternedSingleSiteIndex()
+        index.index_doc(1, IndexRecord(site=u'alpha.nextthought.com'))
+        index.index_doc(2, IndexRecord(site=u'beta.nextthought.com'))
+        index.index_doc(3, IndexRecord(site=u'alpha.nextthought.com'))
+        assert_that(len(index.intern_table), is_(2))
+        assert_that(index.documents_to_values.get(1),
+                    is_(index.intern_table.query_id(u'alpha.nextthought.com')))
+        assert_that(list(index.apply({'any_of': (u'alpha.nextthought.com',)})),
+                    is_([1, 3]))
+        assert_that(list(index.apply({'any_of': (u'xxx',)})), is_([]))
+        assert_that(list(index.apply({'between': (u'b', None)})), is_([2]))
+        assert_that(list(get_index_doc_ids(index, u'beta.nextthought.com')),
+                    is_([2]))
+        assert_that(index.values(2), is_([u'beta.nextthought.com']))
+        assert_that(index.containsValue(u'beta.nextthought.com'), is_(True))
+        index.unindex_doc(2)
+        assert_that(index.containsValue(u'beta.nextthought.com'), is_(False))
+
+        index = InternedUsernameIndex()
+        index.index_doc(1, IndexRecord(username=u'ichigo'))
+        index.index_doc(1, IndexRecord(username=u'aizen'))
+        index.index_doc(2, IndexRecord(username=u'aizen'))
+        assert_that(sorted(index.values(1)), is_([u'aizen', u'ichigo']))
+        assert_that(list(index.apply({'all_of': (u'aizen', u'ichigo')})),
+                    is_([1]))
+        index.remove(1, IndexRecord(username=u'ichigo'))
+        assert_that(index.values(1), is_([u'aizen']))
+        # removing values never indexed does not intern them
+        index.remove(1, IndexRecord(username=u'renji'))
+        assert_that(index.intern_table.query_id(u'renji'), is_(none()))
+        assert_that(len(index.intern_table), is_(2))
+
+        # sorted by value, not by interning order
+        index.index_doc(4, IndexRecord(username=u'abarai'))
+        assert_that(sort_doc_ids_by_index(index, [1, 2, 4, 5]),
+                    is_([4, 1, 2, 5]))
+        assert_that(sort_doc_ids_by_index(index, [1, 4, 5], reverse=True),
+                    is_([1, 4, 5]))
+        assert_that(sort_doc_ids_by_index(index, [1, 4, 5], limit=2),
+                    is_([4, 1]))
+        assert_that(sort_doc_ids_by_index(index, [1, 4, 5], limit=2,
+                                          reverse=True),
+                    is_([1, 4]))
+        assert_that(sort_doc_ids_by_index(index, [1, 4], limit=1,
+                                          key=lambda x: x.upper()),
+                    is_([4]))
+
+        # conversion from stored values
+        index.index_value(3, (u'rukia',))
+        assert_that(list(get_index_doc_ids(index, (u'rukia',))), is_([3]))
+
+    @fudge.patch('nti.contenttypes.courses.enrollment.queue_metadata_modififed',
+                 'nti.contenttypes.courses.enrollment.get_enrollment_meta_catalog')
+    def testEnrollmentCountDeltas(self, mock_queue, mock_catalog):
+        index = EnrollmentCountIndex()
+        assert_that(index.change_enrollment_count(1, 1), is_(False))
+        super(AttributeIndex, index).index_doc(1, 5)
+        assert_that(index.change_enrollment_count(1, 2), is_(True))
+        assert_that(index.documents_to_values.get(1), is_(7))
+        # drifted counts are not clamped, but counted again
+        assert_that(index.change_enrollment_count(1, -10), is_(False))
+        assert_that(index.documents_to_values.get(1), is_(7))
+        assert_that(list(index.apply({'any_of': (7,)})), is_([1]))
+
+        queued = []
+        mock_queue.is_callable().calls(queued.append)
+        mock_catalog.is_callable().returns({IX_ENROLLMENT_COUNT: index})
+        course1 = ContentCourseInstance()
+        course2 = ContentCourseInstance()
+        course3 = ContentCourseInstance()
+        deltas = EnrollmentCountDeltas()
+        for course, delta in ((course1, 1), (course2, 1), (course1, 1),
+                              (course2, -1), (course3, 1)):
+            deltas.add(course, delta)
+        assert_that(deltas.changes, is_(5))
+        assert_that(list(deltas._deltas.values()),
+                    is_([[course1, 2], [course2, 0], [course3, 1]]))
+
+        class IntIds(object):
+            def queryId(self, obj):
+                return {id(course1): 1}.get(id(obj))
+
+        intids = IntIds()
+        gsm = component.getGlobalSiteManager()
+        registered = gsm.queryUtility(IIntIds)
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            deltas.apply()
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+            if registered is not None:
+                gsm.registerUtility(registered, IIntIds)
+        # indexed courses are changed in place, the others counted
+        assert_that(index.documents_to_values.get(1), is_(9))
+        assert_that(queued, is_([course3]))
+        assert_that(deltas.changes, is_(0))
+
+    def testApplyQuery(self):
+        sites = InternedSingleSiteIndex()
+        usernames = InternedUsernameIndex()
+        for doc_id in range(1, 21):
+            record = IndexRecord(username=u'user%s' % (doc_id % 2),
+                                 site=u'site%s' % (doc_id % 4))
+            sites.index_doc(doc_id, record)
+            usernames.index_doc(doc_id, record)
+        usernames.index_doc(21, IndexRecord(username=u'aizen'))
+        catalog = {'site': sites, 'username': usernames}
+
+        assert_that(estimate_query_size(sites, {'any_of': (u'site1', u'site2')}),
+                    is_(10))
+        assert_that(estimate_query_size(usernames, {'any_of': (u'aizen',)}),
+                    is_(1))
+        assert_that(estimate_query_size(sites, {'between': (u'a', u'z')}),
+                    is_(none()))
+
+        query = {'site': {'any_of': (u'site1', u'site3')},
+                 'username': {'any_of': (u'user1',)}}
+        assert_that(list(apply_query(catalog, query)), is_(list(range(1, 21, 2))))
+        query = {'site': {'any_of': (u'site1', u'site2', u'site3')},
+                 'username': {'any_of': (u'aizen',)}}
+        assert_that(list(apply_query(catalog, query)), is_([]))
+        query = {'site': {'any_of': (u'xxx',)},
+                 'username': {'any_of': (u'user1',)}}
+        assert_that(list(apply_query(catalog, query)), is_([]))
+        assert_that(get_query_timings(), has_key('username'))
+
+    @fudge.patch('nti.contenttypes.courses.index.get_course_site')
+    def testOutlineAvailabilityQueries(self, mock_course_site):
+        catalog = create_course_outline_catalog()
+        now = datetime(2018, 1, 1, 12)
+        mock_course_site.is_callable().returns(u'alpha')
+        for doc_id, hours in ((1, 1), (2, 5), (3, 30)):
+            node = CourseOutlineContentNode(AvailableBeginning=now + timedelta(hours=hours),
+                                            AvailableEnding=now + timedelta(days=7))
+            catalog.index_doc(doc_id, node)
+        mock_course_site.is_callable().returns(u'beta')
+        catalog.index_doc(4, CourseOutlineContentNode(AvailableBeginning=now))
+        catalog.index_doc(5, CourseOutlineContentNode())
+
+        assert_that(list(get_site_outline_nodes_opening(6, sites=(u'alpha',),
+                                                        now=now, catalog=catalog)),
+                    is_([1, 2]))
+        assert_that(list(get_site_outline_nodes_opening(48, sites=(u'alpha', u'beta'),
+                                                        now=now, catalog=catalog)),
+                    is_([1, 2, 3, 4]))
+        assert_that(list(get_outline_node_intids_by_dates(beginning=(now, None),
+                                                          ending=(None, now + timedelta(days=7)),
+                                                          sites=(u'alpha',),
+                                                          catalog=catalog)),
+                    is_([1, 2, 3]))
+        assert_that(list(get_site_outline_nodes_opening(6, sites=(u'gamma',),
+                                                        now=now, catalog=catalog)),
+                    is_([]))
+
+    @WithMockDSTrans
+    def testCourseOutlineNodesOpening(self):
+        connection = self.ds.dataserver_folder._p_jar
+        intids = component.getUtility(IIntIds)
+        catalog = create_course_outline_catalog()
+        now = datetime(2018, 1, 1, 12)
+
+        course = ContentCourseInstance()
+        connection.add(course)
+        ICourseCatalogEntry(course).ntiid = u'tag:nextthought.com,2011-10:NTI-CourseInfo-course'
+        shared = course.SubInstances[u'01'] = ContentCourseSubInstance()
+        ICourseCatalogEntry(shared).ntiid = u'tag:nextthought.com,2011-10:NTI-CourseInfo-01'
+        section = course.SubInstances[u'02'] = ContentCourseSubInstance()
+        ICourseCatalogEntry(section).ntiid = u'tag:nextthought.com,2011-10:NTI-CourseInfo-02'
+        section.prepare_own_outline()
+
+        def add_node(outline, name, hours):
+            node = CourseOutlineContentNode(AvailableBeginning=now + timedelta(hours=hours))
+            outline[name] = node
+            if intids.queryId(node) is None:
+                connection.add(node)
+                addIntId(node)
+            doc_id = intids.getId(node)
+            catalog.index_doc(doc_id, node)
+            return doc_id
+
+        first = add_node(course.Outline, u'1', 1)
+        second = add_node(course.Outline, u'2', 30)
+        own = add_node(section.Outline, u'1', 2)
+
+        # nodes are indexed under the course that owns their outline
+        assert_that(catalog[IX_COURSE].documents_to_values.get(first),
+                    is_(ICourseCatalogEntry(course).ntiid))
+        assert_that(catalog[IX_COURSE].documents_to_values.get(own),
+                    is_(ICourseCatalogEntry(section).ntiid))
+
+        end = now + timedelta(hours=6)
+        assert_that(set(get_course_outline_nodes_opening(course, now, end,
+                                                         catalog=catalog)),
+                    is_({first}))
+        # a section sharing the outline of its parent gets its nodes
+        assert_that(set(get_course_outline_nodes_opening(shared, now, None,
+                                                         catalog=catalog)),
+                    is_({first, second}))
+        assert_that(set(get_course_outline_nodes_opening(section, now, end,
+                                                         catalog=catalog)),
+                    is_({own}))
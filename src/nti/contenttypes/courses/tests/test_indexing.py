@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+import fudge
+
+import unittest
+
+import transaction
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.contenttypes.courses._synchronize import synchronize_catalog_from_root
+
+from nti.contenttypes.courses.courses import ContentCourseInstance
+
+from nti.contenttypes.courses.index import install_courses_catalog
+
+from nti.contenttypes.courses.indexing import get_index_queue
+from nti.contenttypes.courses.indexing import batch_index_updates
+from nti.contenttypes.courses.indexing import get_batch_index_queue
+from nti.contenttypes.courses.indexing import defer_index_updates
+from nti.contenttypes.courses.indexing import flush_index_updates
+from nti.contenttypes.courses.indexing import deferred_index_updates
+from nti.contenttypes.courses.indexing import get_index_queue_stats
+from nti.contenttypes.courses.indexing import immediate_index_updates
+
+from nti.contenttypes.courses.tests import CourseLayerTest
+
+from nti.dataserver.tests.mock_dataserver import WithMockDSTrans
+
+from nti.intid.common import addIntId
+
+
+class _Catalog(object):
+
+    def __init__(self):
+        self.indexed = []
+
+    def index_doc(self, doc_id, obj):
+        self.indexed.append((doc_id, obj))
+
+
+class TestIndexing(unittest.TestCase):
+
+    def test_queue(self):
+        manager = transaction.TransactionManager()
+        txn = manager.begin()
+        assert_that(get_index_queue(txn), is_(none()))
+
+        catalog = _Catalog()
+        queue = defer_index_updates(txn)
+        assert_that(defer_index_updates(txn), is_(queue))
+        assert_that(queue.add(catalog, 1, u'a'), is_(True))
+        assert_that(queue.add(catalog, 2, u'b'), is_(True))
+        assert_that(queue.add(catalog, 1, u'c'), is_(True))
+        assert_that(queue.add(catalog, 3, u'd'), is_(True))
+        queue.discard(catalog, 3)
+        assert_that(queue.avoided, is_(1))
+        assert_that(catalog.indexed, is_([]))
+
+        before = get_index_queue_stats()
+        txn.commit()
+        assert_that(catalog.indexed, is_([(2, u'b'), (1, u'c')]))
+        assert_that(get_index_queue_stats(),
+                    has_entries('queued', before['queued'] + 4,
+                                'indexed', before['indexed'] + 2,
+                                'avoided', before['avoided'] + 1))
+
+    def test_flush(self):
+        manager = transaction.TransactionManager()
+        txn = manager.begin()
+        catalog = _Catalog()
+        queue = defer_index_updates(txn)
+        queue.add(catalog, 1, u'a')
+        assert_that(flush_index_updates(txn), is_(1))
+        assert_that(catalog.indexed, is_([(1, u'a')]))
+        assert_that(flush_index_updates(txn), is_(0))
+        txn.abort()
+
+    def test_deferred(self):
+        catalog = _Catalog()
+        transaction.begin()
+        try:
+            with deferred_index_updates() as queue:
+                assert_that(get_index_queue(), is_(queue))
+                with deferred_index_updates() as nested:
+                    assert_that(nested, is_(queue))
+                queue.add(catalog, 1, u'a')
+                assert_that(catalog.indexed, is_([]))
+            assert_that(catalog.indexed, is_([(1, u'a')]))
+            assert_that(get_index_queue(), is_(none()))
+        finally:
+            transaction.abort()
+
+    def test_batch(self):
+        catalog = _Catalog()
+        assert_that(get_batch_index_queue(), is_(none()))
+        with self.assertRaises(ValueError):
+            with batch_index_updates() as queue:
+                with batch_index_updates() as nested:
+                    assert_that(nested, is_(queue))
+                queue.add(catalog, 1, u'a')
+                queue.add(catalog, 1, u'b')
+                assert_that(catalog.indexed, is_([]))
+                raise ValueError()
+        # indexed in one pass, even on errors
+        assert_that(catalog.indexed, is_([(1, u'b')]))
+        assert_that(get_batch_index_queue(), is_(none()))
+
+
+class _Synchronizer(object):
+
+    queue = None
+
+    def synchronize(self, *unused_args, **unused_kwargs):
+        self.queue = get_index_queue()
+
+
+class TestCoursesCatalogQueue(CourseLayerTest):
+
+    @WithMockDSTrans
+    def test_index_at_commit(self):
+        ds_folder = self.ds.dataserver_folder
+        catalog = install_courses_catalog(ds_folder)
+        if catalog._p_jar is None:
+            ds_folder._p_jar.add(catalog)
+        course = ContentCourseInstance()
+        ds_folder._p_jar.add(course)
+        addIntId(course)
+        doc_id = component.getUtility(IIntIds).getId(course)
+
+        txn = transaction.get()
+        queue = defer_index_updates()
+        before = catalog.change_count()
+        catalog.index_doc(doc_id, course)
+        catalog.index_doc(doc_id, course)
+        assert_that(catalog.change_count(), is_(before))
+        assert_that(len(queue), is_(1))
+        assert_that(queue.avoided, is_(1))
+
+        with immediate_index_updates():
+            assert_that(catalog.change_count(), is_(before + 1))
+            catalog.index_doc(doc_id, course)
+            assert_that(catalog.change_count(), is_(before + 2))
+
+        # what commit does
+        catalog.index_doc(doc_id, course)
+        assert_that(catalog.change_count(), is_(before + 2))
+        for hook, args, kwargs in txn.getBeforeCommitHooks():
+            hook(*args, **kwargs)
+        assert_that(catalog.change_count(), is_(before + 3))
+        assert_that(len(queue), is_(0))
+
+    @fudge.patch('nti.contenttypes.courses._synchronize.component.getMultiAdapter')
+    def test_sync_defers(self, mock_adapter):
+        synchronizer = _Synchronizer()
+        mock_adapter.is_callable().returns(synchronizer)
+        transaction.begin()
+        try:
+            synchronize_catalog_from_root(object(), object())
+            assert_that(synchronizer.queue, is_not(none()))
+            # only while syncing
+            assert_that(get_index_queue(), is_(none()))
+        finally:
+            transaction.abort()
@@ -8,6 +8,9 @@ from __future__ import absolute_import
 # disable: accessing protected members, too many methods
 # pylint: disable=W0212,R0904
 
+from hamcrest import is_
+from hamcrest import raises
+from hamcrest import calling
 from hamcrest import contains
 from hamcrest import has_items
 from hamcrest import has_entry
@@ -16,6 +19,9 @@ from hamcrest import assert_that
 from hamcrest import has_entries
 from hamcrest import contains_inanyorder
 
+from datetime import datetime
+from datetime import timedelta
+
 import fudge
 
 from zope import component
@@ -38,10 +44,13 @@ from nti.contentfragments.interfaces import IPlainTextContentFragment
 from nti.contenttypes.courses.courses import ContentCourseInstance
 from nti.contenttypes.courses.courses import ContentCourseSubInstance
 
+from nti.contenttypes.courses.enrollment import DefaultPrincipalEnrollments
+
 from nti.contenttypes.courses.index import IX_TAGS
 
 from nti.contenttypes.courses.index import get_courses_catalog
 from nti.contenttypes.courses.index import get_enrollment_catalog
+from nti.contenttypes.courses.index import get_enrollment_records_extent
 from nti.contenttypes.courses.index import install_courses_catalog
 from nti.contenttypes.courses.index import install_enrollment_catalog
 
@@ -57,14 +66,19 @@ from nti.contenttypes.courses.interfaces import ICourseInstanceEnrollmentRecord
 from nti.contenttypes.courses.utils import get_editors
 from nti.contenttypes.courses.utils import get_instructors
 from nti.contenttypes.courses.utils import get_course_tags
+from nti.contenttypes.courses.utils import get_course_roster
 from nti.contenttypes.courses.utils import index_course_roles
+from nti.contenttypes.courses.utils import has_enrollments
+from nti.contenttypes.courses.utils import has_edited_courses
 from nti.contenttypes.courses.utils import get_courses_for_tag
 from nti.contenttypes.courses.utils import ProxyEnrollmentRecord
+from nti.contenttypes.courses.utils import has_instructed_courses
 from nti.contenttypes.courses.utils import get_instructed_courses
 from nti.contenttypes.courses.utils import get_enrollment_records
 from nti.contenttypes.courses.utils import get_entries_for_puid
 from nti.contenttypes.courses.utils import get_courses_for_puid
 from nti.contenttypes.courses.utils import get_entry_intids_for_puid
+from nti.contenttypes.courses.utils import get_sorted_entry_intids
 from nti.contenttypes.courses.utils import get_entry_intids_for_title
 from nti.contenttypes.courses.utils import get_all_site_course_intids
 from nti.contenttypes.courses.utils import entry_intids_to_course_intids
@@ -178,6 +192,17 @@ class TestEntryFilters(CourseLayerTest):
         assert_that(all_tags, has_entries(u'entry3 tag', 2,
                                           u'duplicate_tag', 3))
 
+        filter_util = component.getUtility(ICourseCatalogEntryFilterUtility)
+        entry_intids, facets = filter_util.faceted_search()
+        assert_that(entry_intids, has_length(4))
+        assert_that(facets['tags'], is_(all_tags))
+        assert_that(facets, has_entries('active', 4,
+                                        'upcoming', 0,
+                                        'archived', 0))
+        entry_intids, facets = filter_util.faceted_search([u'course2'])
+        assert_that(entry_intids, has_length(1))
+        assert_that(facets['tags'], has_entries(u'duplicate_tag', 1))
+
         all_tags = get_course_tags(filter_str=u'entry3')
         assert_that(all_tags, has_length(1))
         assert_that(all_tags, contains(u'entry3 tag'))
@@ -410,6 +435,18 @@ class TestEntryFilters(CourseLayerTest):
         result = filter_util.get_entry_intids_for_filters([u'one', u'thre*'], union=False)
         assert_that(result, has_length(0))
 
+        # Sorted pages
+        entry_intids = [intids.getId(x) for x in (entry1, entry2, entry3)]
+        total, result = get_sorted_entry_intids(entry_intids=entry_intids)
+        assert_that(total, is_(3))
+        assert_that(_get_entries(result), contains(entry1, entry2, entry3))
+        total, result = get_sorted_entry_intids(entry_intids=entry_intids,
+                                                reverse=True, offset=1, limit=1)
+        assert_that(total, is_(3))
+        assert_that(_get_entries(result), contains(entry2))
+        assert_that(calling(get_sorted_entry_intids).with_args(sort_on=u'xxx'),
+                    raises(ValueError))
+
         # Unindex third course
         catalog.unindex_doc(intids.getId(entry3))
         result = filter_util.get_entry_intids_for_filters([u'one', u'thre*'])
@@ -421,6 +458,44 @@ class TestEntryFilters(CourseLayerTest):
         result = filter_util.get_entry_intids_for_filters(u' ')
         assert_that(result, has_length(0))
 
+    @WithMockDSTrans
+    def test_current_entries(self):
+        ds_folder = self.ds.dataserver_folder
+        install_courses_catalog(ds_folder)
+        intids = component.queryUtility(IIntIds)
+        catalog = get_courses_catalog()
+        now = datetime.utcnow()
+
+        entry_intids = []
+        for title, start, end in ((u'current', now - timedelta(days=1), now + timedelta(days=1)),
+                                  (u'upcoming', now + timedelta(days=1), None),
+                                  (u'archived', now - timedelta(days=2), now - timedelta(days=1))):
+            inst = ContentCourseInstance()
+            entry = ICourseCatalogEntry(inst)
+            entry.title = title
+            entry.StartDate = start
+            entry.EndDate = end
+            ds_folder._p_jar.add(inst)
+            addIntId(inst)
+            ds_folder._p_jar.add(entry)
+            addIntId(entry)
+            catalog.index_doc(intids.getId(entry), entry)
+            entry_intids.append(intids.getId(entry))
+
+        filter_util = component.getUtility(ICourseCatalogEntryFilterUtility)
+        result = filter_util.get_current_entry_intids(entry_intids)
+        assert_that(list(result), contains(entry_intids[0]))
+        # answered again from the cached set
+        result = filter_util.get_current_entry_intids(entry_intids)
+        assert_that(list(result), contains(entry_intids[0]))
+
+        # date changes are picked up
+        entry = intids.getObject(entry_intids[1])
+        entry.StartDate = now - timedelta(days=1)
+        catalog.index_doc(entry_intids[1], entry)
+        result = filter_util.get_current_entry_intids(entry_intids)
+        assert_that(list(result), contains_inanyorder(entry_intids[0], entry_intids[1]))
+
     @WithMockDSTrans
     def test_puids(self):
         ds_folder = self.ds.dataserver_folder
@@ -600,6 +675,12 @@ class TestContextEnrollments(CourseLayerTest):
         instructed_courses = get_instructed_and_edited_courses(student_user)
         assert_that(instructed_courses, has_length(0))
 
+        assert_that(has_instructed_courses(editor_user), is_(True))
+        assert_that(has_instructed_courses(student_user), is_(False))
+        assert_that(has_edited_courses(editor_user), is_(True))
+        assert_that(has_instructed_courses(editor_user, sites=(u'xxx',)),
+                    is_(False))
+
     def _add_course(self, course_title, ds_folder):
         course = ContentCourseInstance()
         entry = ICourseCatalogEntry(course)
@@ -683,6 +764,46 @@ class TestContextEnrollments(CourseLayerTest):
         # sites
         assert_that(get_enrollment_records(sites=(u'xxx',)), has_length(0))
 
+        # only enrollment records are in the extent
+        extent = get_enrollment_records_extent(enrollment_catalog)
+        assert_that(list(extent),
+                    contains_inanyorder(*[intids.getId(x) for x in (record11, record12, record22)]))
+
+        # paged rosters
+        total, records = get_course_roster(course2, sort_on='username')
+        assert_that(total, is_(2))
+        assert_that(records, contains(record12, record22))
+        total, records = get_course_roster(course2, sort_on='username',
+                                           reverse=True, limit=1)
+        assert_that(total, is_(2))
+        assert_that(records, contains(record22))
+        total, records = get_course_roster(course2, sort_on='createdTime',
+                                           offset=1, limit=1)
+        assert_that(records, has_length(1))
+        assert_that(calling(get_course_roster).with_args(course2, sort_on='xxx'),
+                    raises(ValueError))
+
+        # principal enrollments are answered from the catalog
+        enrollments = DefaultPrincipalEnrollments(user1)
+        assert_that(enrollments._record_intids, has_length(2))
+        assert_that(enrollments.count_enrollments(), is_(2))
+        assert_that(list(enrollments.iter_enrollments()),
+                    contains_inanyorder(record11, record12))
+        assert_that(DefaultPrincipalEnrollments(user3).count_enrollments(), is_(0))
+
+        # records of courses not in the courses catalog (e.g. those of the
+        # global catalog) are checked against their course
+        get_courses_catalog().unindex_doc(intids.getId(course1))
+        enrollments = DefaultPrincipalEnrollments(user1)
+        assert_that(enrollments.count_enrollments(), is_(2))
+        assert_that(list(enrollments.iter_enrollments()),
+                    contains_inanyorder(record11, record12))
+
+        # existence checks use the indexes only
+        assert_that(has_enrollments(user1), is_(True))
+        assert_that(has_enrollments(user3), is_(False))
+        assert_that(has_enrollments(user1, sites=(u'xxx',)), is_(False))
+
 
 class TestUtils(CourseLayerTest):
 
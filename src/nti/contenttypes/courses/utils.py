@@ -8,7 +8,10 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import sys
+
 from datetime import datetime
+from datetime import timedelta
 
 from itertools import chain
 
@@ -47,6 +50,9 @@ from nti.contentlibrary.interfaces import IContentUnit
 from nti.contentlibrary.interfaces import IContentPackage
 from nti.contentlibrary.interfaces import IEditableContentPackage
 
+from nti.contenttypes.courses.catalog_snapshot import default_externalizer
+from nti.contenttypes.courses.catalog_snapshot import get_catalog_snapshot_service
+
 from nti.contenttypes.courses.common import get_course_site
 from nti.contenttypes.courses.common import get_course_packages
 from nti.contenttypes.courses.common import get_course_editors
@@ -61,25 +67,42 @@ from nti.contenttypes.courses.index import IX_ENTRY
 from nti.contenttypes.courses.index import IX_COURSE
 from nti.contenttypes.courses.index import IX_TOPICS
 from nti.contenttypes.courses.index import IX_PACKAGES
+from nti.contenttypes.courses.index import IX_TAG_COUNTS
+from nti.contenttypes.courses.index import IX_ENTRY_SUBSTRING
 from nti.contenttypes.courses.index import IX_USERNAME
+from nti.contenttypes.courses.index import IX_CREATEDTIME
+from nti.contenttypes.courses.index import IX_LASTMODIFIED
 from nti.contenttypes.courses.index import IX_ENTRY_PUID
 from nti.contenttypes.courses.index import IX_ENTRY_DESC
 from nti.contenttypes.courses.index import IX_IMPORT_HASH
 from nti.contenttypes.courses.index import IX_ENTRY_TITLE
+from nti.contenttypes.courses.index import IX_ENTRY_PUID_SORT
+from nti.contenttypes.courses.index import IX_ENTRY_TITLE_SORT
 from nti.contenttypes.courses.index import IX_CONTENT_UNIT
+from nti.contenttypes.courses.index import IX_AVAILABLE_ENDING
+from nti.contenttypes.courses.index import IX_AVAILABLE_BEGINNING
 from nti.contenttypes.courses.index import IX_COURSE_INSTRUCTOR
 from nti.contenttypes.courses.index import IX_COURSE_EDITOR
+from nti.contenttypes.courses.index import IX_ENTRY_PREVIEW
 from nti.contenttypes.courses.index import IX_ENTRY_END_DATE
 from nti.contenttypes.courses.index import IX_ENTRY_START_DATE
+from nti.contenttypes.courses.index import IX_ENROLLMENT_TOPICS
 from nti.contenttypes.courses.index import IX_COURSE_TO_ENTRY_INTID
 from nti.contenttypes.courses.index import IX_ENTRY_TO_COURSE_INTID
 from nti.contenttypes.courses.index import TP_DELETED_COURSES
+from nti.contenttypes.courses.index import TP_ENROLLMENT_RECORDS
 from nti.contenttypes.courses.index import TP_NON_PUBLIC_COURSES
 
 from nti.contenttypes.courses.index import IndexRecord
+from nti.contenttypes.courses.index import apply_query
 from nti.contenttypes.courses.index import get_courses_catalog
 from nti.contenttypes.courses.index import get_enrollment_catalog
 from nti.contenttypes.courses.index import get_course_outline_catalog
+from nti.contenttypes.courses.index import sort_doc_ids_by_index
+from nti.contenttypes.courses.index import sort_doc_ids_by_field_index
+from nti.contenttypes.courses.index import get_index_doc_ids
+from nti.contenttypes.courses.index import has_common_doc_ids
+from nti.contenttypes.courses.index import get_enrollment_records_extent
 
 from nti.contenttypes.courses.interfaces import COURSE_ROLES
 from nti.contenttypes.courses.interfaces import ES_ALL
@@ -98,6 +121,7 @@ from nti.contenttypes.courses.interfaces import ICourseInstance
 from nti.contenttypes.courses.interfaces import ICourseEnrollments
 from nti.contenttypes.courses.interfaces import ICourseOutlineNode
 from nti.contenttypes.courses.interfaces import ICourseSubInstance
+from nti.contenttypes.courses.interfaces import INonPublicCourseInstance
 from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
 from nti.contenttypes.courses.interfaces import ICourseEnrollmentManager
 from nti.contenttypes.courses.interfaces import ICourseInstanceVendorInfo
@@ -217,7 +241,7 @@ def get_courses_for_packages(packages=(), sites=(), intids=None):
         IX_PACKAGES: {'any_of': packages}
     }
     intids = component.getUtility(IIntIds) if intids is None else intids
-    for uid in catalog.apply(query) or ():
+    for uid in apply_query(catalog, query) or ():
         course = ICourseInstance(intids.queryObject(uid), None)
         result.add(course)
     result.discard(None)
@@ -240,9 +264,15 @@ def unindex_course_roles(context, catalog=None):
 
 
 def get_enrollments_query(catalog=None, usernames=None, entry_ntiids=None, site_names=None):
-    query = {
-        IX_SCOPE: {'any_of': get_enrollment_scopes(catalog=catalog)}
-    }
+    catalog = get_enrollment_catalog() if catalog is None else catalog
+    if get_enrollment_records_extent(catalog) is not None:
+        query = {
+            IX_ENROLLMENT_TOPICS: {'query': (TP_ENROLLMENT_RECORDS,)}
+        }
+    else:
+        query = {
+            IX_SCOPE: {'any_of': get_enrollment_scopes(catalog=catalog)}
+        }
 
     if usernames:
         query[IX_USERNAME] = {'any_of': usernames}
@@ -494,7 +524,11 @@ def is_enrolled_in_hierarchy(context, user):
     return False
 
 
-def get_course_enrollments(context, sites=None, intids=None):
+def get_course_enrollment_intids(context, sites=None):
+    """
+    Return the intids of the enrollment records for the given course(s),
+    without waking any record.
+    """
     if     ICourseInstance.providedBy(context) \
         or ICourseCatalogEntry.providedBy(context):
         entry = ICourseCatalogEntry(context, None)
@@ -506,14 +540,18 @@ def get_course_enrollments(context, sites=None, intids=None):
         courses = context.split()
     else:
         courses = context
-    result = []
     sites = get_sites_4_index(sites)
     catalog = get_enrollment_catalog()
-    intids = component.getUtility(IIntIds) if intids is None else intids
     query = get_enrollments_query(catalog=catalog,
                                   site_names=sites,
                                   entry_ntiids=courses)
-    for doc_id in catalog.apply(query) or ():
+    return catalog.apply(query) or ()
+
+
+def get_course_enrollments(context, sites=None, intids=None):
+    result = []
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    for doc_id in get_course_enrollment_intids(context, sites):
         obj = intids.queryObject(doc_id)
         if     ICourseInstanceEnrollmentRecord.providedBy(obj) \
             or ICourseInstance.providedBy(obj):
@@ -521,6 +559,51 @@ def get_course_enrollments(context, sites=None, intids=None):
     return result
 
 
+#: The enrollment catalog indexes a roster can be sorted on
+ROSTER_SORT_INDEXES = (IX_CREATEDTIME, IX_LASTMODIFIED, IX_USERNAME)
+
+
+def get_course_roster(context, sort_on=None, reverse=False, offset=0,
+                      limit=None, sites=None, intids=None):
+    """
+    Return a page of the enrollment records of the given course(s).
+
+    The record intids are sorted and sliced using the enrollment
+    catalog indexes; only the records in the requested page are
+    resolved.
+
+    :param sort_on: One of ``createdTime``, ``lastModified`` or
+        ``username``. If not given, records are in intid order.
+    :return: A tuple with the total number of records and the list
+        of records in the page.
+    """
+    doc_ids = get_course_enrollment_intids(context, sites)
+    total = len(doc_ids)
+    offset = max(offset or 0, 0)
+    end = offset + limit if limit is not None else None
+    if sort_on:
+        if sort_on not in ROSTER_SORT_INDEXES:
+            raise ValueError("Invalid roster sort key", sort_on)
+        catalog = get_enrollment_catalog()
+        index = catalog[sort_on]
+        key = (lambda x: x.lower()) if sort_on == IX_USERNAME else None
+        doc_ids = sort_doc_ids_by_index(index, doc_ids,
+                                        reverse=reverse,
+                                        limit=end,
+                                        key=key)
+    else:
+        doc_ids = list(doc_ids)
+        if reverse:
+            doc_ids.reverse()
+    result = []
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    for doc_id in doc_ids[offset:end]:
+        obj = intids.queryObject(doc_id)
+        if ICourseInstanceEnrollmentRecord.providedBy(obj):
+            result.append(obj)
+    return total, result
+
+
 def get_courses_for_scope(user, scopes=(), sites=None, intids=None):
     """
     Fetch the enrollment records for the given user (or username)
@@ -537,7 +620,7 @@ def get_courses_for_scope(user, scopes=(), sites=None, intids=None):
     }
     if sites:
         query[IX_SITE] = {'any_of': sites}
-    for doc_id in catalog.apply(query) or ():
+    for doc_id in apply_query(catalog, query) or ():
         obj = intids.queryObject(doc_id)
         if     ICourseInstanceEnrollmentRecord.providedBy(obj) \
             or (    ICourseInstance.providedBy(obj)
@@ -547,36 +630,115 @@ def get_courses_for_scope(user, scopes=(), sites=None, intids=None):
 _get_courses_for_scope = get_courses_for_scope
 
 
-def get_enrollments(user, **kwargs):
+def get_enrollments(user, sites=None, intids=None):
     """
-    Returns an iterable containing all the courses
-    in which this user is enrolled
+    Returns an iterable containing all the enrollment records
+    of this user.
     """
-    return get_courses_for_scope(user,
-                                 scopes=get_enrollment_scopes(),
-                                 **kwargs)
+    result = []
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    catalog = get_enrollment_catalog()
+    sites = get_sites_4_index(sites)
+    username = getattr(user, 'username', user)
+    query = get_enrollments_query(catalog=catalog,
+                                  usernames=(username,),
+                                  site_names=sites)
+    for doc_id in catalog.apply(query) or ():
+        obj = intids.queryObject(doc_id)
+        if ICourseInstanceEnrollmentRecord.providedBy(obj):
+            result.append(obj)
+    return result
 
 
-def get_non_preview_enrollments(user, **kwargs):
+def get_preview_entry_intids(now=None, catalog=None):
+    """
+    Return the intids of the catalog entries currently in preview, either
+    because they are explicitly flagged so or because they start after
+    ``now``.
+    """
+    catalog = get_courses_catalog() if catalog is None else catalog
+    family = catalog.family
+    if IX_ENTRY_PREVIEW not in catalog:
+        return family.IF.Set()
+    now = datetime.utcnow() if now is None else now
+    flags = catalog[IX_ENTRY_PREVIEW]
+    explicit = get_index_doc_ids(flags, (True,), family=family)
+    not_preview = get_index_doc_ids(flags, (False,), family=family)
+    upcoming = catalog.apply({IX_ENTRY_START_DATE: {'between': (now, None)}})
+    upcoming = family.IF.difference(upcoming, not_preview)
+    return family.IF.union(explicit, upcoming)
+
+
+def get_preview_entry_ntiids(now=None, catalog=None):
+    """
+    Return the ntiids of the catalog entries currently in preview.
+    """
+    result = set()
+    catalog = get_courses_catalog() if catalog is None else catalog
+    entry_intids = get_preview_entry_intids(now, catalog)
+    if entry_intids:
+        ntiid_index = catalog[IX_ENTRY].documents_to_values
+        for course_intid in entry_intids_to_course_intids(entry_intids):
+            ntiid = ntiid_index.get(course_intid)
+            if ntiid:
+                result.add(ntiid)
+    return result
+
+
+def get_non_preview_enrollments(user, sites=None, intids=None):
     """
     Returns an iterable containing all the non-preview enrollment records
     for this user.
     """
-    records = get_enrollments(user, **kwargs)
     result = []
-    for record in records:
-        course = ICourseInstance(record, None)
-        entry = ICourseCatalogEntry(course, None)
-        if entry is not None and not entry.Preview:
-            result.append(record)
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    catalog = get_enrollment_catalog()
+    sites = get_sites_4_index(sites)
+    username = getattr(user, 'username', user)
+    query = get_enrollments_query(catalog=catalog,
+                                  usernames=(username,),
+                                  site_names=sites)
+    doc_ids = catalog.apply(query)
+    if doc_ids:
+        preview_ntiids = get_preview_entry_ntiids()
+        if preview_ntiids:
+            preview_docs = get_index_doc_ids(catalog[IX_ENTRY], preview_ntiids)
+            doc_ids = catalog.family.IF.difference(doc_ids, preview_docs)
+    for doc_id in doc_ids or ():
+        obj = intids.queryObject(doc_id)
+        if not ICourseInstanceEnrollmentRecord.providedBy(obj):
+            continue
+        # skip records whose course or entry was removed
+        course = ICourseInstance(obj, None)
+        if ICourseCatalogEntry(course, None) is not None:
+            result.append(obj)
     return result
 
 
-def has_enrollments(user, intids=None):
-    for obj in get_enrollments(user, intids=intids):
-        if ICourseInstanceEnrollmentRecord.providedBy(obj):
-            return True
-    return False
+def user_has_enrollments(user, sites=None, catalog=None):
+    """
+    Return whether this user has any enrollment record in the given
+    sites, answering from the enrollment catalog indexes only.
+    """
+    catalog = get_enrollment_catalog() if catalog is None else catalog
+    if catalog is None:
+        return False
+    sites = get_sites_4_index(sites)
+    username = getattr(user, 'username', user)
+    user_docs = get_index_doc_ids(catalog[IX_USERNAME], (username,))
+    if not user_docs:
+        return False
+    records = get_enrollment_records_extent(catalog)
+    if records is None:
+        records = get_index_doc_ids(catalog[IX_SCOPE],
+                                    get_enrollment_scopes(catalog=catalog))
+    site_docs = get_index_doc_ids(catalog[IX_SITE], sites) if sites else None
+    return has_common_doc_ids((user_docs, records, site_docs),
+                              family=catalog.family)
+
+
+def has_enrollments(user, intids=None, sites=None):  # pylint: disable=unused-argument
+    return user_has_enrollments(user, sites=sites)
 
 
 @interface.implementer(ICourseInstanceEnrollmentRecord)
@@ -695,7 +857,7 @@ def get_all_site_course_intids(site=None):
     # here is `__name__`, which should always be none-null for real courses.
     query = {IX_SITE: {'any_of': sites},
              IX_NAME: {'any': None}}
-    return catalog.apply(query)
+    return apply_query(catalog, query)
 
 
 def get_all_site_entry_intids(site=None, exclude_non_public=False, exclude_deleted=True):
@@ -710,7 +872,7 @@ def get_all_site_entry_intids(site=None, exclude_non_public=False, exclude_delet
     sites = get_sites_4_index(site)
     if sites:
         query[IX_SITE] = {'any_of': sites}
-    rs = catalog.apply(query)
+    rs = apply_query(catalog, query)
     if exclude_deleted:
         deleted_intids_extent = catalog[IX_TOPICS][TP_DELETED_COURSES].getExtent()
         rs = rs - deleted_intids_extent
@@ -720,6 +882,39 @@ def get_all_site_entry_intids(site=None, exclude_non_public=False, exclude_delet
     return rs
 
 
+#: The courses catalog indexes the catalog entries can be sorted on
+ENTRY_SORT_INDEXES = (IX_ENTRY_TITLE_SORT, IX_ENTRY_PUID_SORT)
+
+
+def get_sorted_entry_intids(site=None, sort_on=IX_ENTRY_TITLE_SORT, reverse=False,
+                            offset=0, limit=None, exclude_non_public=False,
+                            exclude_deleted=True, entry_intids=None):
+    """
+    Return a page of the catalog entry intids for all courses in the site
+    hierarchy (or of the given entry intids), sorted with the title or
+    provider unique id sort index. Nothing is woken up.
+
+    :param sort_on: One of ``title_sort`` or ``provider_unique_id_sort``.
+    :return: A tuple with the total number of entries and the list
+        of entry intids in the page.
+    """
+    if sort_on not in ENTRY_SORT_INDEXES:
+        raise ValueError("Invalid catalog sort key", sort_on)
+    catalog = get_courses_catalog()
+    if entry_intids is None:
+        entry_intids = get_all_site_entry_intids(site,
+                                                 exclude_non_public=exclude_non_public,
+                                                 exclude_deleted=exclude_deleted)
+    total = len(entry_intids)
+    offset = max(offset or 0, 0)
+    end = offset + limit if limit is not None else None
+    doc_ids = sort_doc_ids_by_field_index(catalog[sort_on], entry_intids,
+                                          reverse=reverse,
+                                          limit=end,
+                                          family=catalog.family)
+    return total, doc_ids[offset:end]
+
+
 def get_site_course_admin_intids_for_user(user, site=None):
     """
     For the given site admin, return all applicable course intids.
@@ -762,7 +957,7 @@ def _get_course_admin_intids_for_user(user, idx, site=None):
     }
     if sites:
         query[IX_SITE] = {'any_of': sites}
-    return catalog.apply(query)
+    return apply_query(catalog, query)
 
 
 def get_instructed_courses_intids(user, site=None):
@@ -785,18 +980,37 @@ def get_edited_courses_intids(user, site=None):
                                              site=site)
 
 
-def has_instructed_courses(user):
+def user_has_course_role(user, idx, sites=None):
+    """
+    Return whether this user is indexed in the given (instructor or
+    editor) index of the courses catalog for any course in the given
+    sites, answering from the indexes only.
+    """
+    catalog = get_courses_catalog()
+    if catalog is None:
+        return False
+    sites = get_sites_4_index(sites)
+    username = getattr(user, 'username', user)
+    course_docs = get_index_doc_ids(catalog[idx], (username,))
+    if not course_docs:
+        return False
+    site_docs = get_index_doc_ids(catalog[IX_SITE], sites) if sites else None
+    return has_common_doc_ids((course_docs, site_docs),
+                              family=catalog.family)
+
+
+def has_instructed_courses(user, sites=None):
     """
     Return a bool if this user instructs any courses.
     """
-    return bool(get_instructed_courses_intids(user))
+    return user_has_course_role(user, IX_COURSE_INSTRUCTOR, sites=sites)
 
 
-def has_edited_courses(user):
+def has_edited_courses(user, sites=None):
     """
     Return a bool if this user acts as an editor for any courses.
     """
-    return bool(get_edited_courses_intids(user))
+    return user_has_course_role(user, IX_COURSE_EDITOR, sites=sites)
 
 
 def get_instructed_courses(user):
@@ -984,6 +1198,72 @@ def get_content_outline_nodes(ntiid, intids=None):
     return tuple(result)
 
 
+def _get_outline_owner_ntiid(course):
+    # sections may share the outline (and thus the nodes) of their parent
+    # (an acquired outline is parented by the section, the adapter finds
+    # its true owner)
+    outline = getattr(course, 'Outline', None)
+    owner = ICourseInstance(outline, None) if outline is not None else None
+    entry = ICourseCatalogEntry(owner if owner is not None else course, None)
+    return getattr(entry, 'ntiid', None)
+
+
+def get_outline_node_intids_by_dates(beginning=None, ending=None, courses=None,
+                                     sites=None, catalog=None):
+    """
+    Return the intids of the outline nodes whose availability begins and/or
+    ends within the given (start, end) datetime ranges; either bound of a
+    range may be None. The nodes can be restricted to the outlines of the
+    given courses and/or to the given sites; without either, they are
+    restricted to the current site hierarchy.
+    """
+    catalog = get_course_outline_catalog() if catalog is None else catalog
+    family = catalog.family
+    query = {}
+    if beginning is not None:
+        query[IX_AVAILABLE_BEGINNING] = {'between': tuple(beginning)}
+    if ending is not None:
+        query[IX_AVAILABLE_ENDING] = {'between': tuple(ending)}
+    if courses is not None:
+        if ICourseInstance.providedBy(courses):
+            courses = (courses,)
+        ntiids = {_get_outline_owner_ntiid(x) for x in courses}
+        ntiids.discard(None)
+        if not ntiids:
+            return family.IF.Set()
+        query[IX_COURSE] = {'any_of': ntiids}
+    if courses is None or sites is not None:
+        sites = get_sites_4_index(sites)
+        if sites:
+            query[IX_SITE] = {'any_of': sites}
+    if not query:
+        query[IX_AVAILABLE_BEGINNING] = {'between': (None, None)}
+    result = apply_query(catalog, query, family=family)
+    return result if result is not None else family.IF.Set()
+
+
+def get_course_outline_nodes_opening(course, start=None, end=None, catalog=None):
+    """
+    Return the intids of the outline nodes of the given course that become
+    available between the given datetimes.
+    """
+    return get_outline_node_intids_by_dates(beginning=(start, end),
+                                            courses=(course,),
+                                            catalog=catalog)
+
+
+def get_site_outline_nodes_opening(hours, sites=None, now=None, catalog=None):
+    """
+    Return the intids of the outline nodes of all the courses in the given
+    sites (the current site hierarchy if None) that become available within
+    the next given hours.
+    """
+    now = datetime.utcnow() if now is None else now
+    return get_outline_node_intids_by_dates(beginning=(now, now + timedelta(hours=hours)),
+                                            sites=sites,
+                                            catalog=catalog)
+
+
 def unregister_outline_nodes(course, registry=None):
     if registry is None:
         site = get_course_site(course)
@@ -1123,6 +1403,25 @@ def add_principal_to_course_content_roles(principal, course, packages=None):
         membership.setGroups(final_groups)
 
 
+def add_principals_to_course_content_roles(principals, course, packages=None):
+    """
+    Add all the given principals to the content roles of the course,
+    computing those roles only once.
+    """
+    new_groups = None
+    for principal in principals:
+        if get_principal(principal) is None:
+            continue
+        if new_groups is None:
+            new_groups = _content_roles_for_course_instance(course, packages)
+        membership = component.getAdapter(principal, IMutableGroupMember,
+                                          CONTENT_ROLE_PREFIX)
+        orig_groups = set(membership.groups)
+        final_groups = orig_groups | new_groups
+        if final_groups != orig_groups:
+            membership.setGroups(final_groups)
+
+
 def _get_principal_visible_packages(principal, courses_to_exclude=()):
     """
     Gather the set of packages the principal has access to, excluding any
@@ -1457,33 +1756,65 @@ def filter_hidden_tags(tags):
 
 
 def get_course_tags(filter_str=None, filter_hidden=True, sites=(),
-                    exclude_non_public=True):
+                    exclude_non_public=True, prefix=None):
     """
     Get all course tags. Optionally filtering by the given `filter_str` param
-    and by default, removing all hidden tags.
+    (or tag `prefix`) and by default, removing all hidden tags.
 
     Only tags for non-deleted, public courses are returned.
 
     Returns a dict of tag -> course count.
     """
     catalog = get_courses_catalog()
+    if IX_TAG_COUNTS in catalog:
+        sites = get_sites_4_index(sites)
+        counts = catalog[IX_TAG_COUNTS].tag_counts(sites or None,
+                                                   public_only=exclude_non_public,
+                                                   prefix=prefix.lower() if prefix else None)
+        if filter_str:
+            filter_str = filter_str.lower()
+        return {
+            tag: count for tag, count in counts.items()
+            if      not (filter_hidden and is_hidden_tag(tag))
+                and not (filter_str and filter_str not in tag)
+        }
+
+    entry_intids = get_all_site_entry_intids(site=sites,
+                                             exclude_deleted=True,
+                                             exclude_non_public=exclude_non_public)
+    result = count_entry_tags(entry_intids,
+                              filter_str=filter_str,
+                              filter_hidden=filter_hidden)
+    if prefix:
+        prefix = prefix.lower()
+        result = {k: v for k, v in result.items() if k.startswith(prefix)}
+    return result
+
+
+def count_entry_tags(entry_intids, filter_str=None, filter_hidden=True, catalog=None):
+    """
+    Returns a dict of tag -> count of the given entry intids with that tag,
+    intersecting them with the documents of each tag in the tag index.
+    """
+    catalog = get_courses_catalog() if catalog is None else catalog
+    family = catalog.family
     tag_index = catalog[IX_TAGS]
     result = dict()
     if filter_str:
         filter_str = filter_str.lower()
-    entry_intids = get_all_site_entry_intids(site=sites,
-                                             exclude_deleted=True,
-                                             exclude_non_public=exclude_non_public)
-    for entry_intid in entry_intids:
-        course_tags = tag_index._rev_index.get(entry_intid)
-        for tag in course_tags or ():
-            if filter_hidden and is_hidden_tag(tag):
-                continue
-            if filter_str and filter_str not in tag:
-                continue
-            if tag not in result:
-                result[tag] = 0
-            result[tag] += 1
+    if not isinstance(entry_intids, (family.IF.Set, family.IF.TreeSet)):
+        entry_intids = family.IF.Set(entry_intids)
+    if not entry_intids:
+        return result
+    # pylint: disable=protected-access
+    for tag, tag_intids in tag_index._fwd_index.items():
+        if filter_hidden and is_hidden_tag(tag):
+            continue
+        if filter_str and filter_str not in tag:
+            continue
+        count = len(family.IF.intersection(tag_intids, entry_intids))
+        if count:
+            result[tag] = count
     return result
 
 
@@ -1582,6 +1913,33 @@ class CourseCatalogEntryFilterUtility(object):
                 or entry in tagged_entries
         return result
 
+    def _entry_filter(self, filter_str):
+        """
+        Return a callable telling whether an entry matches the given
+        filter str. Entries in the substring index are answered from
+        it; others are checked directly.
+        """
+        filter_str = filter_str.lower()
+        catalog = get_courses_catalog()
+        index = None
+        if catalog is not None and IX_ENTRY_SUBSTRING in catalog:
+            index = catalog[IX_ENTRY_SUBSTRING]
+        intids = component.queryUtility(IIntIds) if index is not None else None
+        matching = index.apply(filter_str) if index is not None else ()
+        tagged = []
+
+        def include(entry):
+            doc_id = intids.queryId(entry) if intids is not None else None
+            if doc_id is not None:
+                if doc_id in matching:
+                    return True
+                if index.has_doc(doc_id):
+                    return False
+            if not tagged:
+                tagged.append(self.get_tagged_entries(filter_str))
+            return self._include_entry(entry, filter_str, tagged[0])
+        return include
+
     def filter_entries(self, entries, filter_strs, selector=lambda x: x, union=True):
         """
         Returns a filtered sequence of included :class:`ICourseCatalogEntry`
@@ -1598,20 +1956,15 @@ class CourseCatalogEntryFilterUtility(object):
             entries = (entries,)
         if filter_strs and len(filter_strs) == 1:
             # Special case the single filter - since this is used by UI
-            filter_str = filter_strs[0]
-            filter_str = filter_str.lower()
-            tagged_entries = self.get_tagged_entries(filter_str)
-            entries = set(x for x in entries
-                          if self._include_entry(selector(x), filter_str, tagged_entries))
+            include = self._entry_filter(filter_strs[0])
+            entries = set(x for x in entries if include(selector(x)))
         elif filter_strs:
             rs = []
             # Go ahead and get a list in case they gave us an iterator
             all_entries = list(entries)
             for filter_str in filter_strs:
-                filter_str = filter_str.lower()
-                tagged_entries = self.get_tagged_entries(filter_str)
-                entries = set(x for x in all_entries
-                              if self._include_entry(selector(x), filter_str, tagged_entries))
+                include = self._entry_filter(filter_str)
+                entries = set(x for x in all_entries if include(selector(x)))
                 rs.append(entries)
             operator = set.union if union else set.intersection
             entries = reduce(operator, rs)
@@ -1627,6 +1980,14 @@ class CourseCatalogEntryFilterUtility(object):
                      get_entry_intids_for_tag,
                      get_entry_intids_for_title):
             rs.append(func(filter_str, sites=sites))
+        if IX_ENTRY_SUBSTRING in courses_catalog:
+            # Also match within words, as filter_entries does
+            substring_rs = courses_catalog[IX_ENTRY_SUBSTRING].apply(filter_str)
+            if substring_rs and sites:
+                site_rs = get_index_doc_ids(courses_catalog[IX_SITE], sites)
+                substring_rs = courses_catalog.family.IF.intersection(substring_rs,
+                                                                      site_rs)
+            rs.append(substring_rs)
         __traceback_info__ = rs
         return reduce(courses_catalog.family.IF.union, rs)
 
@@ -1665,13 +2026,96 @@ class CourseCatalogEntryFilterUtility(object):
             entry_idx = catalog[IX_ENTRY_TO_COURSE_INTID]
             entry_intids = entry_idx.ids()
         now = datetime.utcnow()
+        exclude_set = self._get_not_current_entry_intids(catalog, now)
+        return catalog.family.IF.difference(entry_intids, exclude_set)
+
+    # A tuple of (catalog key, next boundary, intids) for the last computed
+    # set of entries that are not current.
+    _not_current = None
+
+    def _get_not_current_entry_intids(self, catalog, now):
+        """
+        Return the entry intids that are not current at ``now``. The set only
+        changes when a start or end date passes or the catalog changes, so we
+        keep it until the nearest upcoming date in the indexes.
+        """
+        start_index = catalog[IX_ENTRY_START_DATE]
+        end_index = catalog[IX_ENTRY_END_DATE]
+        normalizer = getattr(start_index, 'normalizer', None)
+        catalog_stamp = getattr(catalog, 'stamp', None)
+        if normalizer is None or catalog_stamp is None:
+            return self.get_entry_intids_by_dates(start_not_before=now,
+                                                  end_not_after=now)
+        now_value = normalizer.value(now)
+        key = catalog_stamp()
+        cached = self._not_current
+        if cached is not None and cached[0] == key and now_value < cached[1]:
+            return cached[2]
         # This logic is reversed. We'll get the universe of entry intids with
         # start dates *after* now unioned with universe of entry intids with
         # end dates *before* now. All entry intids *not* in this set will be
         # considered for return, which will include entries without any start or end dates.
-        exclude_set = self.get_entry_intids_by_dates(start_not_before=now,
-                                                     end_not_after=now)
-        return catalog.family.IF.difference(entry_intids, exclude_set)
+        result = self.get_entry_intids_by_dates(start_not_before=now,
+                                                end_not_after=now)
+        boundary = sys.maxsize
+        for index, min_value in ((start_index, now_value),
+                                 (end_index, now_value + 1)):
+            values_to_documents = index.index.values_to_documents
+            try:
+                boundary = min(boundary, values_to_documents.minKey(min_value))
+            except ValueError:  # no upcoming dates
+                pass
+        if key is not None:
+            self._not_current = (key, boundary, result)
+        return result
+
+    def faceted_search(self, filter_strs=None, union=True, sites=None,
+                       exclude_non_public=True, start_terms=(), filter_hidden=True):
+        """
+        Return the entry intids in the site hierarchy matching the given
+        filter strs along with a dict of facet counts over that result.
+
+        The facets are ``tags`` (tag -> count), ``sites`` (site -> count),
+        ``active``, ``upcoming`` and ``archived`` counts and, for each
+        (name, start_not_before, start_not_after) tuple in ``start_terms``,
+        a ``terms`` count of the entries starting in that term. All of
+        them are computed by intersecting intid sets.
+        """
+        catalog = get_courses_catalog()
+        family = catalog.family
+        sites = get_sites_4_index(sites)
+        result = get_all_site_entry_intids(site=sites,
+                                           exclude_deleted=True,
+                                           exclude_non_public=exclude_non_public)
+        if filter_strs:
+            filter_rs = self.get_entry_intids_for_filters(filter_strs, union=union)
+            result = family.IF.intersection(result, filter_rs)
+
+        def count(doc_ids):
+            return len(family.IF.intersection(result, doc_ids)) if doc_ids else 0
+
+        now = datetime.utcnow()
+        upcoming = catalog.apply({IX_ENTRY_START_DATE: {'between': (now, None)}})
+        archived = catalog.apply({IX_ENTRY_END_DATE: {'between': (None, now)}})
+        facets = {
+            'tags': count_entry_tags(result,
+                                     filter_hidden=filter_hidden,
+                                     catalog=catalog),
+            'sites': {
+                site: count(get_index_doc_ids(catalog[IX_SITE], (site,)))
+                for site in sites or ()
+            },
+            'upcoming': count(upcoming),
+            'archived': count(archived),
+            'active': len(result) - count(family.IF.union(upcoming, archived)),
+            'terms': {},
+        }
+        for name, start_not_before, start_not_after in start_terms or ():
+            query = {
+                IX_ENTRY_START_DATE: {'between': (start_not_before, start_not_after)}
+            }
+            facets['terms'][name] = count(catalog.apply(query))
+        return result, facets
 
     def get_entry_intids_by_dates(self, union=True,
                                   start_not_before=None, start_not_after=None,
@@ -1713,16 +2157,63 @@ def is_catalog_anonymously_accessible():
     return False
 
 
+def _is_public_entry(entry):
+    return not INonPublicCourseInstance.providedBy(entry)
+
+
+def get_anonymous_catalog_snapshot(externalizer=None):
+    """
+    Return the externalized public entries of the current catalog if it is
+    anonymously accessible, otherwise None. The entries are served from the
+    catalog snapshot service, if any.
+    """
+    if not is_catalog_anonymously_accessible():
+        return None
+    service = get_catalog_snapshot_service()
+    if service is None:
+        catalog = component.getUtility(ICourseCatalog)
+        externalizer = externalizer or default_externalizer
+        return [externalizer(x) for x in catalog.iterCatalogEntries()
+                if _is_public_entry(x)]
+    return service.snapshot(variant=u'anonymous',
+                            externalizer=externalizer,
+                            predicate=_is_public_entry)
+
+
 def _used_seats(seat_limit):
     # Used seats is obtained via the course in the lineage. With secion
     # courses, this works via acquisition.
     course = find_interface(seat_limit, ICourseInstance, strict=False)
+    reserved_seats = getattr(seat_limit, 'reserved_seats', None)
+    if course is not None and reserved_seats is not None:
+        # pylint: disable=not-callable
+        reserved = reserved_seats(course)
+        if reserved is not None:
+            return reserved
+    # no seat counter yet
     enrollments = ICourseEnrollments(course, None)
     if enrollments is not None:
         return enrollments.count_enrollments()
     return 0
 
 
+def reconcile_course_seats(course):
+    """
+    Reconcile the reserved seat counter of the given course with its
+    actual enrollment count.
+
+    :return: A tuple of the previous and actual seat counts, or None if
+        the course has no seat limit.
+    """
+    entry = ICourseCatalogEntry(course, None)
+    seat_limit = getattr(entry, 'seat_limit', None)
+    reconcile = getattr(seat_limit, 'reconcile_seats', None)
+    if reconcile is None:
+        return None
+    # pylint: disable=not-callable
+    return reconcile(course)
+
+
 def can_user_enroll(seat_limit):
     if seat_limit is None:
         return True